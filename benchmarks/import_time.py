@@ -0,0 +1,45 @@
+# Benchmark: import time of the command line and of the managers
+#
+# Exits with an error if the median time of a command is above --max
+# seconds, so that it can guard against import-time side effects.
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    "--help": [sys.executable, "-m", "biblioruler", "--help"],
+    "mendeley": [sys.executable, "-c", "import biblioruler.managers.mendeley"],
+    "papers3": [sys.executable, "-c", "import biblioruler.managers.papers3"],
+    "zotero5": [sys.executable, "-c", "import biblioruler.managers.zotero5"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max", type=float, default=1.0, help="Maximum median time (in seconds)"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for name, command in COMMANDS.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            times.append(time.time() - start)
+        median = statistics.median(times)
+        print("%s: %.3fs (median of %d)" % (name, median, args.repeat))
+        if median > args.max:
+            print("  above the maximum of %.3fs" % args.max)
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Benchmark: Papers3 citation graph (Papers3.citations), built from a
+# synthetic library, and its expansion along citations
+
+import argparse
+import os.path as op
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from biblioruler.managers.db.papers3 import metadata
+from biblioruler.managers.papers3 import CitationGraph, Papers3
+
+
+def create(path, publications, citations, seed=0):
+    """Creates a Papers3 library where each publication cites others
+
+    :param publications: The number of publications
+    :param citations: The number of publications cited by each publication
+    """
+    metadata.create_all(create_engine("sqlite:///%s" % path))
+    rng = random.Random(seed)
+    uuids = ["P%08d" % i for i in range(publications)]
+
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO Metadata(uuid, key, value) VALUES ('m', 'version', '1')")
+    conn.executemany(
+        "INSERT INTO Publication(uuid, type, attributed_title, created_at, updated_at) VALUES (?, -100, ?, 0, 0)",
+        ((uuid, "Title %s" % uuid) for uuid in uuids),
+    )
+    conn.executemany(
+        "INSERT INTO Citation(uuid, object_id) VALUES (?, ?)",
+        (("C" + uuid, uuid) for uuid in uuids),
+    )
+    conn.executemany(
+        "INSERT INTO CitationItem(uuid, citation, object_id) VALUES (?, ?, ?)",
+        (
+            ("CI%s-%d" % (uuid, ix), "C" + uuid, target)
+            for uuid in uuids
+            for ix, target in enumerate(cited(rng, uuids, uuid, citations))
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def cited(rng, uuids, uuid, citations):
+    """Returns random publications cited by a publication (not itself)"""
+    sample = rng.sample(uuids, citations + 1)
+    return [other for other in sample if other != uuid][:citations]
+
+
+def timeit(f, repeat):
+    """Returns the best time of f (in seconds)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--publications", type=int, default=20000)
+    parser.add_argument(
+        "--citations", type=int, default=10, help="Citations per publication"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--path", help="Synthetic library (created if needed)")
+    args = parser.parse_args()
+
+    path = args.path or op.join(tempfile.mkdtemp(), "Database.papersdb")
+    if not op.exists(path):
+        print(
+            "Creating a library with %d publications (%d citations each) in %s"
+            % (args.publications, args.citations, path)
+        )
+        create(path, args.publications, args.citations)
+
+    manager = Papers3(path, op.dirname(path))
+    graph = manager.citations()
+    edges = len(graph.targets)
+    print("%d publications, %d citations" % (len(graph), edges))
+
+    duration = timeit(manager.citations, args.repeat)
+    print("citations(): %.2fs (query and build)" % duration)
+
+    pairs = [
+        (graph.uuids[ix], graph.uuids[target])
+        for ix in range(len(graph))
+        for target in graph.targets[graph.offsets[ix] : graph.offsets[ix + 1]]
+    ]
+    duration = timeit(lambda: CitationGraph(pairs), args.repeat)
+    print("CitationGraph: %.2fs (build)" % duration)
+
+    starts = random.Random(0).sample(graph.uuids, min(args.samples, len(graph)))
+    for name, f in [
+        ("cites()", lambda uuid: graph.cites(uuid)),
+        ("expand(hops=2)", lambda uuid: graph.expand([uuid], hops=2)),
+        (
+            "expand(hops=2, cited_by=True)",
+            lambda uuid: graph.expand([uuid], hops=2, cited_by=True),
+        ),
+    ]:
+        reached = sum(len(f(uuid)) for uuid in starts) / len(starts)
+        duration = timeit(lambda: [f(uuid) for uuid in starts], args.repeat)
+        print(
+            "%s: %.1fus (%.0f publications)"
+            % (name, duration / len(starts) * 1e6, reached)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# Synthetic Zotero 5 library, used by the Zotero benchmarks
+
+import argparse
+import datetime as dt
+import random
+import sqlite3
+
+ITEM_TYPES = [
+    "journalArticle",
+    "conferencePaper",
+    "book",
+    "note",
+    "attachment",
+    "annotation",
+]
+FIELDS = ["title", "date", "DOI", "volume", "pages", "publicationTitle", "abstractNote"]
+TAGS = ["tag%d" % i for i in range(200)]
+WORDS = ["word%d" % i for i in range(2000)]
+
+
+"""A subset of the Zotero 5 schema"""
+SCHEMA = """
+CREATE TABLE libraries (libraryID INTEGER PRIMARY KEY, type TEXT NOT NULL, editable INT NOT NULL, filesEditable INT NOT NULL, version INT NOT NULL DEFAULT 0, storageVersion INT NOT NULL DEFAULT 0, lastSync INT NOT NULL DEFAULT 0, archived INT NOT NULL DEFAULT 0);
+CREATE TABLE feeds (libraryID INTEGER PRIMARY KEY, name TEXT NOT NULL, url TEXT NOT NULL UNIQUE, lastUpdate TIMESTAMP, lastCheck TIMESTAMP, lastCheckError TEXT, cleanupReadAfter INT, cleanupUnreadAfter INT, refreshInterval INT);
+CREATE TABLE groups (groupID INTEGER PRIMARY KEY, libraryID INT NOT NULL UNIQUE, name TEXT NOT NULL, description TEXT NOT NULL, version INT NOT NULL);
+CREATE TABLE itemTypes (itemTypeID INTEGER PRIMARY KEY, typeName TEXT, templateItemTypeID INT, display INT DEFAULT 1);
+CREATE TABLE fieldsCombined (fieldID INT NOT NULL, fieldName TEXT NOT NULL, label TEXT, fieldFormatID INT, custom INT NOT NULL, PRIMARY KEY (fieldID));
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, itemTypeID INT NOT NULL, dateAdded TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, dateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, libraryID INT NOT NULL, key TEXT NOT NULL, version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0, UNIQUE (libraryID, key));
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value UNIQUE);
+CREATE TABLE itemData (itemID INT, fieldID INT, valueID, PRIMARY KEY (itemID, fieldID));
+CREATE INDEX itemData_fieldID ON itemData(fieldID);
+CREATE TABLE itemNotes (itemID INTEGER PRIMARY KEY, parentItemID INT, note TEXT, title TEXT);
+CREATE INDEX itemNotes_parentItemID ON itemNotes(parentItemID);
+CREATE TABLE itemAttachments (itemID INTEGER PRIMARY KEY, parentItemID INT, linkMode INT, contentType TEXT, charsetID INT, path TEXT, syncState INT DEFAULT 0, storageModTime INT, storageHash TEXT, lastProcessedModificationTime INT);
+CREATE INDEX itemAttachmentParentItemID ON itemAttachments(parentItemID);
+CREATE TABLE itemAnnotations (itemID INTEGER PRIMARY KEY, parentItemID INT NOT NULL, type INTEGER NOT NULL, authorName TEXT, text TEXT, comment TEXT, color TEXT, pageLabel TEXT, sortIndex TEXT NOT NULL, position TEXT NOT NULL, isExternal INT NOT NULL);
+CREATE INDEX itemAnnotations_parentItemID ON itemAnnotations(parentItemID);
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE itemTags (itemID INT NOT NULL, tagID INT NOT NULL, type INT NOT NULL, PRIMARY KEY (itemID, tagID));
+CREATE INDEX itemTags_tagID ON itemTags(tagID);
+CREATE TABLE creatorTypes (creatorTypeID INTEGER PRIMARY KEY, creatorType TEXT);
+CREATE TABLE creators (creatorID INTEGER PRIMARY KEY, firstName TEXT, lastName TEXT, fieldMode INT, UNIQUE (lastName, firstName, fieldMode));
+CREATE TABLE itemCreators (itemID INT NOT NULL, creatorID INT NOT NULL, creatorTypeID INT NOT NULL DEFAULT 1, orderIndex INT NOT NULL DEFAULT 0, PRIMARY KEY (itemID, creatorID, creatorTypeID, orderIndex), UNIQUE (itemID, orderIndex));
+CREATE INDEX itemCreators_creatorTypeID ON itemCreators(creatorTypeID);
+CREATE TABLE collections (collectionID INTEGER PRIMARY KEY, collectionName TEXT NOT NULL, parentCollectionID INT DEFAULT NULL, clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, libraryID INT NOT NULL, key TEXT NOT NULL, version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0, UNIQUE (libraryID, key));
+CREATE TABLE collectionItems (collectionID INT NOT NULL, itemID INT NOT NULL, orderIndex INT NOT NULL DEFAULT 0, PRIMARY KEY (collectionID, itemID));
+CREATE INDEX collectionItems_itemID ON collectionItems(itemID);
+CREATE TABLE deletedItems (itemID INTEGER PRIMARY KEY, dateDeleted DEFAULT CURRENT_TIMESTAMP NOT NULL);
+CREATE TABLE relationPredicates (predicateID INTEGER PRIMARY KEY, predicate TEXT UNIQUE);
+CREATE TABLE itemRelations (itemID INT NOT NULL, predicateID INT NOT NULL, object TEXT NOT NULL, PRIMARY KEY (itemID, predicateID, object));
+CREATE TABLE fulltextWords (wordID INTEGER PRIMARY KEY, word TEXT UNIQUE);
+CREATE TABLE fulltextItemWords (wordID INT, itemID INT, PRIMARY KEY (wordID, itemID));
+CREATE INDEX fulltextItemWords_itemID ON fulltextItemWords(itemID);
+CREATE TABLE savedSearches (savedSearchID INTEGER PRIMARY KEY, savedSearchName TEXT NOT NULL, clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, libraryID INT NOT NULL, key TEXT NOT NULL, version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0, UNIQUE (libraryID, key));
+CREATE TABLE savedSearchConditions (savedSearchID INT NOT NULL, searchConditionID INT NOT NULL, condition TEXT NOT NULL, operator TEXT, value TEXT, required NONE, PRIMARY KEY (savedSearchID, searchConditionID));
+"""
+
+
+def create(path, n=50000, seed=0):
+    """Creates a synthetic Zotero library with n publications
+
+    Each publication has a few fields, creators and tags; some of them have a
+    note and an (indexed and annotated) attachment, and a few are deleted.
+    """
+    r = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    c = conn.cursor()
+    c.execute(
+        "INSERT INTO libraries(libraryID, type, editable, filesEditable, version, storageVersion, lastSync, archived) VALUES (1, 'user', 1, 1, 0, 0, 0, 0)"
+    )
+    c.executemany(
+        "INSERT INTO itemTypes(itemTypeID, typeName) VALUES (?, ?)",
+        enumerate(ITEM_TYPES, 1),
+    )
+    c.executemany(
+        "INSERT INTO fieldsCombined(fieldID, fieldName, custom) VALUES (?, ?, 0)",
+        enumerate(FIELDS, 1),
+    )
+    c.execute(
+        "INSERT INTO creatorTypes(creatorTypeID, creatorType) VALUES (1, 'author')"
+    )
+    c.executemany("INSERT INTO tags(tagID, name) VALUES (?, ?)", enumerate(TAGS, 1))
+    c.executemany(
+        "INSERT INTO fulltextWords(wordID, word) VALUES (?, ?)", enumerate(WORDS, 1)
+    )
+
+    now = dt.datetime(2020, 1, 1).isoformat(" ")
+    itemID = 0
+    valueIDs = {}
+    creatorID = 0
+    for i in range(n):
+        itemID += 1
+        parentID = itemID
+        c.execute(
+            "INSERT INTO items(itemID, itemTypeID, dateAdded, dateModified, clientDateModified, libraryID, key, version, synced) VALUES (?, ?, ?, ?, ?, 1, ?, ?, 0)",
+            (itemID, 1 + i % 3, now, now, now, "K%07d" % itemID, i),
+        )
+        values = {
+            "title": "A study of things, part %d" % i,
+            "date": "%04d-%02d-%02d" % (1990 + i % 30, 1 + i % 12, 1 + i % 28),
+            "DOI": "10.1000/%d" % i,
+            "volume": str(i % 50),
+            "pages": "%d-%d" % (i % 100, i % 100 + 10),
+        }
+        for fieldID, field in enumerate(FIELDS, 1):
+            if field in values:
+                # Values are shared between items
+                if values[field] not in valueIDs:
+                    valueIDs[values[field]] = len(valueIDs) + 1
+                    c.execute(
+                        "INSERT INTO itemDataValues(valueID, value) VALUES (?, ?)",
+                        (valueIDs[values[field]], values[field]),
+                    )
+                c.execute(
+                    "INSERT INTO itemData(itemID, fieldID, valueID) VALUES (?, ?, ?)",
+                    (itemID, fieldID, valueIDs[values[field]]),
+                )
+        for orderIndex in range(r.randint(1, 4)):
+            creatorID += 1
+            c.execute(
+                "INSERT INTO creators(creatorID, firstName, lastName, fieldMode) VALUES (?, ?, ?, 0)",
+                (creatorID, "First%d" % creatorID, "Last%d" % creatorID),
+            )
+            c.execute(
+                "INSERT INTO itemCreators(itemID, creatorID, creatorTypeID, orderIndex) VALUES (?, ?, 1, ?)",
+                (itemID, creatorID, orderIndex),
+            )
+        for tagID in r.sample(range(1, len(TAGS) + 1), r.randint(0, 3)):
+            c.execute(
+                "INSERT INTO itemTags(itemID, tagID, type) VALUES (?, ?, 0)",
+                (itemID, tagID),
+            )
+        if i % 5 == 0:
+            itemID += 1
+            c.execute(
+                "INSERT INTO items(itemID, itemTypeID, dateAdded, dateModified, clientDateModified, libraryID, key, version, synced) VALUES (?, 4, ?, ?, ?, 1, ?, ?, 0)",
+                (itemID, now, now, now, "K%07d" % itemID, i),
+            )
+            c.execute(
+                "INSERT INTO itemNotes(itemID, parentItemID, note, title) VALUES (?, ?, ?, ?)",
+                (itemID, parentID, "<p>Note on %d</p>" % i, "Note on %d" % i),
+            )
+        if i % 3 == 0:
+            itemID += 1
+            c.execute(
+                "INSERT INTO items(itemID, itemTypeID, dateAdded, dateModified, clientDateModified, libraryID, key, version, synced) VALUES (?, 5, ?, ?, ?, 1, ?, ?, 0)",
+                (itemID, now, now, now, "K%07d" % itemID, i),
+            )
+            c.execute(
+                "INSERT INTO itemAttachments(itemID, parentItemID, linkMode, contentType, path) VALUES (?, ?, 1, 'application/pdf', ?)",
+                (itemID, parentID, "storage:paper%d.pdf" % i),
+            )
+            c.executemany(
+                "INSERT INTO fulltextItemWords(wordID, itemID) VALUES (?, ?)",
+                [
+                    (wordID, itemID)
+                    for wordID in r.sample(range(1, len(WORDS) + 1), 100)
+                ],
+            )
+            attachmentID = itemID
+            # A highlight and a note
+            for kind in (1, 2):
+                itemID += 1
+                c.execute(
+                    "INSERT INTO items(itemID, itemTypeID, dateAdded, dateModified, clientDateModified, libraryID, key, version, synced) VALUES (?, 6, ?, ?, ?, 1, ?, ?, 0)",
+                    (itemID, now, now, now, "K%07d" % itemID, i),
+                )
+                page = i % 10
+                c.execute(
+                    "INSERT INTO itemAnnotations(itemID, parentItemID, type, text, comment, color, pageLabel, sortIndex, position, isExternal) VALUES (?, ?, ?, ?, ?, '#ffd400', ?, ?, ?, 0)",
+                    (
+                        itemID,
+                        attachmentID,
+                        kind,
+                        "Highlighted text" if kind == 1 else None,
+                        "Comment %d" % itemID,
+                        str(page + 1),
+                        "%05d|%06d|%05d" % (page, kind, 0),
+                        '{"pageIndex": %d, "rects": [[100, %d, 300, %d]]}'
+                        % (page, 100 * kind, 100 * kind + 12),
+                    ),
+                )
+        if i % 100 == 99:
+            c.execute(
+                "INSERT INTO deletedItems(itemID, dateDeleted) VALUES (?, ?)",
+                (parentID, now),
+            )
+
+    # Relations: related publications (in both directions), and a few
+    # publications replacing (merged) items that were deleted
+    c.executemany(
+        "INSERT INTO relationPredicates(predicateID, predicate) VALUES (?, ?)",
+        [(1, "dc:relation"), (2, "dc:replaces")],
+    )
+    keys = [key for key, in c.execute("SELECT key FROM items WHERE itemTypeID <= 3")]
+    for ix in range(0, len(keys) - 1, 50):
+        for source, target in ((keys[ix], keys[ix + 1]), (keys[ix + 1], keys[ix])):
+            c.execute(
+                "INSERT INTO itemRelations(itemID, predicateID, object) SELECT itemID, 1, ? FROM items WHERE key = ?",
+                ("http://zotero.org/users/1/items/%s" % target, source),
+            )
+        if ix % 500 == 0:
+            c.execute(
+                "INSERT INTO itemRelations(itemID, predicateID, object) SELECT itemID, 2, ? FROM items WHERE key = ?",
+                ("http://zotero.org/users/1/items/M%07d" % ix, keys[ix]),
+            )
+
+    # Collections: a tree with two levels, each publication being in one
+    ncollections = max(1, n // 500)
+    for collectionID in range(1, ncollections + 1):
+        c.execute(
+            "INSERT INTO collections(collectionID, collectionName, parentCollectionID, libraryID, key) VALUES (?, ?, ?, 1, ?)",
+            (
+                collectionID,
+                "Collection %d" % collectionID,
+                None if collectionID <= 10 else 1 + collectionID % 10,
+                "C%07d" % collectionID,
+            ),
+        )
+    c.execute(
+        "INSERT INTO collectionItems(collectionID, itemID, orderIndex) SELECT 1 + itemID %% %d, itemID, itemID FROM items"
+        % ncollections
+    )
+
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates a synthetic Zotero library")
+    parser.add_argument("path")
+    parser.add_argument("--items", type=int, default=50000)
+    args = parser.parse_args()
+    create(args.path, args.items)
@@ -0,0 +1,131 @@
+# Benchmark: loading of Zotero publications with plain SQL
+# (Manager.publications), the ORM (Manager.publications(orm=True)), and
+# lazily (per-key Paper._retrieve)
+
+import argparse
+import itertools
+import os.path as op
+import tempfile
+import time
+import tracemalloc
+
+from zotero5_library import create
+from biblioruler.managers.zotero5 import Manager, Paper
+
+
+def describe(paper):
+    return (
+        paper.uuid,
+        paper.type,
+        paper.title,
+        paper.doi,
+        paper.isodate(),
+        [(author.firstname, author.surname) for author in paper.authors],
+        sorted(paper.tags),
+        [note.html for note in paper.notes],
+        [(f.title, f.mimetype, f.path) for f in paper.files],
+    )
+
+
+def measure(name, papers):
+    """Iterates over papers (without keeping them), and reports the time and
+    peak memory"""
+    tracemalloc.start()
+    start = time.time()
+    count = 0
+    for paper in papers:
+        count += 1
+    duration = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(
+        "%s: %d papers in %.2fs (%.0f papers/s, peak memory %.1f kB/paper)"
+        % (name, count, duration, count / duration, peak / count / 1024)
+    )
+    return duration / count
+
+
+def allocations(name, papers, chunksize=500):
+    """Reports the Python memory blocks allocated per paper
+
+    Papers are read by chunks, which are kept until a tracemalloc snapshot
+    is taken: the blocks allocated while reading a chunk and still alive (the
+    papers, and whatever their loading retains) are the difference with the
+    snapshot taken before the chunk, and the transient memory is the peak
+    while reading it. The manager does not keep papers (its identity map is
+    weak), so each chunk is released before the next one.
+    """
+    papers = iter(papers)
+    tracemalloc.start()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    count = blocks = peak = 0
+    while True:
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        chunk = list(itertools.islice(papers, chunksize))
+        if not chunk:
+            break
+        peak = max(peak, (tracemalloc.get_traced_memory()[1] - start) / len(chunk))
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        blocks += sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+        count += len(chunk)
+        del chunk
+    tracemalloc.stop()
+    print(
+        "%s: %.0f blocks/paper, chunk peak %.1f kB/paper (%d papers)"
+        % (name, blocks / count, peak / 1024, count)
+    )
+    return blocks / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument(
+        "--lazy-items",
+        type=int,
+        default=5000,
+        help="Number of items loaded with the lazy path (slow)",
+    )
+    parser.add_argument("--path", help="Synthetic library (created if needed)")
+    args = parser.parse_args()
+
+    path = args.path or op.join(tempfile.mkdtemp(), "zotero.sqlite")
+    if not op.exists(path):
+        print("Creating a library with %d items in %s" % (args.items, path))
+        create(path, args.items)
+
+    manager = Manager(path, op.dirname(path), copy=False)
+
+    sql = measure("sql", manager.publications())
+    orm = measure("orm", manager.publications(orm=True))
+
+    papers = [describe(paper) for paper in manager.publications()]
+    assert papers == [
+        describe(paper) for paper in manager.publications(orm=True)
+    ], "sql and orm loading differ"
+
+    def lazy_papers():
+        for key in [paper[0].split(":")[-1] for paper in papers[: args.lazy_items]]:
+            paper = Paper(manager, key)
+            paper.title
+            yield paper
+
+    lazy = measure("lazy", lazy_papers())
+    assert [describe(paper) for paper in lazy_papers()] == papers[
+        : args.lazy_items
+    ], "bulk and lazy loading differ"
+
+    print("speedup (orm): %.1fx" % (lazy / orm))
+    print("speedup (sql): %.1fx" % (lazy / sql))
+
+    sql = allocations("sql", manager.publications())
+    orm = allocations("orm", manager.publications(orm=True))
+    lazy = allocations("lazy", lazy_papers())
+    print("allocations (orm/sql): %.1fx" % (orm / sql))
+    print("allocations (lazy/sql): %.1fx" % (lazy / sql))
+
+
+if __name__ == "__main__":
+    main()
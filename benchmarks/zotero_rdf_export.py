@@ -0,0 +1,67 @@
+# Benchmark: Zotero RDF export of a synthetic Zotero library (publications
+# are loaded beforehand, so that only the writer is measured)
+
+import argparse
+import hashlib
+import os
+import os.path as op
+import tempfile
+import time
+
+from zotero5_library import create
+from biblioruler.exporters.zotero_rdf import Exporter
+from biblioruler.managers.zotero5 import Manager
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument("--path", help="Synthetic library (created if needed)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", help="Base name of the RDF output (defaults to a temporary file)"
+    )
+    args = parser.parse_args()
+
+    path = args.path or op.join(tempfile.mkdtemp(), "zotero.sqlite")
+    if not op.exists(path):
+        print("Creating a library with %d items in %s" % (args.items, path))
+        create(path, args.items)
+
+    manager = Manager(path, op.dirname(path), copy=False)
+    papers = list(manager.publications())
+    collections = list(manager.collections().values())
+
+    # Attachments are only exported if their file exists
+    for paper in papers:
+        for f in paper.files:
+            if not op.exists(f.path):
+                os.makedirs(op.dirname(f.path), exist_ok=True)
+                with open(f.path, "wb") as fh:
+                    fh.write(b"%PDF-1.4\n")
+
+    output = args.output or op.join(tempfile.mkdtemp(), "export")
+    durations = []
+    for _ in range(args.repeat):
+        exporter = Exporter()
+        start = time.time()
+        exporter.export(output, papers, collections)
+        durations.append(time.time() - start)
+
+    duration = min(durations)
+    with open(output + ".rdf", "rb") as fh:
+        digest = hashlib.sha256(fh.read()).hexdigest()
+    print(
+        "%d papers in %.2fs (%.0f papers/s), %d bytes, sha256 %s"
+        % (
+            len(papers),
+            duration,
+            len(papers) / duration,
+            op.getsize(output + ".rdf"),
+            digest,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
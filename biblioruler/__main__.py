@@ -7,7 +7,8 @@ import sys
 import os
 import os.path as op
 from importlib import import_module
-import sqlite3
+
+import biblioruler.config as config
 
 # --- Utility functions
 
@@ -50,9 +51,8 @@ parser.add_argument(
 )
 parser.add_argument(
     "--config",
-    action="store_true",
-    default=op.expanduser("~/.biblioruler"),
-    help="Print debug information",
+    default=config.CONFIGPATH,
+    help="The configuration directory (defaults to %s)" % config.CONFIGPATH,
 )
 
 subparsers = parser.add_subparsers(help="Command", dest="command")
@@ -79,12 +79,11 @@ if args.command is None:
 logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
 
+config.CONFIGPATH = args.config
 if not op.exists(args.config):
     logging.info("Creating configuration directory")
     os.mkdir(args.config)
 
-db = sqlite3.connect(op.join(args.config, "data.db"))
-
 try:
     logging.debug("Calling command %s" % args.command)
     fname = "command_%s" % args.command.replace("-", "_")
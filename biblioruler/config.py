@@ -0,0 +1,171 @@
+# Local configuration and cache (~/.biblioruler)
+
+import json
+import logging
+import os
+import os.path as op
+import sqlite3
+
+"""The configuration directory (can be changed with --config)"""
+CONFIGPATH = op.expanduser("~/.biblioruler")
+
+
+def path(*parts):
+    """Returns a path within the configuration directory (creating it if needed)"""
+    os.makedirs(CONFIGPATH, exist_ok=True)
+    return op.join(CONFIGPATH, *parts)
+
+
+def signature(paths):
+    """Returns the modification time and size of each file (None if missing)"""
+    signature = {}
+    for filepath in paths:
+        try:
+            s = os.stat(filepath)
+            signature[filepath] = [s.st_mtime_ns, s.st_size]
+        except OSError:
+            signature[filepath] = None
+    return signature
+
+
+def cached(name, compute):
+    """Returns cached values, computing them again if their sources changed
+
+    Values are stored in defaults.json within the configuration directory,
+    along with the modification time and size of the files they were
+    computed from.
+
+    :param name: The key of the values in the cache
+    :param compute: A function returning a pair (values, sources), where
+        values is JSON serializable and sources is the list of the files that
+        were read
+    """
+    cachepath = path("defaults.json")
+    cache = {}
+    try:
+        with open(cachepath, "rt") as fh:
+            cache = json.load(fh)
+    except (OSError, ValueError):
+        pass
+
+    entry = cache.get(name)
+    if entry is not None and signature(entry["sources"]) == entry["signature"]:
+        return entry["values"]
+
+    values, sources = compute()
+    cache[name] = {
+        "values": values,
+        "sources": list(sources),
+        "signature": signature(sources),
+    }
+    try:
+        tmppath = cachepath + ".tmp"
+        with open(tmppath, "wt") as fh:
+            json.dump(cache, fh, indent=2)
+        os.replace(tmppath, cachepath)
+    except OSError:
+        logging.warning("Could not write the defaults cache %s", cachepath)
+    return values
+
+
+"""Tables of the local database"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    source TEXT NOT NULL, library INT NOT NULL, version INT NOT NULL, modified TEXT NOT NULL,
+    PRIMARY KEY (source, library));
+CREATE TABLE IF NOT EXISTS owners (
+    source TEXT NOT NULL, uuid TEXT NOT NULL, owner TEXT NOT NULL,
+    PRIMARY KEY (source, uuid));
+"""
+
+
+def database():
+    """Opens the local database (data.db), creating its tables if needed"""
+    conn = sqlite3.connect(path("data.db"))
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def watermark(source):
+    """Returns the watermark of a source (library -> (version, modified))
+
+    :param source: The identifier of the source
+    :returns: The watermark stored by :py:func:`set_watermark`, or None
+    """
+    conn = database()
+    try:
+        watermark = {
+            library: (version, modified)
+            for library, version, modified in conn.execute(
+                "SELECT library, version, modified FROM watermarks WHERE source = ?",
+                (source,),
+            )
+        }
+    finally:
+        conn.close()
+    return watermark or None
+
+
+def set_watermark(source, watermark):
+    """Stores the watermark of a source (library -> (version, modified))"""
+    conn = database()
+    try:
+        with conn:
+            conn.execute("DELETE FROM watermarks WHERE source = ?", (source,))
+            conn.executemany(
+                "INSERT INTO watermarks(source, library, version, modified) VALUES (?, ?, ?, ?)",
+                [
+                    (source, library, version, modified)
+                    for library, (version, modified) in watermark.items()
+                ],
+            )
+    finally:
+        conn.close()
+
+
+def owners(source, uuids):
+    """Returns the owners of rows (uuid -> owner uuid), e.g. the publications
+    of deleted authors or files, which cannot be read from the source anymore
+
+    :param source: The identifier of the source
+    :param uuids: The uuids of the rows
+    :returns: The owners stored by :py:func:`set_owners` (unknown rows are
+        left out)
+    """
+    conn = database()
+    try:
+        return {
+            uuid: row[0]
+            for uuid in uuids
+            for row in conn.execute(
+                "SELECT owner FROM owners WHERE source = ? AND uuid = ?",
+                (source, uuid),
+            )
+        }
+    finally:
+        conn.close()
+
+
+def set_owners(source, owners, removed=None):
+    """Stores the owners of rows (uuid -> owner uuid)
+
+    :param owners: The owners of the new or changed rows
+    :param removed: The uuids of the removed rows; if None, the owners
+        replace all the ones of the source
+    """
+    conn = database()
+    try:
+        with conn:
+            if removed is None:
+                conn.execute("DELETE FROM owners WHERE source = ?", (source,))
+            else:
+                conn.executemany(
+                    "DELETE FROM owners WHERE source = ? AND uuid = ?",
+                    [(source, uuid) for uuid in removed],
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO owners(source, uuid, owner) VALUES (?, ?, ?)",
+                [(source, uuid, owner) for uuid, owner in owners.items()],
+            )
+    finally:
+        conn.close()
@@ -1,29 +1,74 @@
-import xml.sax.saxutils
 import argparse
+import concurrent.futures
 import os.path as op
 import os
-import io
 import re
 import logging
-import PyPDF2
+from collections import deque, namedtuple
+
+import biblioruler.managers.base as managers
 
 
 def escape(string: str):
-    """Escape string for XML"""
+    """Escape string for XML (&, < and >, like xml.sax.saxutils.escape)"""
     if string is None:
         return None
-    return xml.sax.saxutils.escape(string)
-
-
-def write(out: io.IOBase, _indent: int, string: str, *objects, condition=True):
-    """Write a line to a stream with a given indent"""
-    if condition:
-        for _i in range(_indent):
-            out.write("  ")
-        if objects:
-            out.write(string.format(*objects))
-        else:
-            out.write(string)
+    if "&" in string or "<" in string or ">" in string:
+        return string.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return string
+
+
+class Indents(dict):
+    """Indentation of each level (two spaces per level), computed once"""
+
+    def __missing__(self, level):
+        self[level] = indent = "  " * level
+        return indent
+
+
+INDENTS = Indents()
+
+
+"""Size of the output buffer"""
+BUFFER_SIZE = 1 << 20
+
+# Element templates (the first argument is the indentation)
+PAPER_START = '{}<bib:{} rdf:about="#{}">\n'.format
+PAPER_END = "{}</bib:{}>\n\n".format
+AUTHORS_START = "{}<bib:authors><rdf:Seq>\n".format
+AUTHORS_END = "{}</rdf:Seq></bib:authors>\n".format
+AUTHOR = (
+    "{0}<rdf:li>\n"
+    "{1}<foaf:Person>\n"
+    "{2}<foaf:surname>{3}</foaf:surname>\n"
+    "{2}<foaf:givenname>{4}</foaf:givenname>\n"
+    "{1}</foaf:Person>\n"
+    "{0}</rdf:li>\n"
+).format
+ITEM_TYPE = "{}<z:itemType>{}</z:itemType>\n".format
+TITLE = "{}<dc:title>{}</dc:title>\n".format
+ABSTRACT = "{}<dcterms:abstract>{}</dcterms:abstract>\n".format
+VOLUME = "{}<prism:volume>{}</prism:volume>\n".format
+NUMBER = "{}<prism:number>{}</prism:number>\n".format
+DOI = "{}<dc:identifier>DOI {}</dc:identifier>\n".format
+PAGES = "{}<bib:pages>{}</bib:pages>\n".format
+LINK = '{}<link:link rdf:resource="#{}"/>\n'.format
+SUBJECT = "{}<dc:subject>{}</dc:subject>".format
+CONTAINER_START = "{}<dcterms:isPartOf>\n".format
+CONTAINER_END = "{}</dcterms:isPartOf>\n".format
+CONTAINER = '{}<dcterms:isPartOf rdf:resource="{}"/>\n'.format
+DATE = "{}<dc:date>{}</dc:date>\n".format
+DATE_SUBMITTED = (
+    "{}<dcterms:dateSubmitted>{:%Y-%m-%d %H:%M:%S}</dcterms:dateSubmitted>\n".format
+)
+NOTE_REFERENCE = '{} <dcterms:isReferencedBy rdf:resource="#{}"/>\n'.format
+MEMO = '{0}<bib:Memo rdf:about="#{2}">{1}{3}{0}</bib:Memo>'.format
+ATTACHMENT_START = '{}<z:Attachment rdf:about="#{}">\n'.format
+ATTACHMENT_END = '{0}<rdf:resource rdf:resource="{2}"/>\n{1}</z:Attachment>\n'.format
+MIMETYPE = "{}<link:type>{}</link:type>\n".format
+COLLECTION_START = '{}<z:Collection rdf:about="#{}">\n'.format
+COLLECTION_END = "{}</z:Collection>\n\n".format
+HAS_PART = '{}<dcterms:hasPart rdf:resource="#{}"/>\n'.format
 
 
 # Bibliographic types
@@ -48,6 +93,27 @@ ZTYPE = {
 RE_FILECHARS = re.compile(r"""[/:\-"']""")
 
 
+"""An attachment whose annotated PDF is written by a worker process"""
+Annotating = namedtuple("Annotating", "future indent indent1 source path")
+
+"""Maximum number of papers waiting for their annotated PDFs"""
+MAX_PENDING = 1000
+
+
+def annotate(source, annotations, path):
+    """Writes an annotated PDF (run inline, or by worker processes)
+
+    :returns: None, or an error message if the PDF could not be annotated (in
+        which case the partial output is removed)
+    """
+    try:
+        managers.embed_annotations(source, annotations, path)
+    except Exception as e:
+        if op.exists(path):
+            os.remove(path)
+        return "%s: %s" % (type(e).__name__, e)
+
+
 class Exporter:
     """The exporter is created by using the static create method. Export
     begins by calling the export method."""
@@ -59,14 +125,46 @@ class Exporter:
         self.annotate = False
         self.path = None
         self.overwrite = False
+        self.jobs = None
 
     def export(self, path, publications, collections):
-        """Outputs papers and collections using Zotero RDF"""
+        """Outputs papers and collections using Zotero RDF
+
+        The RDF of each paper (or collection) is built as a list of strings
+        from the element templates, and written at once to a large buffer.
+
+        With annotations and jobs set, annotated PDFs are written by a pool
+        of processes, and papers are written (in order) once their PDFs are
+        ready. With or without jobs, the PDFs that could not be annotated are
+        reported at the end (their attachments point to the original files).
+        """
         self.path = path
 
+        # Annotated PDFs written by worker processes (see output_file)
+        self.pool = None
+        self.annotating = {}
+        self.pending = deque()
+        self.errors = {}
+
         if self.annotate:
             os.makedirs(path, exist_ok=True)
-        with open(path + ".rdf", "wt") as out:
+            if self.jobs:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        try:
+            self.write_rdf(path, publications, collections)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+                self.pool = None
+
+        if self.errors:
+            logging.error("%d PDF(s) could not be annotated:", len(self.errors))
+            for source, error in self.errors.items():
+                logging.error("  %s: %s", source, error)
+
+    def write_rdf(self, path, publications, collections):
+        """Writes the RDF file (see :py:meth:`export`)"""
+        with open(path + ".rdf", "wt", buffering=BUFFER_SIZE) as out:
             out.write(
                 """<rdf:RDF
          xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
@@ -81,133 +179,140 @@ class Exporter:
             )
 
             for p in publications:
-                self.output_paper(out, p, indent=1)
+                if p.deleted:
+                    # Deletions (incremental reads) cannot be exported
+                    continue
+                lines = []
+                self.output_paper(lines, p, indent=1)
+                if self.pool is None:
+                    out.write("".join(lines))
+                else:
+                    self.pending.append(lines)
+                    self.flush(out)
+            self.flush(out, wait=True)
 
             for c in collections:
-                self.output_collection(c, out, indent=1)
+                lines = []
+                self.output_collection(c, lines, indent=1)
+                out.write("".join(lines))
 
             out.write("""</rdf:RDF>\n""")
 
-    def output_paper(self, f, paper, indent=0):
-        _indent = "  " * indent
+    def flush(self, out, wait=False):
+        """Writes the papers whose annotated PDFs are ready, in order
+
+        :param wait: Wait for all the annotated PDFs (otherwise, only waits
+            if too many papers are pending)
+        """
+        while self.pending:
+            lines = self.pending[0]
+            if not wait and len(self.pending) <= MAX_PENDING:
+                if not all(
+                    line.future.done() for line in lines if isinstance(line, Annotating)
+                ):
+                    return
+            self.pending.popleft()
+            out.write(
+                "".join(
+                    line if isinstance(line, str) else self.annotated(line)
+                    for line in lines
+                )
+            )
+
+    def annotated(self, attachment):
+        """Returns the end of an attachment written by a worker process,
+        pointing to the original file if the PDF could not be annotated"""
+        path = attachment.path
+        try:
+            error = attachment.future.result()
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        if error:
+            self.errors[attachment.source] = error
+            path = attachment.source
+        return ATTACHMENT_END(attachment.indent1, attachment.indent, escape(path))
+
+    def output_paper(self, out, paper, indent=0):
+        """Appends the RDF of a paper (followed by its notes and attachments)
+        to a list of strings"""
+        _indent = INDENTS[indent]
+        _indent1 = INDENTS[indent + 1]
         gtype = BIBTYPE.get(paper.type, "Article")
 
-        appendout = io.StringIO()
+        appendout = []
 
         attachments = []
         for file in paper.files:
             if self.output_file(appendout, file, indent=indent):
                 attachments.append(file.uuid)
 
-        write(f, indent, '<bib:{} rdf:about="#{}">\n', gtype, paper.uuid)
+        out.append(PAPER_START(_indent, gtype, paper.uuid))
 
         if paper.authors:
-            write(f, indent + 1, u"<bib:authors><rdf:Seq>\n")
+            out.append(AUTHORS_START(_indent1))
             for author in paper.authors:
-                write(f, indent + 2, "<rdf:li>\n")
-                self.output_author(author, f, indent + 3)
-                write(f, indent + 2, "</rdf:li>\n")
-            write(f, indent + 1, u"""</rdf:Seq></bib:authors>\n""")
-
-        f.write(u"""%s  <z:itemType>%s</z:itemType>\n""" % (_indent, ZTYPE[paper.type]))
-        write(f, indent + 1, """<dc:title>{}</dc:title>\n""", escape(paper.title))
-
-        if hasattr(paper, "abstract"):
-            write(
-                f,
-                indent + 1,
-                """<dcterms:abstract>{}</dcterms:abstract>\n""",
-                escape(paper.abstract),
-                condition=paper.abstract,
-            )
+                self.output_author(author, out, indent + 2)
+            out.append(AUTHORS_END(_indent1))
+
+        out.append(ITEM_TYPE(_indent1, ZTYPE[paper.type]))
+        out.append(TITLE(_indent1, escape(paper.title)))
+
+        abstract = getattr(paper, "abstract", None)
+        if abstract:
+            out.append(ABSTRACT(_indent1, escape(abstract)))
 
         if paper.volume is not None:
-            write(
-                f,
-                indent + 1,
-                """<prism:volume>{}</prism:volume>\n""",
-                escape(paper.volume),
-            )
-        if paper.volume is not None:
-            write(
-                f,
-                indent + 1,
-                """<prism:number>{}</prism:number>\n""",
-                escape(paper.number),
-            )
+            out.append(VOLUME(_indent1, escape(paper.volume)))
+            out.append(NUMBER(_indent1, escape(paper.number)))
         if paper.doi is not None:
-            write(
-                f,
-                indent + 1,
-                """<dc:identifier>DOI {}</dc:identifier>\n""",
-                escape(paper.doi),
-            )
+            out.append(DOI(_indent1, escape(paper.doi)))
         if paper.pages is not None:
-            write(f, indent + 1, """<bib:pages>{}</bib:pages>\n""", escape(paper.pages))
+            out.append(PAGES(_indent1, escape(paper.pages)))
 
         for attachment in attachments:
-            write(
-                f,
-                indent + 1,
-                """<link:link rdf:resource="#{}"/>\n""",
-                escape(attachment),
-            )
+            out.append(LINK(_indent1, escape(attachment)))
 
         for keyword in paper.keywords:
-            write(f, indent + 1, """<dc:subject>{}</dc:subject>""", escape(keyword))
+            out.append(SUBJECT(_indent1, escape(keyword)))
 
         if paper.read:
-            write(f, indent + 1, """<dc:subject>#read</dc:subject>""")
+            out.append(SUBJECT(_indent1, "#read"))
 
         if paper.container is not None:
             if self.embed_container:
-                write(f, indent + 1, """<dcterms:isPartOf>\n""")
-                self.output_paper(f, paper.container, indent + 2)
-                write(f, indent + 1, """</dcterms:isPartOf>\n""")
+                out.append(CONTAINER_START(_indent1))
+                self.output_paper(out, paper.container, indent + 2)
+                out.append(CONTAINER_END(_indent1))
             else:
-                write(
-                    f,
-                    indent + 1,
-                    """<dcterms:isPartOf rdf:resource="{}"/>\n""",
-                    paper.container.uuid,
-                )
+                out.append(CONTAINER(_indent1, paper.container.uuid))
 
         date = paper.date()
-        write(
-            f, indent + 1, u"""<dc:date>{}</dc:date>\n""", date, condition=len(date) > 0
-        )
+        if date:
+            out.append(DATE(_indent1, date))
 
-        write(
-            f,
-            indent + 1,
-            """<dcterms:dateSubmitted>{:%Y-%m-%d %H:%M:%S}</dcterms:dateSubmitted>\n""",
-            paper.creationdate,
-            condition=paper.creationdate,
-        )
+        if paper.creationdate:
+            out.append(DATE_SUBMITTED(_indent1, paper.creationdate))
         for note in paper.notes:
-            write(
-                f,
-                indent + 1,
-                """ <dcterms:isReferencedBy rdf:resource="#{}"/>\n""",
-                note.uuid,
-            )
+            out.append(NOTE_REFERENCE(_indent1, note.uuid))
 
-        write(f, indent, u"""</bib:{}>\n\n""", gtype)
+        out.append(PAPER_END(_indent, gtype))
 
         for note in paper.notes:
-            write(f, indent, """<bib:Memo rdf:about="#{}">""", note.uuid)
-            write(f, indent + 1, escape(note.html))
-            write(f, indent, """</bib:Memo>""")
-
-        f.write(appendout.getvalue())
-        appendout.close()
-
-    def output_author(self, author, f, indent=0):
-        _indent = "  " * indent
-        write(f, indent, "<foaf:Person>\n")
-        write(f, indent + 1, "<foaf:surname>{}</foaf:surname>\n", author.surname)
-        write(f, indent + 1, "<foaf:givenname>{}</foaf:givenname>\n", author.firstname)
-        write(f, indent, "</foaf:Person>\n")
+            out.append(MEMO(_indent, _indent1, note.uuid, escape(note.html) or ""))
+
+        out.extend(appendout)
+
+    def output_author(self, author, out, indent=0):
+        """Appends the RDF of an author (as a list item)"""
+        out.append(
+            AUTHOR(
+                INDENTS[indent],
+                INDENTS[indent + 1],
+                INDENTS[indent + 2],
+                author.surname,
+                author.firstname,
+            )
+        )
 
     def output_file(self, out, f, indent=0):
         """Output a file"""
@@ -215,23 +320,15 @@ class Exporter:
         if not f.exists():
             return False
 
-        write(out, indent, """<z:Attachment rdf:about="#{}">\n""", f.uuid)
-        write(out, indent + 1, """<z:itemType>attachment</z:itemType>\n""")
-        # write(out, indent+1, """<dc:subject>{}</dc:subject>\n""", subject)
-        write(
-            out,
-            indent + 1,
-            """<dc:title>{}</dc:title>\n""",
-            escape(f.title),
-            condition=f.title,
-        )
-        write(
-            out,
-            indent + 1,
-            """<link:type>{}</link:type>\n""",
-            f.mimetype,
-            condition=f.mimetype,
-        )
+        _indent = INDENTS[indent]
+        _indent1 = INDENTS[indent + 1]
+        out.append(ATTACHMENT_START(_indent, f.uuid))
+        out.append(ITEM_TYPE(_indent1, "attachment"))
+        # out.append(SUBJECT(_indent1, subject))
+        if f.title:
+            out.append(TITLE(_indent1, escape(f.title)))
+        if f.mimetype:
+            out.append(MIMETYPE(_indent1, f.mimetype))
 
         # By default, path is original file path
         path = f.path
@@ -240,43 +337,47 @@ class Exporter:
         if self.annotate and f.has_externalannotations():
             uuidpath = RE_FILECHARS.sub("_", f.uuid)
             path = op.join(self.path, uuidpath + "-" + op.basename(f.path))
-            try:
+            if self.pool is not None:
+                # The attachment is completed once the PDF is written
+                future = self.annotating.get(path)
+                if future is None:
+                    if op.exists(path) and os.stat(path).st_size > 0:
+                        future = concurrent.futures.Future()
+                        future.set_result(None)
+                    else:
+                        future = self.pool.submit(
+                            annotate, f.path, list(f.annotations), path
+                        )
+                    self.annotating[path] = future
+                out.append(Annotating(future, _indent, _indent1, f.path, path))
+                return True
+
+            # Write annotations (errors are handled as with worker processes)
+            if (not op.exists(path)) or (os.stat(path).st_size == 0):
                 logging.debug("Writing annotated PDF [%s] from [%s]", path, f.path)
-                # Write annotations
-                if (not op.exists(path)) or (os.stat(path).st_size == 0):
-                    f.embed_annotations(path)
-            except Exception as e:
-                # Something went wrong
-
-                # First remove the file
-                if op.exists(path):
-                    os.remove(path)
-
-                # Handle gracefully for some errors
-                if isinstance(e, PyPDF2.utils.PdfReadError) or isinstance(e, IOError):
-                    logging.error("Error while annotating (%s): %s", type(e), e)
+                error = annotate(f.path, list(f.annotations), path)
+                if error:
+                    self.errors[f.path] = error
                     path = f.path
-                else:
-                    raise
-
-        write(out, indent + 1, """<rdf:resource rdf:resource="{}"/>\n""", escape(path))
 
-        write(out, indent, """</z:Attachment>\n""")
+        out.append(ATTACHMENT_END(_indent1, _indent, escape(path)))
 
         return True
 
-    def output_collection(self, collection, f, indent=0):
-        _indent = "  " * indent
-        write(f, indent, """<z:Collection rdf:about="#{}">\n""", collection.uuid)
-        write(f, indent + 1, """<dc:title>{}</dc:title>\n""", escape(collection.name))
+    def output_collection(self, collection, out, indent=0):
+        """Appends the RDF of a collection to a list of strings"""
+        _indent = INDENTS[indent]
+        _indent1 = INDENTS[indent + 1]
+        out.append(COLLECTION_START(_indent, collection.uuid))
+        out.append(TITLE(_indent1, escape(collection.name)))
 
         for c in collection.children:
-            write(f, indent + 1, """<dcterms:hasPart rdf:resource="#{}"/>\n""", c.uuid)
+            out.append(HAS_PART(_indent1, c.uuid))
 
         for p in collection.publications:
-            write(f, indent + 1, """<dcterms:hasPart rdf:resource="#{}"/>\n""", p.uuid)
+            out.append(HAS_PART(_indent1, p.uuid))
 
-        write(f, indent, "</z:Collection>\n\n")
+        out.append(COLLECTION_END(_indent))
 
     @staticmethod
     def create(prefix, args):
@@ -301,6 +402,13 @@ class Exporter:
             action="store_true",
             help="Overwrite files with embedded annotations if they exist",
         )
+        add_argument(
+            "jobs",
+            type=int,
+            default=None,
+            help="Number of processes writing the annotated PDFs "
+            "(by default, they are written one at a time during the export)",
+        )
 
         args, remaining_args = parser.parse_known_args(args, namespace=self)
         return self, remaining_args
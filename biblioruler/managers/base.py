@@ -5,7 +5,6 @@
 import logging
 import os.path as op
 import os
-from bs4 import BeautifulSoup
 
 """All the types that can be taken by a paper"""
 types = set(
@@ -118,6 +117,8 @@ class Note(Object):
     @property
     def text(self):
         if self._text is None and self._html:
+            from bs4 import BeautifulSoup
+
             self._text = BeautifulSoup(self._html).get_text()
         return self._text
 
@@ -129,6 +130,7 @@ class Paper(Object):
     - authors : a list of authors
     - files : the attached files
     - keywords : the set of keywords
+    - deleted : True if the paper was deleted (incremental reads)
     """
 
     def __init__(self, uuid, surrogate=True):
@@ -148,6 +150,7 @@ class Paper(Object):
         self.year = None
 
         self.read = False
+        self.deleted = False
         self.uri = None
         self.doi = None
         self.volume = None
@@ -192,7 +195,7 @@ class File(Object):
         self.title = None
         self.mimetype = None
         self.path = None
-        self._annotations = []
+        self._annotations = None
 
     def has_externalannotations(self):
         """Returns False if the file has embedded annotations or has no annotations, True otherwise"""
@@ -206,33 +209,51 @@ class File(Object):
 
     @property
     def annotations(self):
-        """Returns the annotations of the file"""
-        annotations = self.retrieve_annotations()
-        return annotations
+        """Returns the annotations of the file (retrieved on first access)"""
+        if self._annotations is None:
+            self._annotations = self.retrieve_annotations()
+        return self._annotations
+
+    def retrieve_annotations(self):
+        """Retrieves the annotations of the file"""
+        return []
 
     def embed_annotations(self, path):
-        import PyPDF2
+        embed_annotations(self.path, self.annotations, path)
+
+
+def embed_annotations(source, annotations, path):
+    """Writes a copy of a PDF with annotations
 
-        inpdf = PyPDF2.PdfFileReader(self.path, "rb")
-        if inpdf.isEncrypted:
-            # PyPDF2 seems to think some files are encrypted even
-            # if they are not. We just ignore the encryption.
-            # This seems to work for the one file where I saw this issue
-            inpdf._override_encryption = True
-            inpdf._flatten()
+    Annotations can be pickled (without their file), so this can run in
+    another process.
 
-        outpdf = PyPDF2.PdfFileWriter()
-        pages = []
-        for i in range(inpdf.getNumPages()):
-            pages.append(inpdf.getPage(i))
+    :param source: The path of the PDF
+    :param annotations: The annotations
+    :param path: The path of the annotated copy
+    """
+    import PyPDF2
+
+    inpdf = PyPDF2.PdfFileReader(source, "rb")
+    if inpdf.isEncrypted:
+        # PyPDF2 seems to think some files are encrypted even
+        # if they are not. We just ignore the encryption.
+        # This seems to work for the one file where I saw this issue
+        inpdf._override_encryption = True
+        inpdf._flatten()
 
-        for annotation in self.annotations:
-            annotation.annotate(outpdf, pages)
-        for page in pages:
-            outpdf.addPage(page)
+    outpdf = PyPDF2.PdfFileWriter()
+    pages = []
+    for i in range(inpdf.getNumPages()):
+        pages.append(inpdf.getPage(i))
 
-        with open(path, "wb") as file:
-            outpdf.write(file)
+    for annotation in annotations:
+        annotation.annotate(outpdf, pages)
+    for page in pages:
+        outpdf.addPage(page)
+
+    with open(path, "wb") as file:
+        outpdf.write(file)
 
 
 class Annotation(Object):
@@ -245,6 +266,12 @@ class Annotation(Object):
         self.date = date
         self.page = page
 
+    def __getstate__(self):
+        # The file (and its manager) is not needed to annotate a PDF
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
 
 class HighlightAnnotation(Annotation):
     def __init__(
@@ -605,7 +605,9 @@ class Item(Base):
     library = relationship(
         "Library", primaryjoin="Item.libraryID == Library.libraryID", backref="items"
     )
-    # fulltextWords = relationship('FulltextWord', secondary='YARK.fulltextItemWords', backref='items')
+    fulltextWords = relationship(
+        "FulltextWord", secondary=t_fulltextItemWords, backref="items"
+    )
 
 
 class DeletedItem(Item):
@@ -657,6 +659,26 @@ class GroupItem(Item):
     )
 
 
+class ItemAnnotation(Base):
+    __tablename__ = "itemAnnotations"
+
+    itemID = Column(ForeignKey("items.itemID", ondelete="CASCADE"), primary_key=True)
+    parentItemID = Column(
+        ForeignKey("itemAttachments.itemID"), nullable=False, index=True
+    )
+    type = Column(Integer, nullable=False)
+    authorName = Column(Text)
+    text = Column(Text)
+    comment = Column(Text)
+    color = Column(Text)
+    pageLabel = Column(Text)
+    sortIndex = Column(Text, nullable=False)
+    position = Column(Text, nullable=False)
+    isExternal = Column(Integer, nullable=False)
+
+    attachment = relationship("ItemAttachment", backref="annotations")
+
+
 class ItemAttachment(Base):
     __tablename__ = "itemAttachments"
 
@@ -1,12 +1,13 @@
 # Mendeley SQL backend
 
+import biblioruler.config as config
 import biblioruler.managers.base as managers
 from dateutil import parser as dtparser
 from urllib.parse import unquote
 from urllib.parse import urlparse
 
 from .base import Resource, Note, HighlightAnnotation, NoteAnnotation
-from biblioruler.sqlite3utils import dict_factory
+from biblioruler.sqlite3utils import dict_factory, backup, snapshot
 import argparse
 import sqlite3
 import os
@@ -14,35 +15,43 @@ import os.path as op
 import logging
 import platform
 import datetime as dt
+import weakref
 
 DEFAULTS = None
 
 
 def defaults():
-    """Get defaults"""
+    """Get defaults (read on first call, and cached in the configuration directory)"""
     global DEFAULTS
-    if DEFAULTS is not None:
-        return DEFAULTS
+    if DEFAULTS is None:
+        DEFAULTS = config.cached("mendeley", read_defaults)
+        logging.info("Mendeley database path: %s", DEFAULTS["dbpath"])
+    return DEFAULTS
+
 
-    DEFAULTS = {"dbpath": None, "filebase": None}
+def read_defaults():
+    """Read defaults from the Mendeley Desktop preferences
+
+    :returns: the defaults and the list of files they were read from
+    """
+    defaults = {"dbpath": None, "filebase": None}
+    sources = []
 
     if platform.system() == "Darwin":
         import plistlib
 
-        with open(
-            os.path.expanduser(
-                "~/Library/Preferences/com.mendeley.Mendeley Desktop.plist"
-            ),
-            "rb",
-        ) as fh:
+        plistpath = os.path.expanduser(
+            "~/Library/Preferences/com.mendeley.Mendeley Desktop.plist"
+        )
+        sources.append(plistpath)
+        with open(plistpath, "rb") as fh:
             plist = plistlib.load(fh)
-            DEFAULTS["dbpath"] = op.join(
+            defaults["dbpath"] = op.join(
                 op.expanduser("~/Library/Application Support/Mendeley Desktop/"),
                 plist["MendeleyWeb.userEmail"] + "@www.mendeley.com.sqlite",
             )
-            logging.info("Mendeley database path: " + DEFAULTS["dbpath"])
 
-    return DEFAULTS
+    return defaults, sources
 
 
 @Resource(urn="mendeley:paper")
@@ -61,9 +70,15 @@ class Paper(managers.Paper):
                 d.read, d.favourite, d.abstract, d.institution
                 FROM Documents d"""
 
-    AUTHORS_QUERY = """SELECT contribution, firstNames, lastName FROM DocumentContributors WHERE documentId=%d ORDER BY id"""
-    TAG_QUERY = """SELECT tag FROM DocumentTags WHERE documentId=%d"""
-    FILE_QUERY = """SELECT df.hash, f.localUrl FROM DocumentFiles df, Files f WHERE df.hash=f.hash AND documentId=%d"""
+    """Queries for the data attached to documents
+
+    The %s placeholder is replaced by a restriction on documentId, which is
+    either a single document or all the documents of the personal group (bulk
+    loading)
+    """
+    AUTHORS_QUERY = """SELECT documentId, contribution, firstNames, lastName FROM DocumentContributors WHERE %s ORDER BY documentId, id"""
+    TAG_QUERY = """SELECT documentId, tag FROM DocumentTags WHERE %s"""
+    FILE_QUERY = """SELECT df.documentId, df.hash, f.localUrl FROM DocumentFiles df, Files f WHERE df.hash=f.hash AND %s"""
 
     TYPES = {
         "Book": "book",
@@ -85,8 +100,14 @@ class Paper(managers.Paper):
         managers.Paper.__init__(self, uuid)
         self.manager = manager
 
-    def populate(self, row):
-        """Populate from DB"""
+    def populate(self, row, related=None):
+        """Populate from DB
+
+        :param row: the row of the document (see BASE_QUERY)
+        :param related: the authors, tags and files grouped by document ID (as
+            returned by :py:meth:`Manager.related`); if None, they are
+            retrieved for this paper only
+        """
         self.init()
 
         for key, value in row.items():
@@ -113,53 +134,43 @@ class Paper(managers.Paper):
         if row["__added"] is not None:
             self.creationdate = dt.datetime.fromtimestamp(row["__added"] / 1000)
 
-        c = self.manager.dbconn.cursor()
-        try:
-            c.execute(Paper.AUTHORS_QUERY % self.id)
-            for ix, row in enumerate(c):
-                self.authors.append(
-                    Author(
-                        firstname=row["firstNames"],
-                        surname=row["lastName"],
-                        uuid="paper:%d:author:%d" % (self.id, ix),
-                        surrogate=False,
-                    )
-                )
-        finally:
-            c.close()
+        if related is None:
+            related = self.manager.related(self.id)
 
-        c = self.manager.dbconn.cursor()
-        try:
-            c.execute(Paper.TAG_QUERY % self.id)
-            for ix, row in enumerate(c):
-                self.keywords.add(row["tag"])
-        finally:
-            c.close()
+        for ix, row in enumerate(related["authors"].get(self.id, ())):
+            self.authors.append(
+                Author(
+                    firstname=row["firstNames"],
+                    surname=row["lastName"],
+                    uuid="paper:%d:author:%d" % (self.id, ix),
+                    surrogate=False,
+                )
+            )
 
         # Get tags
-        c = self.manager.dbconn.cursor()
-        try:
-            c.execute(Paper.TAG_QUERY % self.id)
-            for ix, row in enumerate(c):
-                self.keywords.add(row["tag"])
-        finally:
-            c.close()
+        for row in related["tags"].get(self.id, ()):
+            self.keywords.add(row["tag"])
 
         # Get files
+        for row in related["files"].get(self.id, ()):
+            self.files.append(File(self.manager, row["hash"], row["localUrl"]))
+
+        self.surrogate = False
+
+    def _retrieve(self):
         c = self.manager.dbconn.cursor()
         try:
-            c.execute(Paper.FILE_QUERY % self.id)
-            for ix, row in enumerate(c):
-                self.files.append(File(self.manager, row["hash"], row["localUrl"]))
+            c.execute(
+                Paper.BASE_QUERY + " WHERE d.uuid=:uuid", {"uuid": self.local_uuid}
+            )
+            self.populate(c.fetchone())
         finally:
             c.close()
 
-        self.surrogate = False
-
     @staticmethod
-    def createFromDB(manager, row):
-        paper = Paper(manager, "%s" % row["__uuid"])
-        paper.populate(row)
+    def createFromDB(manager, row, related=None):
+        paper = manager.paper("%s" % row["__uuid"])
+        paper.populate(row, related)
         return paper
 
 
@@ -178,30 +189,41 @@ class File(managers.File):
         self.manager = manager
         self.path = converturl2abspath(localUrl)
 
-    def retrieve_annotations(self):
-
-        query = """SELECT fhr.id, fhr.page, fhr.highlightId,
+    """Annotation queries (all the files at once)"""
+    HIGHLIGHTS_QUERY = """SELECT fh.fileHash, fhr.id, fhr.page, fhr.highlightId,
                                 fhr.x1, fhr.y1,
                                 fhr.x2, fhr.y2,
                                 fh.createdTime,
                                 color
                         FROM FileHighlights fh
-                        LEFT JOIN FileHighlightRects fhr
+                        JOIN FileHighlightRects fhr
                             ON fhr.highlightId=fh.id
-                        WHERE (fhr.page IS NOT NULL) AND fh.fileHash=:hash
-                        ORDER BY fhr.highlightId"""
+                        WHERE fhr.page IS NOT NULL
+                        ORDER BY fh.fileHash, fhr.highlightId"""
+
+    NOTES_QUERY = """
+            SELECT fileHash, id, color, FileNotes.page,
+                FileNotes.x, FileNotes.y,
+                FileNotes.author, FileNotes.note,
+                FileNotes.modifiedTime
+            FROM FileNotes
+            WHERE FileNotes.page IS NOT NULL"""
+
+    def retrieve_annotations(self):
+        """Builds the annotations from the manager annotation index"""
+        index = self.manager.annotation_index
+        highlights, notes = index.get(self.local_uuid, ((), ()))
         annotations = []
 
         annotation = None
-        highlightId = None
+        annotationId = None
 
-        ret = self.manager.dbconn.execute(query, {"hash": self.local_uuid})
-        for r in ret:
+        for r in highlights:
             page = r["page"] - 1
             bbox = [r["x1"], r["y1"], r["x2"], r["y2"]]
-            cdate = dtparser.parse(r["createdTime"])
-            uuid = "%s:note:%s" % (self.uuid, r["id"])
             if annotation is None or annotationId != r["highlightId"]:
+                cdate = dtparser.parse(r["createdTime"])
+                uuid = "%s:note:%s" % (self.uuid, r["id"])
                 annotation = HighlightAnnotation(
                     uuid, self, page, r["color"], date=cdate
                 )
@@ -210,24 +232,17 @@ class File(managers.File):
 
             annotation.addBBox(bbox)
 
-        query = """
-            SELECT id, color, FileNotes.page,
-                FileNotes.x, FileNotes.y,
-                FileNotes.author, FileNotes.note,
-                FileNotes.modifiedTime
-            FROM FileNotes
-            WHERE FileNotes.page IS NOT NULL AND fileHash=:hash"""
-        ret = self.manager.dbconn.execute(query, {"hash": self.local_uuid})
-
-        for r in ret:
+        for r in notes:
             page = r["page"] - 1
             bbox = [r["x"], r["y"], r["x"] + 30, r["y"] + 30]
             author = r["author"]
             txt = r["note"]
             cdate = dtparser.parse(r["modifiedTime"])
             uuid = "%s:note:%s" % (self.uuid, r["id"])
-            NoteAnnotation(
-                uuid, self, page, bbox, r["color"], txt, date=cdate, author=author
+            annotations.append(
+                NoteAnnotation(
+                    uuid, self, page, bbox, r["color"], txt, date=cdate, author=author
+                )
             )
 
         return annotations
@@ -257,37 +272,61 @@ class Collection(managers.Collection):
     def __init__(self, manager, uuid, name):
         managers.Collection.__init__(self, uuid, name)
         self.manager = manager
+        self.children = []
+        self.publications = []
 
-    def populate(self, row):
+    def populate(self, row, members):
+        """Populate from DB
+
+        :param row: the row of the folder (see BASE_QUERY)
+        :param members: the document UUIDs of each folder (folderId -> list)
+        """
         self.parentId = row["parentId"]
         self.id = row["id"]
 
-        c = self.manager.dbconn.cursor()
-        try:
-            c.execute(Collection.DOCUMENT_QUERY + " AND folderId=%d" % self.id)
-            for row in c:
-                self.publications.append(Paper(self.manager, "%s" % row["uuid"]))
-        finally:
-            c.close()
+        for uuid in members.get(self.id, ()):
+            self.publications.append(self.manager.paper(uuid))
 
         if self.parentId < 0:
             self.parentId = None
 
     @staticmethod
-    def createFromDB(manager, row):
+    def createFromDB(manager, row, members):
         collection = Collection(manager, "folder:%s" % row["id"], row["name"])
-        collection.populate(row)
+        collection.populate(row, members)
         return collection
 
 
 class Manager(managers.Manager):
     """Mendeley manager"""
 
-    def __init__(self, dbpath=defaults()["dbpath"], filebase=defaults()["filebase"]):
-        """Initialize the manager"""
+    def __init__(self, dbpath=None, filebase=None, snapshot=None):
+        """Initialize the manager
+
+        :param dbpath: The path of the Mendeley database (defaults to the one
+            of the current Mendeley Desktop user)
+        :param snapshot: If None, the Mendeley database is read directly.
+            Otherwise, it is copied with the sqlite backup API and only the copy
+            is read, so that Mendeley Desktop can run concurrently: ":memory:"
+            copies into memory, and any other value is the path of a snapshot
+            file that is reused while the database is unchanged.
+        """
         managers.Manager.__init__(self, None, surrogate=False)
+        # The Mendeley preferences are only read when the database is not given
+        if dbpath is None:
+            dbpath = defaults()["dbpath"]
+            if filebase is None:
+                filebase = defaults()["filebase"]
         self.dbpath = dbpath
-        self.dbconn = sqlite3.connect(dbpath)
+        self.snapshot = snapshot
+        self.dbconn = None
+        if snapshot is None:
+            self.dbconn = sqlite3.connect(dbpath)
+        elif snapshot == ":memory:":
+            self.dbconn = sqlite3.connect(snapshot)
+            backup(dbpath, self.dbconn)
+        else:
+            self.refresh()
         self.filebase = filebase
 
         ## Checks to see if this is a valid db connection
@@ -297,8 +336,76 @@ class Manager(managers.Manager):
         except sqlite3.OperationalError:
             raise ValueError("Invalid Papers3 database")
         self.dbconn.row_factory = dict_factory
+        self._annotation_index = None
+
+        # Identity map (UUID -> paper) shared by publications and collections;
+        # papers are only kept while they are referenced
+        self.papers = weakref.WeakValueDictionary()
+
+    def refresh(self):
+        """Updates the snapshot file if the Mendeley database has changed
+
+        When the snapshot is rebuilt, the connection is reopened on the new
+        copy (and the annotation index is dropped). Nothing is done when the
+        database is read directly or copied into memory.
+
+        :returns: True if the snapshot was rebuilt
+        """
+        if self.snapshot is None or self.snapshot == ":memory:":
+            return False
+
+        rebuilt = snapshot(self.dbpath, self.snapshot)
+        if rebuilt or self.dbconn is None:
+            if self.dbconn is not None:
+                self.dbconn.close()
+            self.dbconn = sqlite3.connect(self.snapshot)
+            self.dbconn.row_factory = dict_factory
+            self._annotation_index = None
+        return rebuilt
+
+    def paper(self, uuid):
+        """Returns the paper with the given UUID, creating a surrogate if needed"""
+        paper = self.papers.get(uuid)
+        if paper is None:
+            paper = self.papers[uuid] = Paper(self, uuid)
+        return paper
+
+    @property
+    def annotation_index(self):
+        """Highlight and note rows of all the files, indexed by file hash
+
+        The index is built on first access with one query for highlights and
+        one for notes, and maps a file hash to a (highlights, notes) pair.
+        """
+        if self._annotation_index is None:
+            index = {}
+            for position, query in enumerate((File.HIGHLIGHTS_QUERY, File.NOTES_QUERY)):
+                c = self.dbconn.cursor()
+                try:
+                    c.execute(query)
+                    for row in c:
+                        if row["fileHash"] not in index:
+                            index[row["fileHash"]] = ([], [])
+                        index[row["fileHash"]][position].append(row)
+                finally:
+                    c.close()
+            self._annotation_index = index
+        return self._annotation_index
+
+    def members(self):
+        """Returns the document UUIDs of all the folders (folderId -> list)"""
+        members = {}
+        c = self.dbconn.cursor()
+        try:
+            c.execute(Collection.DOCUMENT_QUERY)
+            for row in c:
+                members.setdefault(row["folderId"], []).append(row["uuid"])
+        finally:
+            c.close()
+        return members
 
     def collections(self):
+        members = self.members()
         c = self.dbconn.cursor()
         try:
             collections = {}
@@ -307,7 +414,7 @@ class Manager(managers.Manager):
                 WHERE g.groupType == 'PersonalGroupType' AND rf.folderId = f.id and rf.groupId=g.id"""
             c.execute(query)
             for row in c:
-                collection = Collection.createFromDB(self, row)
+                collection = Collection.createFromDB(self, row, members)
                 collections[collection.id] = collection
 
             for collection in collections.values():
@@ -317,7 +424,52 @@ class Manager(managers.Manager):
         finally:
             c.close()
 
-    def publications(self):
+    """Restricts to the documents of the personal group"""
+    PERSONAL_DOCUMENTS = """documentId IN (SELECT rd.documentId FROM Groups g, RemoteDocuments rd
+                WHERE g.groupType == 'PersonalGroupType' AND rd.groupId=g.id)"""
+
+    def related(self, documentId=None):
+        """Retrieves the authors, tags and files of documents
+
+        Each query is run once and its rows are grouped by document ID, so
+        that loading the whole library takes a fixed number of queries.
+
+        :param documentId: The document ID, or None to retrieve the data of
+            all the documents of the personal group
+        :returns: a dictionary with keys authors, tags and files, each mapping
+            a document ID to the list of its rows
+        """
+        if documentId is None:
+            restriction, parameters = Manager.PERSONAL_DOCUMENTS, {}
+        else:
+            restriction, parameters = "documentId=:id", {"id": documentId}
+
+        related = {}
+        for key, query in (
+            ("authors", Paper.AUTHORS_QUERY),
+            ("tags", Paper.TAG_QUERY),
+            ("files", Paper.FILE_QUERY),
+        ):
+            grouped = related[key] = {}
+            c = self.dbconn.cursor()
+            try:
+                c.execute(query % restriction, parameters)
+                for row in c:
+                    grouped.setdefault(row["documentId"], []).append(row)
+            finally:
+                c.close()
+
+        return related
+
+    def publications(self, bulk=True):
+        """Returns all the publications of the personal group
+
+        :param bulk: If True, authors, tags and files are retrieved for all
+            the documents at once (see :py:meth:`related`) rather than with
+            three queries per document
+        """
+        related = self.related() if bulk else None
+
         c = self.dbconn.cursor()
         try:
             query = (
@@ -327,7 +479,7 @@ class Manager(managers.Manager):
             )
             c.execute(query)
             for row in c:
-                yield Paper.createFromDB(self, row)
+                yield Paper.createFromDB(self, row, related)
         finally:
             c.close()
 
@@ -338,9 +490,17 @@ class Manager(managers.Manager):
         parser.add_argument(
             "--%sdbpath" % prefix,
             dest="dbpath",
-            default=DEFAULTS["dbpath"],
-            help="The path to the Papers3 sqlite database, "
-            "defaults to [%s]." % DEFAULTS["dbpath"],
+            default=None,
+            help="The path to the Mendeley sqlite database, "
+            "defaults to the one of the current Mendeley Desktop user",
+        )
+        parser.add_argument(
+            "--%ssnapshot" % prefix,
+            dest="snapshot",
+            default=None,
+            help="Read from a copy of the database rather than from the live one: "
+            "either :memory: or the path of a snapshot file (reused while the "
+            "database is unchanged)",
         )
         parser.add_argument(
             "--%shelp" % prefix,
@@ -348,4 +508,4 @@ class Manager(managers.Manager):
             help="Provides helps about arguments for this manager",
         )
         args, remaining_args = parser.parse_known_args(args)
-        return Manager(args.dbpath), remaining_args
+        return Manager(args.dbpath, snapshot=args.snapshot), remaining_args
@@ -11,42 +11,59 @@ import json
 import datetime
 import logging
 import platform
+import plistlib
+import itertools
+import weakref
+from array import array
+from operator import itemgetter
 
+import biblioruler.config as config
 import biblioruler.managers.base as managers
-from biblioruler.sqlite3utils import dict_factory
+from biblioruler.sqlite3utils import dict_factory, merge_join
 
-
-ANNOTATION_QUERY = """SELECT uuid, contents, type, text, created_at, left, height, rectangles FROM Annotation WHERE object_id = "{}" """
-PDF_QUERY = """SELECT uuid as local_uuid, is_primary, mime_type as mimetype, path, md5 FROM PDF WHERE object_id = "{}" """
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 DEFAULTS = None
 
 
 def defaults():
+    """Get defaults (read on first call, and cached in the configuration directory)"""
     global DEFAULTS
-    if DEFAULTS is not None:
-        return DEFAULTS
+    if DEFAULTS is None:
+        DEFAULTS = config.cached("papers3", read_defaults)
+        logging.info("Papers3 database path: %s", DEFAULTS["dbpath"])
+    return DEFAULTS
+
 
-    DEFAULTS = {"dbpath": None}
+def read_defaults():
+    """Read defaults from the Papers3 preferences
+
+    :returns: the defaults and the list of files they were read from
+    """
+    defaults = {"dbpath": None, "filebase": None}
+    sources = []
 
     if platform.system() == "Darwin":
         import plistlib
 
-        with open(
-            os.path.expanduser("~/Library/Preferences/com.mekentosj.papers3.plist"),
-            "rb",
-        ) as fh:
+        plistpath = os.path.expanduser(
+            "~/Library/Preferences/com.mekentosj.papers3.plist"
+        )
+        sources.append(plistpath)
+        with open(plistpath, "rb") as fh:
             plist = plistlib.load(fh)
-            DEFAULTS["dbpath"] = (
+            defaults["dbpath"] = (
                 os.path.expanduser("~/Library/Application Support/")
                 + plist["mt_papers3_library_location_local"]
                 + "/Library.papers3/Database.papersdb"
             )
-            DEFAULTS["filebase"] = plist["mt_papers3_full_library_location_shared"]
-            logging.info("Papers3 database path: " + DEFAULTS["dbpath"])
+            defaults["filebase"] = plist["mt_papers3_full_library_location_shared"]
 
-    return DEFAULTS
+    return defaults, sources
 
 
 _xlate_month = {
@@ -83,12 +100,119 @@ def parse_date(pub_date, translate_month=True, month=(6, 7), year=(2, 5)):
     return {"month": cmonth, "year": cyear}
 
 
-# Interface to papers
+"""Size of a rectangle in annotation blobs (four doubles)"""
+RECTANGLE_SIZE = 32
+
 
+def decode_rectangles(blobs):
+    """Decodes annotation rectangle blobs into page-space bounding boxes
 
-class Annotation(managers.Annotation):
-    def __init__(self, file, uuid):
-        super().__init__(file, uuid)
+    A blob is a packed array of little-endian doubles, four per rectangle
+    (x, y, width, height). All the blobs are decoded at once (with NumPy if
+    it is installed), and each one is mapped to a list of [x0, y0, x1, y1]
+    boxes (lower left and upper right corners).
+
+    :param blobs: A list of blobs (or None)
+    :returns: A list with the list of boxes of each blob
+    """
+    counts = [len(blob) // RECTANGLE_SIZE if blob else 0 for blob in blobs]
+    data = b"".join(
+        blob[: count * RECTANGLE_SIZE] for blob, count in zip(blobs, counts) if count
+    )
+
+    if numpy is not None:
+        rectangles = numpy.frombuffer(data, dtype="<f8").reshape(-1, 4)
+        boxes = numpy.hstack(
+            (rectangles[:, :2], rectangles[:, :2] + rectangles[:, 2:])
+        ).tolist()
+    else:
+        values = array("d", data)
+        if sys.byteorder == "big":
+            values.byteswap()
+        boxes = [
+            [x, y, x + width, y + height]
+            for x, y, width, height in zip(*[iter(values)] * 4)
+        ]
+
+    offsets = itertools.accumulate(counts, initial=0)
+    return [boxes[offset : offset + count] for offset, count in zip(offsets, counts)]
+
+
+"""Tokens of predicate format strings"""
+RE_PREDICATE_TOKEN = re.compile(
+    r"""\s*(?:(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')"""
+    r"|(?P<number>-?\d+(?:\.\d+)?)"
+    r"|(?P<symbol>==|!=|<>|<=|>=|=|<|>|&&|\|\||!|\(|\))"
+    r"|(?P<word>[A-Za-z_][\w.]*(?:\[[a-zA-Z]*\])?))"
+)
+
+
+"""Reserved words of predicate format strings"""
+PREDICATE_WORDS = {
+    "AND",
+    "OR",
+    "NOT",
+    "ANY",
+    "CONTAINS",
+    "BEGINSWITH",
+    "ENDSWITH",
+    "LIKE",
+    "TRUEPREDICATE",
+    "FALSEPREDICATE",
+}
+
+
+def tokenize_predicate(predicate):
+    """Splits a predicate format string into (kind, token) pairs
+
+    Strings are unquoted, numbers converted, and reserved words uppercased.
+    """
+    tokens = []
+    position = 0
+    predicate = predicate.rstrip()
+    while position < len(predicate):
+        m = RE_PREDICATE_TOKEN.match(predicate, position)
+        if m is None:
+            raise ValueError("Cannot parse predicate at %s" % predicate[position:])
+        position = m.end()
+        kind = m.lastgroup
+        token = m.group(kind)
+        if kind == "string":
+            token = re.sub(r"\\(.)", r"\1", token[1:-1])
+        elif kind == "number":
+            token = float(token) if "." in token else int(token)
+        elif kind == "word" and token.split("[")[0].upper() in PREDICATE_WORDS:
+            token = token.upper()
+            kind = "symbol"
+        tokens.append((kind, token))
+    return tokens
+
+
+def predicate_format(configuration):
+    """Returns the predicate of a smart collection configuration (or None)
+
+    The configuration is a property list, searched for a string stored under
+    a key containing "predicate".
+    """
+    if not configuration:
+        return None
+    try:
+        values = [plistlib.loads(configuration)]
+    except (plistlib.InvalidFileException, ValueError):
+        return None
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if isinstance(item, str) and "predicate" in str(key).lower():
+                    return item
+                values.append(item)
+        elif isinstance(value, list):
+            values.extend(value)
+    return None
+
+
+# Interface to papers
 
 
 class File(managers.File):
@@ -96,15 +220,16 @@ class File(managers.File):
         super().__init__(uuid)
         self.paper = paper
 
-    def populate(self, cursor, row):
+    def populate(self, row):
         """
-        :param cursor: the db cursor
         :param row: an associative array containing everything
         """
-        self.setdbvalues(cursor, row)
+        self.is_primary = row["is_primary"]
+        self.mimetype = row["mimetype"]
+        self.md5 = row["md5"]
         self.path = (
-            op.join(self.paper.papers3.filebase, self.path)
-            if self.path is not None
+            op.join(self.paper.papers3.filebase, row["path"])
+            if row["path"] is not None
             else None
         )
         self.surrogate = False
@@ -113,15 +238,48 @@ class File(managers.File):
             self.mimetype = "application/html"
         return self
 
-    def annotations(self):
-        c = self.papers3.dbconn.cursor()
-        try:
-            c2.execute(ANNOTATION_QUERY.format(row["uuid"]))
-            for row2 in c2:
-                yield Annotation(row2)
-        finally:
-            c.close()
-            c2.close()
+    def retrieve_annotations(self):
+        """Builds the annotations from the manager annotation index
+
+        Annotations with rectangles are highlights, and their comments (if
+        any) are notes placed at the first rectangle (or at the annotation
+        position)
+        """
+        annotations = []
+        for row, boxes in self.paper.papers3.annotation_index.get(self.local_uuid, ()):
+            # Page numbers start at 1
+            page = (row["page_nr"] or 1) - 1
+            date = (
+                datetime.datetime.fromtimestamp(
+                    row["created_at"], datetime.timezone.utc
+                )
+                if row["created_at"] is not None
+                else None
+            )
+
+            if boxes:
+                annotation = managers.HighlightAnnotation(
+                    row["uuid"], self, page, row["color"], date=date, surrogate=False
+                )
+                for bbox in boxes:
+                    annotation.addBBox(bbox)
+                annotations.append(annotation)
+
+            if row["contents"]:
+                x, y = boxes[0][:2] if boxes else (row["left"] or 0, row["top"] or 0)
+                annotations.append(
+                    managers.NoteAnnotation(
+                        "%s:note" % row["uuid"],
+                        self,
+                        page,
+                        [x, y, x + 30, y + 30],
+                        row["color"],
+                        row["contents"],
+                        date=date,
+                        surrogate=False,
+                    )
+                )
+        return annotations
 
     @classmethod
     def urn(cls):
@@ -156,7 +314,14 @@ class Paper(managers.Paper):
         super().__init__(uuid, True)
         self.papers3 = papers3
 
-    def populate(self, row):
+    def populate(self, row, authors=None, keywords=None, files=None):
+        """Populate from a Publication row
+
+        :param row: The Publication row
+        :param authors: The author rows (retrieved if None)
+        :param keywords: The keyword rows (retrieved if None)
+        :param files: The PDF rows (retrieved if None)
+        """
         self.init()
         self.type = Paper.pub_type.get(row["type"], "unknown")
         self.title = row["attributed_title"]
@@ -178,40 +343,34 @@ class Paper(managers.Paper):
 
         # Bundle
         if row["bundle"] != None:
-            self.container = Paper(self.papers3, row["bundle"])
+            self.container = self.papers3.paper(row["bundle"])
 
         self.abstract = row["summary"]
 
-        # Retrieve authors
-        authors = self.papers3.dbconn.cursor()
-        authors.execute(Papers3.AUTHOR_QUERY % self.uuid)
-        for author in authors:
-            self.authors.append(
-                Author(author["uuid"], author["prename"], author["surname"])
-            )
-        authors.close()
+        if authors is None:
+            authors, keywords, files = self.papers3.related(self.local_uuid)
+        self.authors = [
+            Author(author["uuid"], author["prename"], author["surname"])
+            for author in authors
+        ]
+        self.keywords = set(keyword["name"] for keyword in keywords)
+        self.files = [File(self, pdf["local_uuid"]).populate(pdf) for pdf in files]
 
         self.surrogate = False
 
+    def set_deleted(self):
+        """Marks the paper as deleted (see :py:meth:`Papers3.publications`)"""
+        self.init()
+        self.deleted = True
+        self.surrogate = False
+
     @staticmethod
     def surrogate(papers3, uuid):
-        p = Paper(uuid, None)
-        p.papers3 = papers3
-        return p
+        return papers3.paper(uuid)
 
-    def files(self):
-        c = self.papers3.dbconn.cursor()
-        try:
-            c.execute(PDF_QUERY.format(self.local_uuid))
-            if c.rowcount == 0:
-                return []
-
-            for row in c:
-                file = File(self, row["local_uuid"])
-                file.populate(c, row)
-                yield file
-        finally:
-            c.close()
+    def _retrieve(self):
+        if not self.papers3.get_many("uuid", [self.local_uuid]):
+            logging.warning("Papers3 publication %s does not exist", self.local_uuid)
 
     # def _retrieve(self):
     #     p = self.papers3.get_publication_by_uuid(uuid)
@@ -231,44 +390,150 @@ class Author(managers.Author):
 
 
 class Collection(managers.Collection):
-    def __init__(self, papers3, *args):
+    def __init__(self, papers3, uuid, name):
+        managers.Collection.__init__(self, uuid, name)
         self.papers3 = papers3
-        managers.Collection.__init__(self, *args)
-        del self.publications
-
-    def __getattr__(self, name):
-        if name == "publications":
-            c = self.papers3.dbconn.cursor()
-            try:
-                self.publications = []
-                c.execute(
-                    """SELECT object_id FROM CollectionItem WHERE collection="{}" """.format(
-                        self.local_uuid
-                    )
-                )
-                for row in c:
-                    self.publications.append(
-                        Paper.surrogate(self.papers3, row["object_id"])
-                    )
-            finally:
-                c.close()
-            return self.publications
-
-        return managers.Collection.__getattribute__(self, name)
+        self.children = []
+        self.publications = []
 
     @classmethod
     def urn(cls):
         return "papers3"
 
 
+class CitationGraph:
+    """Citations between publications, stored as compressed sparse rows
+
+    Publications are the nodes (sorted by uuid); the publications cited by
+    the node at index ix are the targets between offsets[ix] and
+    offsets[ix+1], and the publications citing it are the sources between
+    reverse_offsets[ix] and reverse_offsets[ix+1].
+    """
+
+    def __init__(self, citations):
+        """Builds the graph
+
+        :param citations: A list of (citing uuid, cited uuid), without
+            duplicates
+        """
+        self.uuids = sorted(set(uuid for citation in citations for uuid in citation))
+        self.index = {uuid: ix for ix, uuid in enumerate(self.uuids)}
+        edges = sorted(
+            (self.index[citing], self.index[cited]) for citing, cited in citations
+        )
+
+        self.offsets, self.targets = self.compress(edges)
+        self.reverse_offsets, self.sources = self.compress(
+            sorted((cited, citing) for citing, cited in edges)
+        )
+
+    def compress(self, edges):
+        """Returns the offsets and targets of edges sorted by source"""
+        offsets = array("q", [0] * (len(self.uuids) + 1))
+        for source, _ in edges:
+            offsets[source + 1] += 1
+        for ix in range(len(self.uuids)):
+            offsets[ix + 1] += offsets[ix]
+        return offsets, array("q", (target for _, target in edges))
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def node(self, uuid):
+        """Returns the index of a publication (or None if it has no citation)"""
+        return self.index.get(uuid)
+
+    def cites(self, uuid):
+        """Returns the uuids of the publications cited by a publication"""
+        ix = self.index.get(uuid)
+        if ix is None:
+            return []
+        return [
+            self.uuids[target]
+            for target in self.targets[self.offsets[ix] : self.offsets[ix + 1]]
+        ]
+
+    def cited_by(self, uuid):
+        """Returns the uuids of the publications citing a publication"""
+        ix = self.index.get(uuid)
+        if ix is None:
+            return []
+        return [
+            self.uuids[source]
+            for source in self.sources[
+                self.reverse_offsets[ix] : self.reverse_offsets[ix + 1]
+            ]
+        ]
+
+    def expand(self, uuids, hops=1, cites=True, cited_by=False):
+        """Returns the publications within a number of citations of others
+
+        For instance, ``expand([uuid], hops=2)`` returns a publication, the
+        ones it cites and the ones they cite.
+
+        :param uuids: The uuids of the starting publications
+        :param hops: The maximum number of citations followed (None for no limit)
+        :param cites: Follow citations towards the cited publications
+        :param cited_by: Follow citations towards the citing publications
+        :returns: The list of uuids (starting publications first, then by
+            distance)
+        """
+        adjacency = []
+        if cites:
+            adjacency.append((self.offsets, self.targets))
+        if cited_by:
+            adjacency.append((self.reverse_offsets, self.sources))
+
+        result = list(dict.fromkeys(uuids))
+        visited = set()
+        frontier = []
+        for uuid in result:
+            ix = self.index.get(uuid)
+            if ix is not None:
+                visited.add(ix)
+                frontier.append(ix)
+
+        hop = 0
+        while frontier and (hops is None or hop < hops):
+            hop += 1
+            reached = []
+            for ix in frontier:
+                for offsets, targets in adjacency:
+                    for target in targets[offsets[ix] : offsets[ix + 1]]:
+                        if target not in visited:
+                            visited.add(target)
+                            reached.append(target)
+            result.extend(self.uuids[ix] for ix in reached)
+            frontier = reached
+        return result
+
+
 class Papers3(managers.Manager):
     """Interface to Papers3.app"""
 
-    def __init__(self, dbpath=defaults()["dbpath"], filebase=defaults()["filebase"]):
-        """Initialize the papers object"""
+    def __init__(self, dbpath=None, filebase=None, incremental=False):
+        """Initialize the papers object
+
+        :param dbpath: The path of the Papers3 database (defaults to the one
+            of the Papers3 preferences)
+        :param filebase: The base path of Papers3 files (defaults to the one
+            of the Papers3 preferences, or to the library folder containing
+            the database when dbpath is given)
+        :param incremental: If True, :py:meth:`publications` only returns the
+            publications changed since the previous call (see
+            :py:meth:`incremental_publications`)
+        """
+        # The Papers3 preferences are only read when the database is not given
+        if dbpath is None:
+            dbpath = defaults()["dbpath"]
+            if filebase is None:
+                filebase = defaults()["filebase"]
+        elif filebase is None:
+            filebase = op.dirname(op.abspath(dbpath))
         self.dbpath = dbpath
         self.dbconn = sqlite3.connect(dbpath)
         self.filebase = filebase
+        self.incremental = incremental
 
         ## Checks to see if this is a valid db connection
         c = self.dbconn.cursor()
@@ -278,18 +543,38 @@ class Papers3(managers.Manager):
             raise ValueError("Invalid Papers3 database")
         self.dbconn.row_factory = dict_factory
         logging.info("Connected to Papers3 SQL database")
+        self._annotation_index = None
+
+        # Identity map (uuid -> paper) shared by publications and collections;
+        # papers are only kept while they are referenced
+        self.papers = weakref.WeakValueDictionary()
+
+        # Columns that can be used as keys by get_many()
+        c = self.dbconn.cursor()
+        try:
+            c.execute("PRAGMA table_info(Publication)")
+            self.keys = set(row["name"] for row in c) | {"rowid"}
+        finally:
+            c.close()
 
-    def get_publication_by_uuid(self, ids, results=None, n=100):
+    def paper(self, uuid):
+        """Returns the paper with the given uuid, creating a surrogate if needed"""
+        paper = self.papers.get(uuid)
+        if paper is None:
+            paper = self.papers[uuid] = Paper(self, uuid)
+        return paper
+
+    def get_publication_by_uuid(self, ids, results=None):
         """Get a publication by its universal ID"""
-        return self.get_publications("uuid", ids, results, n)
+        return self.get_publications("uuid", ids, results)
 
-    def get_publication_by_id(self, ids, results=None, n=100):
+    def get_publication_by_id(self, ids, results=None):
         """Get a publication by its internal ID"""
-        return self.get_publications("rowid", ids, results, n)
+        return self.get_publications("rowid", ids, results)
 
-    def get_publication_by_doi(self, ids, results=None, n=100):
-        """Get a publication by its internal ID"""
-        return self.get_publications("doi", ids, results, n)
+    def get_publication_by_doi(self, ids, results=None):
+        """Get a publication by its DOI"""
+        return self.get_publications("doi", ids, results)
 
     def get_publication_by_uri(self, uris, results=None):
         """Get a publication by its papers URI"""
@@ -322,47 +607,284 @@ class Papers3(managers.Manager):
                     )  # Should never happen
         return results
 
-    def query_papers_by_citekey(self, citekeys, results={}, n=100):
-        return self.get_publications("citekey", citekeys, results, n)
+    def query_papers_by_citekey(self, citekeys, results=None):
+        return self.get_publications("citekey", citekeys, results)
+
+    """Collections and their (ordered) members"""
+    COLLECTIONS_QUERY = """SELECT uuid, name, collection_description, parent, editable, configuration
+                   FROM Collection WHERE %s ORDER BY priority, ROWID"""
+    MEMBERS_QUERY = """SELECT collection, object_id FROM CollectionItem
+                   WHERE collection IS NOT NULL AND object_id IS NOT NULL
+                   ORDER BY collection, priority, ROWID"""
+
+    def members(self):
+        """Returns the publication uuids of all the collections (uuid -> list)"""
+        c = self.dbconn.cursor()
+        try:
+            c.execute(Papers3.MEMBERS_QUERY)
+            return {
+                collection: [row["object_id"] for row in rows]
+                for collection, rows in itertools.groupby(c, itemgetter("collection"))
+            }
+        finally:
+            c.close()
 
     def collections(self, virtual=False):
-        """
-        Get all the collections
-        """
+        """Returns the collections (uuid -> collection)
 
-        query = (
-            """SELECT uuid, name, collection_description, created_at, parent, priority FROM Collection WHERE %s"""
-            % ("true" if virtual else "editable=1")
-        )
+        Members are read with one scan of the collection items, and
+        publications are shared with :py:meth:`publications`.
+
+        :param virtual: Also returns smart collections, whose members are
+            selected in SQL (see :py:meth:`compile_predicate`); smart collections
+            whose predicate cannot be compiled are empty
+        """
+        members = self.members()
         c = self.dbconn.cursor()
         try:
-            c.execute(query)
-            collections = {}
-            for row in c:
-                collection = Collection(self, row["uuid"], row["name"])
-                collection.description = row["collection_description"]
-                collection.parent = row["parent"]
-                collections[collection.uuid] = collection
-
-            for collection in collections.values():
-                if collection.parent is not None:
-                    if collection.parent in collections:
-                        collection.parent = collections[collection.parent]
-                        collection.parent.children.append(collection)
-
-            return collections
+            c.execute(Papers3.COLLECTIONS_QUERY % ("1" if virtual else "editable = 1"))
+            rows = c.fetchall()
+        finally:
+            c.close()
+
+        collections = {}
+        parents = {}
+        for row in rows:
+            collection = Collection(self, row["uuid"], row["name"])
+            collection.description = row["collection_description"]
+            parents[row["uuid"]] = row["parent"]
+
+            if row["editable"]:
+                uuids = members.get(row["uuid"], ())
+            else:
+                uuids = self.smart_members(row)
+            collection.publications = [self.paper(uuid) for uuid in uuids]
+            collections[row["uuid"]] = collection
+
+        for uuid, parent in parents.items():
+            if parent is not None and parent in collections:
+                collections[uuid].parent = collections[parent]
+
+        return {collection.uuid: collection for collection in collections.values()}
+
+    def smart_members(self, row):
+        """Returns the publication uuids of a smart collection (see
+        :py:meth:`collections`)"""
+        predicate = predicate_format(row["configuration"])
+        if predicate is None:
+            logging.debug("Smart collection %s has no predicate", row["name"])
+            return []
+        try:
+            query, parameters = self.compile_predicate(predicate)
+        except ValueError as e:
+            logging.warning(
+                "Smart collection %s cannot be evaluated (%s): %s",
+                row["name"],
+                e,
+                predicate,
+            )
+            return []
 
+        c = self.dbconn.cursor()
+        try:
+            c.execute(query, parameters)
+            return [row["uuid"] for row in c]
         finally:
             c.close()
 
+    """Query of smart collections (%s is the compiled predicate)"""
+    SMART_COLLECTION_QUERY = """SELECT p.uuid FROM Publication p WHERE %s
+                   ORDER BY p.uuid"""
+
+    """Key paths of predicates on related objects, with the condition on
+    the publication (%s is the condition on the column)"""
+    RELATED_KEYPATHS = {
+        "keywords.name": (
+            "k.name",
+            """p.uuid IN (SELECT ki.object_id FROM KeywordItem ki
+                JOIN Keyword k ON ki.keyword_id = k.uuid WHERE %s)""",
+        ),
+        "authors.surname": (
+            "a.surname",
+            """p.uuid IN (SELECT oa.object_id FROM OrderedAuthor oa
+                JOIN Author a ON oa.author_id = a.uuid WHERE %s)""",
+        ),
+        "authors.prename": (
+            "a.prename",
+            """p.uuid IN (SELECT oa.object_id FROM OrderedAuthor oa
+                JOIN Author a ON oa.author_id = a.uuid WHERE %s)""",
+        ),
+    }
+
+    """SQL operators of predicate comparisons"""
+    COMPARISONS = {
+        "==": "=",
+        "=": "=",
+        "!=": "<>",
+        "<>": "<>",
+        "<": "<",
+        "<=": "<=",
+        ">": ">",
+        ">=": ">=",
+    }
+
+    def compile_predicate(self, predicate):
+        """Compiles the predicate of a smart collection into a SQL query
+
+        Predicates use the NSPredicate syntax: comparisons (==, !=, <, <=, >,
+        >=, CONTAINS, BEGINSWITH, ENDSWITH and LIKE, with the [c] modifier)
+        of a publication column (or of keywords.name, authors.surname and
+        authors.prename, optionally prefixed by ANY) with a string or number,
+        combined with AND, OR, NOT and parentheses. The diacritic
+        insensitivity modifier ([d]) is ignored.
+
+        :param predicate: The predicate format string
+        :returns: The query (returning publication uuids) and its parameters
+        :raises ValueError: if the predicate is not supported
+        """
+        tokens = tokenize_predicate(predicate)
+        parameters = []
+
+        def peek():
+            return tokens[0] if tokens else (None, None)
+
+        def expect(value):
+            kind, token = tokens.pop(0) if tokens else (None, None)
+            if token != value:
+                raise ValueError("Expected %s instead of %s" % (value, token))
+
+        def disjunction():
+            clauses = [conjunction()]
+            while peek()[1] in ("OR", "||"):
+                tokens.pop(0)
+                clauses.append(conjunction())
+            return " OR ".join(clauses)
+
+        def conjunction():
+            clauses = [negation()]
+            while peek()[1] in ("AND", "&&"):
+                tokens.pop(0)
+                clauses.append(negation())
+            return "(%s)" % " AND ".join(clauses)
+
+        def negation():
+            kind, token = peek()
+            if token in ("NOT", "!"):
+                tokens.pop(0)
+                return "NOT %s" % negation()
+            if token == "(":
+                tokens.pop(0)
+                clause = disjunction()
+                expect(")")
+                return "(%s)" % clause
+            if token in ("TRUEPREDICATE", "FALSEPREDICATE"):
+                tokens.pop(0)
+                return "1" if token == "TRUEPREDICATE" else "0"
+            return comparison()
+
+        def comparison():
+            kind, keypath = tokens.pop(0) if tokens else (None, None)
+            if keypath == "ANY":
+                kind, keypath = tokens.pop(0) if tokens else (None, None)
+            if kind != "word":
+                raise ValueError("Expected a key path instead of %s" % keypath)
+            kind, operator = tokens.pop(0) if tokens else (None, None)
+            kind, value = tokens.pop(0) if tokens else (None, None)
+            if kind not in ("string", "number"):
+                raise ValueError("Expected a value instead of %s" % value)
+
+            operator, _, modifiers = operator.upper().partition("[")
+            nocase = "C" in modifiers
+
+            if keypath in Papers3.RELATED_KEYPATHS:
+                column, condition = Papers3.RELATED_KEYPATHS[keypath]
+            elif keypath in self.keys:
+                column, condition = "p.%s" % keypath, "%s"
+            else:
+                raise ValueError("Unsupported key path %s" % keypath)
+
+            if operator in Papers3.COMPARISONS:
+                clause = "%s %s ?" % (column, Papers3.COMPARISONS[operator])
+                if nocase and kind == "string":
+                    clause += " COLLATE NOCASE"
+                parameters.append(value)
+            elif operator in ("CONTAINS", "BEGINSWITH", "ENDSWITH") and nocase:
+                pattern = re.sub(r"([%_\\])", r"\\\1", str(value))
+                if operator != "BEGINSWITH":
+                    pattern = "%" + pattern
+                if operator != "ENDSWITH":
+                    pattern = pattern + "%"
+                clause = "%s LIKE ? ESCAPE '\\'" % column
+                parameters.append(pattern)
+            elif operator == "CONTAINS":
+                clause = "INSTR(%s, ?) > 0" % column
+                parameters.append(value)
+            elif operator == "BEGINSWITH":
+                clause = "SUBSTR(%s, 1, ?) = ?" % column
+                parameters.extend((len(value), value))
+            elif operator == "ENDSWITH":
+                clause = "SUBSTR(%s, ?) = ?" % column
+                parameters.extend((-len(value), value))
+            elif operator == "LIKE" and nocase:
+                pattern = re.sub(r"([%_\\])", r"\\\1", str(value))
+                clause = "%s LIKE ? ESCAPE '\\'" % column
+                parameters.append(pattern.replace("*", "%").replace("?", "_"))
+            elif operator == "LIKE":
+                clause = "%s GLOB ?" % column
+                parameters.append(value)
+            else:
+                raise ValueError("Unsupported operator %s" % operator)
+
+            return condition % clause
+
+        where = disjunction()
+        if tokens:
+            raise ValueError("Unexpected %s" % tokens[0][1])
+        return Papers3.SMART_COLLECTION_QUERY % where, parameters
+
     PUBLICATION_QUERY = """SELECT publication_date, attributed_title, bundle, volume, number,
                    startpage, endpage, citekey, editor_string, doi, abbreviation, type, uuid, summary
                    FROM Publication"""
 
-    def get_publications(self, key, values, results=None, n=100):
+    """Temporary table holding the values searched by get_many()"""
+    LOOKUP_TABLE = """CREATE TEMP TABLE IF NOT EXISTS lookup (lookup_key PRIMARY KEY)"""
+
+    """Query of get_many(): the publications are joined with the searched values"""
+    GET_MANY_QUERY = """%s JOIN temp.lookup ON Publication.%s = lookup.lookup_key"""
+
+    def get_many(self, key, values):
+        """Returns the publications whose key is one of the values
+
+        The values are loaded into a temporary table that is joined once with
+        the publications, so the number of values does not matter (and they
+        are never spliced into the query).
+
+        :param key: A column of the Publication table (e.g. uuid, doi, citekey or rowid)
+        :param values: An iterable over the searched values
+        :returns: The list of matching papers
+        """
+        if key not in self.keys:
+            raise ValueError("Cannot search Papers3 publications by %s" % key)
+
+        c = self.dbconn.cursor()
+        try:
+            with self.dbconn:
+                c.execute(Papers3.LOOKUP_TABLE)
+                c.execute("DELETE FROM temp.lookup")
+                c.executemany(
+                    "INSERT OR IGNORE INTO temp.lookup VALUES (?)",
+                    ((value,) for value in values),
+                )
+            c.execute(Papers3.GET_MANY_QUERY % (Papers3.PUBLICATION_QUERY, key))
+            rows = c.fetchall()
+        finally:
+            c.close()
+        return [self.get_paper(row) for row in rows]
+
+    def get_publications(self, key, values, results=None):
         """Returns summary information for each paper matched to papers.
 
-        The returned object is a `dict` keyed on the citekey for each paper,
+        The returned object is a `dict` keyed on the uuid of each paper,
         where field names are taken from the CSL terminology.
 
           - title   : The title of the publicatio
@@ -378,38 +900,311 @@ class Papers3(managers.Manager):
           - month   : Month of publication date (as 3 letter name)
           - year    : 4 digit (character) year of publication
         """
-        query = """%s WHERE %%s IN (%%s)""" % Papers3.PUBLICATION_QUERY
-        c = self.dbconn.cursor()
         if not results:
             results = {}
-        while len(values) > 0:
-            take = min(len(values), n)
-            cites = ['"%s"' % x for x in values[0:take]]
-            cites = ",".join(cites)
-            values = values[take:]
-            logging.debug(query % (key, cites))
-            c.execute(query % (key, cites))
-            for row in c:
-                paper = self.get_paper(row)
-                results[paper.uuid] = paper
-            c.close()
+        for paper in self.get_many(key, values):
+            results[paper.uuid] = paper
         return results
 
-    def publications(self):
-        """Returns all papers"""
+    """Publications ordered by uuid (the key of the other queries)"""
+    PUBLICATIONS_QUERY = """SELECT p.uuid AS object_id, p.* FROM (%s) p
+                   WHERE p.uuid %%s ORDER BY p.uuid""" % PUBLICATION_QUERY
+
+    """Queries of the authors, keywords and files of publications, ordered
+    by publication (%s is the restriction on the publication)"""
+    AUTHOR_QUERY = """SELECT oa.object_id, o.surname, o.prename, o.uuid
+                     FROM OrderedAuthor oa JOIN Author o ON oa.author_id = o.uuid
+                     WHERE oa.object_id %s ORDER BY oa.object_id, oa.priority"""
+    KEYWORD_QUERY = """SELECT ki.object_id, k.name
+                     FROM KeywordItem ki JOIN Keyword k ON ki.keyword_id = k.uuid
+                     WHERE ki.object_id %s ORDER BY ki.object_id, ki.priority"""
+    PDF_QUERY = """SELECT object_id, uuid AS local_uuid, is_primary, mime_type AS mimetype, path, md5
+                     FROM PDF WHERE object_id %s ORDER BY object_id, ROWID"""
+
+    def related(self, uuid):
+        """Returns the author, keyword and PDF rows of a publication"""
         c = self.dbconn.cursor()
         try:
-            c.execute(Papers3.PUBLICATION_QUERY)
-            for row in c:
-                yield self.get_paper(row)
+            related = []
+            for query in (
+                Papers3.AUTHOR_QUERY,
+                Papers3.KEYWORD_QUERY,
+                Papers3.PDF_QUERY,
+            ):
+                c.execute(query % "= ?", (uuid,))
+                related.append(c.fetchall())
+            return related
         finally:
             c.close()
 
-    AUTHOR_QUERY = """SELECT o.surname, o.prename, o.uuid FROM OrderedAuthor oa, Author o
-                     WHERE oa.author_id = o.uuid and object_id="%s" ORDER BY priority"""
+    """Last change of the change log"""
+    WATERMARK_QUERY = """SELECT ROWID AS revision, dbRevision FROM changeLog
+                   ORDER BY ROWID DESC LIMIT 1"""
+
+    """Uuids of the rows of a table changed after a change log entry"""
+    CHANGED_UUIDS = """SELECT modUUID FROM changeLog
+                   WHERE ROWID > :revision AND modTable = '%s'"""
+
+    """Publications touched by the changed rows of each table (%s is the
+    query of the changed uuids)"""
+    CHANGED_PUBLICATIONS = {
+        "Publication": "SELECT uuid FROM Publication WHERE uuid IN (%s)",
+        "Author": "SELECT object_id FROM OrderedAuthor WHERE author_id IN (%s)",
+        "OrderedAuthor": "SELECT object_id FROM OrderedAuthor WHERE uuid IN (%s)",
+        "Keyword": "SELECT object_id FROM KeywordItem WHERE keyword_id IN (%s)",
+        "KeywordItem": "SELECT object_id FROM KeywordItem WHERE uuid IN (%s)",
+        "PDF": "SELECT object_id FROM PDF WHERE uuid IN (%s)",
+        "Annotation": """SELECT pdf.object_id FROM Annotation a
+                   JOIN PDF pdf ON a.object_id = pdf.uuid WHERE a.uuid IN (%s)""",
+        "CollectionItem": "SELECT object_id FROM CollectionItem WHERE uuid IN (%s)",
+    }
+
+    """Temporary table holding the publications changed since a watermark"""
+    CHANGED_TABLE = """CREATE TEMP TABLE IF NOT EXISTS changed (uuid PRIMARY KEY)"""
+
+    """Publications removed since a change log entry"""
+    DELETED_QUERY = """SELECT DISTINCT modUUID AS uuid FROM changeLog
+                   WHERE ROWID > :revision AND modTable = 'Publication'
+                   AND modUUID NOT IN (SELECT uuid FROM Publication)"""
+
+    """Owners (publications) of the rows of the tables depending on a
+    publication (%s is the restriction on the row uuids)"""
+    OWNERS_QUERY = """SELECT uuid, object_id AS publication FROM OrderedAuthor WHERE uuid %s
+                   UNION ALL SELECT uuid, object_id FROM KeywordItem WHERE uuid %s
+                   UNION ALL SELECT uuid, object_id FROM PDF WHERE uuid %s
+                   UNION ALL SELECT a.uuid, pdf.object_id FROM Annotation a
+                       JOIN PDF pdf ON a.object_id = pdf.uuid WHERE a.uuid %s
+                   UNION ALL SELECT uuid, object_id FROM CollectionItem WHERE uuid %s"""
+
+    """Rows of these tables changed after a change log entry"""
+    CHANGED_ROWS = """SELECT DISTINCT modUUID AS uuid FROM changeLog WHERE ROWID > :revision
+                   AND modTable IN ('OrderedAuthor', 'KeywordItem', 'PDF', 'Annotation', 'CollectionItem')"""
+
+    def watermark(self):
+        """Returns the current watermark (library -> (revision, dbRevision))
+
+        Papers3 has a single library (0), and the revision is the last entry
+        of its change log (0 if empty).
+        """
+        c = self.dbconn.cursor()
+        try:
+            c.execute(Papers3.WATERMARK_QUERY)
+            row = c.fetchone()
+        finally:
+            c.close()
+        if row is None:
+            return {0: (0, "")}
+        return {0: (row["revision"], row["dbRevision"] or "")}
+
+    def source(self):
+        """The identifier of the database in the local database"""
+        return "papers3:%s" % op.realpath(self.dbpath)
+
+    def owners(self, since=None):
+        """Returns the publications owning the author, keyword, file,
+        annotation and collection membership rows
+
+        Once rows are deleted, their publication cannot be read anymore: the
+        owners are kept in the local database (see
+        :py:func:`biblioruler.config.owners`) to resolve them.
+
+        :param since: A watermark (see :py:meth:`watermark`), or None
+        :returns: A tuple (owners, removed) where owners maps the uuids of the
+            rows changed since the watermark (all the rows if None) to their
+            publication, and removed is the list of the uuids of the deleted
+            rows (None if since is None)
+        """
+        c = self.dbconn.cursor()
+        try:
+            if since is None:
+                c.execute(Papers3.OWNERS_QUERY % (("IS NOT NULL",) * 5))
+                return {row["uuid"]: row["publication"] for row in c}, None
+
+            c.execute(Papers3.CHANGED_ROWS, {"revision": since[0][0]})
+            uuids = [row["uuid"] for row in c.fetchall()]
+            with self.dbconn:
+                c.execute(Papers3.LOOKUP_TABLE)
+                c.execute("DELETE FROM temp.lookup")
+                c.executemany(
+                    "INSERT OR IGNORE INTO temp.lookup VALUES (?)",
+                    ((uuid,) for uuid in uuids),
+                )
+            c.execute(
+                Papers3.OWNERS_QUERY
+                % (("IN (SELECT lookup_key FROM temp.lookup)",) * 5)
+            )
+            owners = {row["uuid"]: row["publication"] for row in c}
+        finally:
+            c.close()
+        return owners, [uuid for uuid in uuids if uuid not in owners]
+
+    def select_changes(self, since):
+        """Fills the temporary table of the publications changed since a
+        watermark
+
+        Changes to authors, keywords, files (and their annotations) and
+        collection memberships are mapped to their publications; deleted
+        rows are mapped through the owners stored in the local database (see
+        :py:meth:`owners`).
+        """
+        removed = config.owners(self.source(), self.owners(since)[1])
+        revision = since[0][0]
+        query = """INSERT OR IGNORE INTO temp.changed
+                   SELECT uuid FROM Publication WHERE uuid IN (%s)""" % (
+            " UNION ".join(
+                publications % (Papers3.CHANGED_UUIDS % table)
+                for table, publications in Papers3.CHANGED_PUBLICATIONS.items()
+            )
+        )
+        c = self.dbconn.cursor()
+        try:
+            with self.dbconn:
+                c.execute(Papers3.CHANGED_TABLE)
+                c.execute("DELETE FROM temp.changed")
+                c.execute(query, {"revision": revision})
+                c.executemany(
+                    """INSERT OR IGNORE INTO temp.changed
+                       SELECT uuid FROM Publication WHERE uuid = ?""",
+                    ((uuid,) for uuid in set(removed.values())),
+                )
+        finally:
+            c.close()
+
+    def deleted_publications(self, since):
+        """Returns the publications deleted since a watermark (as papers
+        marked as deleted)"""
+        c = self.dbconn.cursor()
+        try:
+            c.execute(Papers3.DELETED_QUERY, {"revision": since[0][0]})
+            rows = c.fetchall()
+        finally:
+            c.close()
+        for row in rows:
+            paper = self.paper(row["uuid"])
+            paper.set_deleted()
+            yield paper
+
+    def incremental_publications(self):
+        """Returns the publications changed since the last call
+
+        The watermark (and the owners of the rows, see :py:meth:`owners`) are
+        stored in the local database (data.db) once all the publications have
+        been returned; the first call (or the first one after the change log
+        was reset) returns everything.
+        """
+        since = config.watermark(self.source())
+        watermark = self.watermark()
+        if since is not None and since[0][0] > watermark[0][0]:
+            logging.warning("The Papers3 change log was reset, reading everything")
+            since = None
+        owners, removed = self.owners(since)
+
+        yield from self.read_publications(since)
+        config.set_watermark(self.source(), watermark)
+        config.set_owners(self.source(), owners, removed)
+
+    def publications(self, since=None):
+        """Returns all papers
+
+        Publications, authors, keywords and files are each read with one
+        scan ordered by publication, and merge-joined.
+
+        :param since: A watermark (see :py:meth:`watermark`): only the
+            publications changed since then are returned, followed by the
+            deleted ones (papers marked as deleted). If None and the manager
+            is incremental, the watermark stored by the previous call is used
+            (see :py:meth:`incremental_publications`)
+        """
+        if since is None and self.incremental:
+            return self.incremental_publications()
+        return self.read_publications(since)
+
+    def read_publications(self, since=None):
+        """Returns all papers, or the ones changed since a watermark"""
+        restriction = "IS NOT NULL"
+        if since is not None:
+            self.select_changes(since)
+            restriction = "IN (SELECT uuid FROM temp.changed)"
+
+        cursors = [self.dbconn.cursor() for _ in range(4)]
+        try:
+            for c, query in zip(
+                cursors,
+                (
+                    Papers3.PUBLICATIONS_QUERY,
+                    Papers3.AUTHOR_QUERY,
+                    Papers3.KEYWORD_QUERY,
+                    Papers3.PDF_QUERY,
+                ),
+            ):
+                c.execute(query % restriction)
+
+            for row, (authors, keywords, files) in merge_join(
+                *cursors, key=itemgetter("object_id")
+            ):
+                paper = self.paper(row["uuid"])
+                paper.populate(row, authors, keywords, files)
+                yield paper
+        finally:
+            for c in cursors:
+                c.close()
+
+        if since is not None:
+            yield from self.deleted_publications(since)
+
+    """Citations between publications: Citation.object_id cites the
+    publications of its items"""
+    CITATIONS_QUERY = """SELECT DISTINCT c.object_id AS citing, ci.object_id AS cited
+                   FROM CitationItem ci JOIN Citation c ON ci.citation = c.uuid
+                   WHERE c.object_id IS NOT NULL AND ci.object_id IS NOT NULL
+                   AND c.object_id <> ci.object_id"""
+
+    def citations(self):
+        """Returns the citation graph (see :py:class:`CitationGraph`)
+
+        The citations are read with one query; for instance, a publication and
+        everything it cites can be retrieved with
+        ``get_many("uuid", graph.expand([uuid], hops=None))``.
+        """
+        c = self.dbconn.cursor()
+        try:
+            c.execute(Papers3.CITATIONS_QUERY)
+            return CitationGraph([(row["citing"], row["cited"]) for row in c])
+        finally:
+            c.close()
+
+    """Annotations of all the files"""
+    ANNOTATIONS_QUERY = """SELECT object_id, uuid, contents, created_at, page_nr, color,
+                   left, top, rectangles
+                   FROM Annotation WHERE object_id IS NOT NULL
+                   ORDER BY object_id, page_nr, ROWID"""
+
+    @property
+    def annotation_index(self):
+        """Annotation rows of all the files, indexed by file uuid
+
+        The index is built on first access with one query, and maps a file
+        uuid to a list of (row, boxes) pairs, where the rectangle blobs of
+        all the annotations are decoded at once by
+        :py:func:`decode_rectangles`.
+        """
+        if self._annotation_index is None:
+            c = self.dbconn.cursor()
+            try:
+                c.execute(Papers3.ANNOTATIONS_QUERY)
+                rows = c.fetchall()
+            finally:
+                c.close()
+
+            boxes = decode_rectangles([row.pop("rectangles") for row in rows])
+            index = {}
+            for row, rowboxes in zip(rows, boxes):
+                index.setdefault(row["object_id"], []).append((row, rowboxes))
+            self._annotation_index = index
+        return self._annotation_index
 
     def get_paper(self, row):
-        paper = Paper(self, row["uuid"])
+        paper = self.paper(row["uuid"])
         paper.populate(row)
         return paper
 
@@ -419,16 +1214,24 @@ class Papers3(managers.Manager):
         parser.add_argument(
             "--%sdbpath" % prefix,
             dest="dbpath",
-            default=DEFAULTS["dbpath"],
+            default=None,
             help="The path to the Papers3 sqlite database, "
-            "defaults to [%s]." % DEFAULTS["dbpath"],
+            "defaults to the one of the Papers3 preferences",
         )
         parser.add_argument(
             "--%sfilebase" % prefix,
             dest="filebase",
-            default=DEFAULTS["filebase"],
+            default=None,
             help="The base path to the Papers3 file location, "
-            "defaults to [%s]." % DEFAULTS["filebase"],
+            "defaults to the one of the Papers3 preferences",
+        )
+        parser.add_argument(
+            "--%sincremental" % prefix,
+            dest="incremental",
+            action="store_true",
+            default=False,
+            help="Only read the publications changed since the previous "
+            "incremental read (the first one reads everything)",
         )
         parser.add_argument(
             "--%shelp" % prefix,
@@ -436,7 +1239,10 @@ class Papers3(managers.Manager):
             help="Provides helps about arguments for this manager",
         )
         args, remaining_args = parser.parse_known_args(args)
-        return Papers3(args.dbpath, args.filebase), remaining_args
+        return (
+            Papers3(args.dbpath, args.filebase, incremental=args.incremental),
+            remaining_args,
+        )
 
 
 Manager = Papers3
@@ -1,10 +1,15 @@
 # zotero SQL backend
 
 from pathlib import Path
-import shutil
 
+import biblioruler.config as config
 import biblioruler.managers.base as managers
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import (
+    configure_mappers,
+    joinedload,
+    sessionmaker,
+    subqueryload,
+)
 import html.parser
 
 from dateutil import parser as dtparser
@@ -12,8 +17,16 @@ from urllib.parse import unquote
 from urllib.parse import urlparse
 
 from .base import Resource, HighlightAnnotation, NoteAnnotation
-from biblioruler.sqlite3utils import dict_factory
+from biblioruler.sqlite3utils import (
+    dict_factory,
+    connect_pooled,
+    has_table,
+    merge_join,
+    snapshot,
+)
 import argparse
+import bisect
+import concurrent.futures
 import sqlite3
 import os
 import os.path as op
@@ -21,12 +34,22 @@ import logging
 import platform
 import datetime as dt
 import subprocess
+import threading
+import time
+import weakref
 
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 import biblioruler.managers.db.zotero5 as dbz
 
 import configparser
+from array import array
+from collections import deque
+import itertools
+import json
 import re
+import unicodedata
+from operator import itemgetter
 
 
 # --- Utilities
@@ -35,46 +58,68 @@ DEFAULTS = None
 
 
 def defaults():
-    """Get defaults"""
+    """Get defaults (read on first call, and cached in the configuration directory)"""
     global DEFAULTS
-    if DEFAULTS is not None:
-        return DEFAULTS
+    if DEFAULTS is None:
+        DEFAULTS = config.cached("zotero5", read_defaults)
+        logging.info("Zotero default: %s", DEFAULTS)
+    return DEFAULTS
+
 
-    DEFAULTS = {}
+def read_defaults():
+    """Read defaults from the Zotero profile
+
+    :returns: the defaults and the list of files they were read from
+    """
+    defaults = {}
 
     system = platform.system()
     pathtransform = lambda x: x
 
-
     if system == "Darwin":
-        mainpath = os.path.expanduser("~/Library/Application Support/Zotero")
+        home = Path(os.path.expanduser("~"))
+        mainpath = home / "Library/Application Support/Zotero"
     elif system == "Linux":
         if "microsoft" in platform.uname().release:
             from pathlib import PureWindowsPath
+
             def pathtransform(path):
                 p = PureWindowsPath(path)
-                r= Path("/mnt") / p.drive[:-1].lower() /  Path(*p.parts[1:])
+                r = Path("/mnt") / p.drive[:-1].lower() / Path(*p.parts[1:])
                 return r
-            path=subprocess.check_output('cmd.exe /c "echo %USERPROFILE%"', shell=True, stderr=subprocess.DEVNULL).strip().decode("utf-8")
-            mainpath= pathtransform(path) / "AppData/Roaming/Zotero/Zotero"
+
+            path = (
+                subprocess.check_output(
+                    'cmd.exe /c "echo %USERPROFILE%"',
+                    shell=True,
+                    stderr=subprocess.DEVNULL,
+                )
+                .strip()
+                .decode("utf-8")
+            )
+            home = pathtransform(path)
+            mainpath = home / "AppData/Roaming/Zotero/Zotero"
         else:
-            mainpath = os.path.expanduser("~/.zotero/zotero")
+            home = Path(os.path.expanduser("~"))
+            mainpath = home / ".zotero/zotero"
     else:
         raise Exception("No zotero path defined for %s" % platform.system())
 
     inipath = os.path.join(mainpath, "profiles.ini")
     logging.info("Reading %s", inipath)
-    config = configparser.ConfigParser()
-    config.read(inipath)
+    profiles = configparser.ConfigParser()
+    profiles.read(inipath)
 
     profilepath = None
-    for k, v in config.items():
+    for k, v in profiles.items():
         if k.startswith("Profile"):
             if v.get("Default", 0) == "1":
                 profilepath = mainpath / v["Path"]
                 break
 
-    assert profilepath is not None, f"Could not find the default profile in {mainpath}/profiles.ini"
+    assert (
+        profilepath is not None
+    ), f"Could not find the default profile in {mainpath}/profiles.ini"
 
     # Read preferences
     prefs = os.path.join(profilepath, "prefs.js")
@@ -84,16 +129,42 @@ def defaults():
             m = re_pref.match(line)
             if m is not None:
                 if m.group(1) == "extensions.zotero.baseAttachmentPath":
-                    DEFAULTS["baseAttachmentPath"] = m.group(2)
+                    defaults["baseAttachmentPath"] = m.group(2)
                 elif m.group(1) == "extensions.zotero.dataDir":
-                    DEFAULTS["dataDir"] = str(pathtransform(m.group(2)))
+                    defaults["dataDir"] = str(pathtransform(m.group(2)))
 
-    if "baseAttachmentPath" not in DEFAULTS:
-        DEFAULTS["baseAttachmentPath"] = os.path.join(DEFAULTS["dataDir"], "storage")
-    DEFAULTS["dbpath"] = os.path.join(DEFAULTS["dataDir"], "zotero.sqlite")
-    logging.info("Zotero default: %s", DEFAULTS)
+    if "dataDir" not in defaults:
+        defaults["dataDir"] = str(home / "Zotero")
+    if "baseAttachmentPath" not in defaults:
+        defaults["baseAttachmentPath"] = os.path.join(defaults["dataDir"], "storage")
+    defaults["dbpath"] = os.path.join(defaults["dataDir"], "zotero.sqlite")
 
-    return DEFAULTS
+    return defaults, [inipath, prefs]
+
+
+def parse_datetime(value):
+    """Parses a SQL timestamp"""
+    return dt.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+RE_DOI_PREFIX = re.compile(r"^(?:doi:|https?://(?:dx\.)?doi\.org/)\s*", re.I)
+RE_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(field, value):
+    """Normalizes a field value for exact (indexed) lookups
+
+    DOIs are case insensitive and can be written as URLs; titles are compared
+    without accents, case, punctuation and extra spaces.
+    """
+    value = value.strip()
+    if field == "DOI":
+        return RE_DOI_PREFIX.sub("", value).lower()
+    if field == "title":
+        value = unicodedata.normalize("NFKD", value)
+        value = "".join(c for c in value if not unicodedata.combining(c))
+        return RE_NON_WORD.sub(" ", value.casefold()).strip()
+    return value.lower()
 
 
 # --- Resources
@@ -103,76 +174,232 @@ def defaults():
 class Note(managers.Note):
     """A note"""
 
-    def __init__(self, note: dbz.ItemNote):
-        super().__init__(note.itemID, title=note.title, html=note.note)
+    def __init__(self, itemID, title, html):
+        super().__init__(itemID, title=title, html=html)
 
 
 @Resource(urn="zotero:collection")
 class Collection(managers.Collection):
     """A collection"""
 
-    def __init__(self, manager, collection: dbz.Collection):
-        super().__init__(
-            collection.collectionID, collection.collectionName, surrogate=True
-        )
+    def __init__(self, manager, collectionID, name, surrogate=True):
+        super().__init__(collectionID, name, surrogate=surrogate)
         self.manager = manager
+        self.children = []
+        if not surrogate:
+            self.publications = []
 
     def _retrieve(self):
-        query = (
-            self.manager.session.query(dbz.CollectionItem)
-            .filter(dbz.CollectionItem.collectionID == self.local_uuid)
-            .join(dbz.Item)
-            # .order_by(dbz.CollectionItem.orderIndex)
-        )
+        with self.manager.session() as session:
+            query = (
+                session.query(dbz.CollectionItem)
+                .filter(dbz.CollectionItem.collectionID == self.local_uuid)
+                .join(dbz.Item)
+                # .order_by(dbz.CollectionItem.orderIndex)
+            )
 
-        self.publications = []
-        for collectionItem in query.all():
-            self.publications.append(Paper(self.manager, collectionItem.item.key))
+            self.publications = []
+            for collectionItem in query.all():
+                item = collectionItem.item
+                self.publications.append(self.manager.paper(item.libraryID, item.key))
 
         self.surrogate = False
 
 
+@Resource(urn="zotero:search")
+class SavedSearch(managers.Collection):
+    """A saved search, whose publications are read from the database each
+    time they are iterated over"""
+
+    def __init__(self, manager, savedSearchID, name, query, parameters):
+        """Initialize the saved search
+
+        :param query: The SQL query returning the library IDs and keys of the
+            publications
+            (see :py:meth:`Manager.compile_search`)
+        :param parameters: The parameters of the query
+        """
+        super().__init__(savedSearchID, name, surrogate=False)
+        self.manager = manager
+        self.query = query
+        self.parameters = parameters
+        self.children = []
+
+    @property
+    def publications(self):
+        conn = self.manager.engine.raw_connection()
+        try:
+            for libraryID, key in conn.execute(self.query, self.parameters):
+                yield self.manager.paper(libraryID, key)
+        finally:
+            conn.close()
+
+
 @Resource(urn="zotero")
 class Author(managers.Author):
     """An author"""
 
-    def __init__(self, author: dbz.ItemCreator):
+    def __init__(self, creatorID, firstname, surname):
         super().__init__(
-            author.creatorID,
-            firstname=author.creator.firstName,
-            surname=author.creator.lastName,
-            surrogate=False,
+            creatorID, firstname=firstname, surname=surname, surrogate=False
         )
 
 
+@Resource(urn="zotero:file")
+class File(managers.File):
+    """An attachment"""
+
+    """Annotation types (itemAnnotations.type)"""
+    HIGHLIGHT, NOTE, UNDERLINE = 1, 2, 5
+
+    def __init__(self, manager, itemID, key, title, mimetype, path):
+        managers.File.__init__(self, key, surrogate=False)
+        self.manager = manager
+        self.itemID = itemID
+        self.title = title
+        self.mimetype = mimetype
+        self.path = path
+
+    def retrieve_annotations(self):
+        """Builds the annotations from the manager annotation index"""
+        annotations = []
+        for row in self.manager.annotation_index.get(self.itemID, ()):
+            key, kind, author, comment, color, position, dateAdded = row
+            position = json.loads(position)
+            page = position.get("pageIndex", 0)
+            rects = position.get("rects")
+            if not rects:
+                # Ink and image annotations
+                continue
+
+            uuid = "%s:annotation:%s" % (self.uuid, key)
+            date = parse_datetime(dateAdded)
+            if kind in (File.HIGHLIGHT, File.UNDERLINE):
+                annotation = HighlightAnnotation(
+                    uuid, self, page, color, date=date, author=author, surrogate=False
+                )
+                for bbox in rects:
+                    annotation.addBBox(bbox)
+                annotations.append(annotation)
+            elif kind == File.NOTE:
+                annotations.append(
+                    NoteAnnotation(
+                        uuid,
+                        self,
+                        page,
+                        rects[0],
+                        color,
+                        comment,
+                        date=date,
+                        author=author,
+                        surrogate=False,
+                    )
+                )
+
+        return annotations
+
+
 @Resource(urn="zotero:paper")
 class Paper(managers.Paper):
     """A zotero paper"""
 
-    def __init__(self, manager, uuid):
+    TYPES = {
+        "journalArticle": "article-journal",
+        "magazineArticle": "article-magazine",
+        "newspaperArticle": "article-newspaper",
+        "conferencePaper": "paper-conference",
+        "book": "book",
+        "bookSection": "chapter",
+        "report": "report",
+        "thesis": "thesis",
+        "patent": "patent",
+        "webpage": "webpage",
+        "blogPost": "post-weblog",
+        "hearing": "bill",
+        "bill": "bill",
+        "manuscript": "manuscript",
+        "map": "map",
+        "dataset": "dataset",
+    }
+
+    """Zotero fields copied as is (Zotero name -> paper attribute)"""
+    FIELDS = {
+        "DOI": "doi",
+        "volume": "volume",
+        "issue": "number",
+        "pages": "pages",
+        "abstractNote": "abstract",
+    }
+
+    def __init__(self, manager, uuid, libraryID=1):
+        """Initialize the paper
+
+        :param uuid: The key of the item (only unique within a library)
+        :param libraryID: The library of the item
+        """
         managers.Paper.__init__(self, uuid)
         self.manager = manager
+        self.libraryID = libraryID
 
     def _retrieve(self):
         try:
-            self.populate(
-                self.manager.session.query(dbz.Item)
-                .filter(dbz.Item.key == self.local_uuid)
-                .one()
-            )
+            with self.manager.session() as session:
+                self.populate(
+                    session.query(dbz.Item)
+                    .filter(dbz.Item.libraryID == self.libraryID)
+                    .filter(dbz.Item.key == self.local_uuid)
+                    .one()
+                )
         except:
             logging.exception("Could not retrieve item %s", self.local_uuid)
             raise
 
-    def populate(self, item: dbz.Item):
+    def populate(self, item: dbz.Item, files=None):
+        """Populate from an ORM item
+
+        :param files: The attachments of the item (retrieved if None)
+        """
+        if files is None:
+            files = self.manager.attachments(item.itemID).get(item.itemID, [])
+        self.set_values(
+            self.manager.itemtypes.get(item.itemTypeID),
+            {data.field.fieldName: data.value.value for data in item.data},
+            item.dateAdded,
+            [
+                Author(
+                    author.creatorID, author.creator.firstName, author.creator.lastName
+                )
+                for author in sorted(item.creators, key=lambda c: c.orderIndex)
+            ],
+            [tag.tag.name for tag in item.tags],
+            [Note(note.itemID, note.title, note.note) for note in item.notes],
+            files,
+        )
+
+    def set_values(self, itemtype, values, dateAdded, authors, tags, notes, files):
+        """Populate from plain values
+
+        :param itemtype: The Zotero item type name
+        :param values: The item fields (field name -> value)
+        :param dateAdded: When the item was added (datetime)
+        :param authors: The list of authors
+        :param tags: The tag names
+        :param notes: The list of notes
+        :param files: The list of attachments
+        """
         self.init()
-        values = {data.field.fieldName: data.value.value for data in item.data}
+        self.number = None
+        self.type = Paper.TYPES.get(itemtype, "entry")
         self.title = values.get("title", None)
-        self.uri = "zotero://select/items/1_%s" % self.local_uuid
+        self.uri = "zotero://select/items/%d_%s" % (self.libraryID, self.local_uuid)
+        for field, attribute in Paper.FIELDS.items():
+            if field in values:
+                setattr(self, attribute, values[field])
 
-        self.notes = [Note(note) for note in item.notes]
-        self.authors = [Author(author) for author in item.creators]
-        self.tags = set(tag.tag.name for tag in item.tags)
+        self.notes = notes
+        self.files = files
+        self.authors = authors
+        self.keywords = self.tags = set(tags)
 
         # Retrieve the date
         date = values.get("date", None)
@@ -182,128 +409,1259 @@ class Paper(managers.Paper):
                 self.year = int(m.group(1))
                 self.month = int(m.group(2))
                 self.day = int(m.group(3))
-        self.creationdate = item.dateAdded
+        self.creationdate = dateAdded
 
         self.surrogate = False
 
+    def set_deleted(self):
+        """Marks the paper as deleted (see :py:meth:`Manager.publications`)"""
+        self.init()
+        self.deleted = True
+        self.surrogate = False
+
+
+class RelationGraph:
+    """Relations between items, stored as compressed sparse rows
+
+    Items are the nodes (sorted by item ID); the relations of the node at
+    index ix are the targets (and predicates) between offsets[ix] and
+    offsets[ix+1]. Relations are followed in both directions.
+    """
+
+    def __init__(self, relations, replaced):
+        """Builds the graph
+
+        :param relations: A list of (item ID, predicate, item ID)
+        :param replaced: The (merged) items which are replaced by an item
+            that is not in the database anymore ((library ID, key) -> item
+            ID; the library ID is None if the library is not local)
+        """
+        self.replaced = replaced
+        self.predicates = sorted(set(predicate for _, predicate, _ in relations))
+        predicates = {predicate: ix for ix, predicate in enumerate(self.predicates)}
+
+        nodes = set()
+        for source, _, target in relations:
+            nodes.add(source)
+            nodes.add(target)
+        self.ids = array("q", sorted(nodes))
+        index = {itemID: ix for ix, itemID in enumerate(self.ids)}
+
+        # Counts the relations of each node, then fills the rows
+        self.offsets = array("q", [0] * (len(self.ids) + 1))
+        for source, _, target in relations:
+            self.offsets[index[source] + 1] += 1
+            self.offsets[index[target] + 1] += 1
+        for ix in range(len(self.ids)):
+            self.offsets[ix + 1] += self.offsets[ix]
+
+        self.targets = array("q", [0] * self.offsets[-1])
+        self.edge_predicates = array("H", [0] * self.offsets[-1])
+        position = array("q", self.offsets[:-1])
+        for source, predicate, target in relations:
+            for a, b in (
+                (index[source], index[target]),
+                (index[target], index[source]),
+            ):
+                self.targets[position[a]] = b
+                self.edge_predicates[position[a]] = predicates[predicate]
+                position[a] += 1
+
+        self._components = None
+        self._groups = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def node(self, itemID):
+        """Returns the index of an item (or None if it has no relation)"""
+        ix = bisect.bisect_left(self.ids, itemID)
+        if ix < len(self.ids) and self.ids[ix] == itemID:
+            return ix
+        return None
+
+    def neighbors(self, itemID, predicate=None):
+        """Returns the IDs of the items related to an item
+
+        :param predicate: Only follow relations with this predicate (e.g.
+            dc:relation, dc:replaces or owl:sameAs)
+        """
+        ix = self.node(itemID)
+        if ix is None:
+            return []
+        neighbors = []
+        for position in range(self.offsets[ix], self.offsets[ix + 1]):
+            if (
+                predicate is None
+                or self.predicates[self.edge_predicates[position]] == predicate
+            ):
+                itemID = self.ids[self.targets[position]]
+                if itemID not in neighbors:
+                    neighbors.append(itemID)
+        return neighbors
+
+    @property
+    def components(self):
+        """The connected component of each node (an array of labels)"""
+        if self._components is None:
+            labels = array("q", [-1] * len(self.ids))
+            for start in range(len(self.ids)):
+                if labels[start] >= 0:
+                    continue
+                labels[start] = start
+                stack = [start]
+                while stack:
+                    ix = stack.pop()
+                    for position in range(self.offsets[ix], self.offsets[ix + 1]):
+                        target = self.targets[position]
+                        if labels[target] < 0:
+                            labels[target] = start
+                            stack.append(target)
+            self._components = labels
+        return self._components
+
+    @property
+    def groups(self):
+        """The items of each connected component (label -> list of item IDs)"""
+        if self._groups is None:
+            groups = {}
+            for ix, label in enumerate(self.components):
+                groups.setdefault(label, []).append(self.ids[ix])
+            self._groups = groups
+        return self._groups
+
+    def component(self, itemID):
+        """Returns the IDs of the items connected to an item (itself included)"""
+        ix = self.node(itemID)
+        if ix is None:
+            return [itemID]
+        return self.groups[self.components[ix]]
+
+    def connected_components(self):
+        """Returns the list of the connected components (lists of item IDs)"""
+        return list(self.groups.values())
+
 
 class Manager(managers.Manager):
     def connect(self):
         # Read only connect
-        return sqlite3.connect("file:%s?mode=ro" % self.ro_dbpath, uri=True)
+        return connect_pooled(self.ro_dbpath)
+
+    """zotero manager
 
-    """zotero manager"""
+    Connections are pooled, and the manager can be used from several threads:
+    raw SQL queries use connections from the pool of the engine, and the ORM
+    uses a new session for each read (closed, and its connection returned to
+    the pool, once the read is done).
+    """
+
+    """Size of the connection pool"""
+    POOL_SIZE = min(32, (os.cpu_count() or 1) + 4)
 
     def __init__(
-        self,
-        dbpath=defaults()["dbpath"],
-        filebase=defaults()["baseAttachmentPath"],
-        copy=True,
+        self, dbpath=None, filebase=None, copy=True, processes=None, incremental=False
     ):
-        """Initialize the manager"""
+        """Initialize the manager
+
+        :param dbpath: The path of zotero.sqlite (defaults to the one of the
+            default Zotero profile)
+        :param filebase: The base attachment path (defaults to the one of the
+            default Zotero profile, or to the storage folder of the database
+            when dbpath is given)
+        :param copy: If True, the database is read from a snapshot (see
+            :py:meth:`refresh`) so that Zotero can run concurrently
+        :param processes: The default number of worker processes used by
+            :py:meth:`publications` (None to read in the current process)
+        :param incremental: If True, :py:meth:`publications` only returns the
+            publications changed since the previous call (see
+            :py:meth:`incremental_publications`)
+        """
         managers.Manager.__init__(self, None, surrogate=False)
+        # The Zotero profile is only read when the database is not given
+        if dbpath is None:
+            dbpath = defaults()["dbpath"]
+            if filebase is None:
+                filebase = defaults()["baseAttachmentPath"]
+        elif filebase is None:
+            filebase = Path(dbpath).parent / "storage"
         self.dbpath = Path(dbpath)
         self.ro_dbpath = self.dbpath
         self.filebase = filebase
+        self.processes = processes
+        self.incremental = incremental
 
         if copy:
             self.ro_dbpath = self.dbpath.with_suffix(".ro.sql")
 
+        # Base paths of attachments (see resolve)
+        self.basepaths = {
+            "storage": str(self.dbpath.parent / "storage"),
+            "attachments": str(filebase),
+        }
+
+        # Protects the engine, the identity map and the indices
+        self.lock = threading.RLock()
+
         self.engine = None
         self.refresh()
 
-    def refresh(self):
-        """Copy again the database if read-only and outdated"""
-        print("Copy to", self.ro_dbpath)
+        # Identity map ((library ID, key) -> paper) shared by publications and
+        # collections (keys are only unique within a library); papers are
+        # only kept while they are referenced
+        self.papers = weakref.WeakValueDictionary()
+
+    def paper(self, libraryID, key):
+        """Returns the paper with the given library and key, creating a
+        surrogate if needed"""
+        paper = self.papers.get((libraryID, key))
+        if paper is None:
+            with self.lock:
+                paper = self.papers.get((libraryID, key))
+                if paper is None:
+                    paper = self.papers[libraryID, key] = Paper(self, key, libraryID)
+        return paper
 
-        if self.ro_dbpath:
-            if (
-                not self.ro_dbpath.is_file()
-                or self.ro_dbpath.stat().st_mtime < self.dbpath.stat().st_mtime
-            ):
-                shutil.copyfile(self.dbpath, self.ro_dbpath)
+    def refresh(self):
+        """Updates the snapshot if the database changed
+
+        The snapshot is made with the sqlite backup API, which gives a
+        consistent copy even if Zotero is writing; it is kept as long as the
+        modification time and size of the database are unchanged.
+        """
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        if self.ro_dbpath != self.dbpath:
+            start = time.time()
+            if snapshot(self.dbpath, self.ro_dbpath) and self.engine:
+                # Connections still in use read the previous snapshot
+                self.engine.dispose()
                 self.engine = None
+            logging.info(
+                "Zotero snapshot %s checked in %.2fs",
+                self.ro_dbpath,
+                time.time() - start,
+            )
 
         if not self.engine:
             self.engine = create_engine(
-                u"sqlite://", creator=self.connect, connect_args={"readonly": True}
+                "sqlite://",
+                creator=self.connect,
+                poolclass=QueuePool,
+                pool_size=Manager.POOL_SIZE,
             )
-            # options={ "mode": "ro"})
-            self.session = scoped_session(sessionmaker(bind=self.engine))
+            # Sessions are only used to read, and are closed after each read
+            # (with self.session() as session: ...) so that their connection
+            # goes back to the pool
+            self.session = sessionmaker(bind=self.engine)
 
             logging.info("Connected to Zotero SQL database")
 
-            self.fields = {}
-            for row in self.session.query(dbz.FieldsCombined):
-                self.fields[row.fieldName] = row.fieldID
+            with self.session() as session:
+                self.fields = {}
+                for row in session.query(dbz.FieldsCombined):
+                    self.fields[row.fieldName] = row.fieldID
+                self.fieldnames = {value: key for key, value in self.fields.items()}
+
+                self.itemtypes = {}
+                for row in session.query(dbz.ItemType):
+                    self.itemtypes[row.itemTypeID] = row.typeName
+
+            # Lookup indices (see find_by_many) are only valid for a snapshot
+            self.indices = {}
+            self._annotation_index = None
+
+    """Queries of collections(), which reads all the collections at once"""
+    COLLECTIONS_QUERY = """SELECT collectionID, collectionName, parentCollectionID FROM collections
+        WHERE libraryID NOT IN (SELECT libraryID FROM feeds)"""
+    COLLECTION_ITEMS_QUERY = """SELECT ci.collectionID, i.libraryID, i.key FROM collectionItems ci, items i
+        WHERE i.itemID = ci.itemID AND %s
+        ORDER BY ci.collectionID, ci.orderIndex"""
 
     def collections(self):
-        return None
+        """Returns all the collections (collection ID -> collection)
+
+        Collections are read with one query, and their publications with
+        another one; publications are shared with :py:meth:`publications`.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            collections = {}
+            parents = {}
+            for collectionID, name, parentID in conn.execute(Manager.COLLECTIONS_QUERY):
+                collections[collectionID] = Collection(
+                    self, collectionID, name, surrogate=False
+                )
+                parents[collectionID] = parentID
+
+            for collectionID, parentID in parents.items():
+                if parentID is not None and parentID in collections:
+                    collections[collectionID].parent = collections[parentID]
+
+            for collectionID, libraryID, key in conn.execute(
+                Manager.COLLECTION_ITEMS_QUERY % Manager.PUBLICATION_CONDITION
+            ):
+                if collectionID in collections:
+                    collections[collectionID].publications.append(
+                        self.paper(libraryID, key)
+                    )
+
+            return collections
+        finally:
+            conn.close()
+
+    """Queries of relations()"""
+    RELATIONS_QUERY = """SELECT r.itemID, p.predicate, r.object FROM itemRelations r
+        JOIN relationPredicates p ON p.predicateID = r.predicateID"""
+    ITEM_KEYS_QUERY = "SELECT libraryID, key, itemID FROM items"
+    LIBRARY_URIS_QUERY = """SELECT 'groups/' || groupID, libraryID FROM groups
+        UNION SELECT 'users', libraryID FROM libraries WHERE type = 'user'"""
+    RE_ITEM_URI = re.compile(
+        r"^https?://zotero\.org/(users|groups/\d+)/(?:[^/]+/)*items/(\w+)$"
+    )
+
+    def relations(self):
+        """Returns the relations between items (see :py:class:`RelationGraph`)
+
+        Relations are read with one query; their objects are item URIs,
+        which are resolved (in memory) to the items of the local libraries.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            libraries = dict(conn.execute(Manager.LIBRARY_URIS_QUERY))
+            itemIDs = {
+                (libraryID, key): itemID
+                for libraryID, key, itemID in conn.execute(Manager.ITEM_KEYS_QUERY)
+            }
+            relations = []
+            replaced = {}
+            for itemID, predicate, uri in conn.execute(Manager.RELATIONS_QUERY):
+                m = Manager.RE_ITEM_URI.match(uri)
+                if m is None:
+                    continue
+                key = (libraries.get(m.group(1)), m.group(2))
+                target = itemIDs.get(key)
+                if target is not None:
+                    relations.append((itemID, predicate, target))
+                elif predicate == "dc:replaces":
+                    replaced[key] = itemID
+            return RelationGraph(relations, replaced)
+        finally:
+            conn.close()
+
+    """Queries of saved_searches()"""
+    SAVED_SEARCHES_QUERY = """SELECT savedSearchID, savedSearchName, libraryID FROM savedSearches
+        WHERE libraryID NOT IN (SELECT libraryID FROM feeds) ORDER BY savedSearchID"""
+    SEARCH_CONDITIONS_QUERY = """SELECT savedSearchID, condition, operator, value FROM savedSearchConditions
+        ORDER BY savedSearchID, searchConditionID"""
+    SEARCH_QUERY = """WITH matches(itemID) AS (SELECT i.itemID FROM items i WHERE i.libraryID = ? AND (%s))
+        SELECT i.libraryID, i.key FROM items i
+        WHERE i.itemID %sIN (SELECT itemID FROM deletedItems)
+            AND i.itemTypeID NOT IN (SELECT itemTypeID FROM itemTypes WHERE typeName IN ('attachment', 'note', 'annotation'))
+            AND i.itemID IN (%s)
+        ORDER BY i.itemID"""
+    """Matching items (and the parents of matching notes and attachments)"""
+    SEARCH_MATCHES = "SELECT itemID FROM matches"
+    SEARCH_PARENTS = """SELECT itemID FROM matches
+            UNION SELECT parentItemID FROM itemNotes WHERE itemID IN matches
+            UNION SELECT parentItemID FROM itemAttachments WHERE itemID IN matches"""
+    """Search flags (stored in the operator column), with their defaults"""
+    SEARCH_FLAGS = {
+        "joinMode": "all",
+        "recursive": "false",
+        "noChildren": "false",
+        "includeParentsAndChildren": "false",
+        "deleted": "false",
+    }
+
+    """Subqueries of the search conditions, returning item IDs (%s is
+    the comparison)"""
+    SEARCH_CONDITIONS = {
+        "tag": "SELECT it.itemID FROM itemTags it JOIN tags t ON t.tagID = it.tagID WHERE t.name %s",
+        "creator": """SELECT ic.itemID FROM itemCreators ic JOIN creators c ON c.creatorID = ic.creatorID
+            WHERE TRIM(COALESCE(c.firstName, '') || ' ' || c.lastName) %s""",
+        "itemType": "SELECT itemID FROM items WHERE itemTypeID IN (SELECT itemTypeID FROM itemTypes WHERE typeName %s)",
+        "field": """SELECT d.itemID FROM itemData d JOIN itemDataValues v ON v.valueID = d.valueID
+            WHERE d.fieldID = ? AND v.value %s""",
+    }
+    COLLECTION_CONDITION = """SELECT itemID FROM collectionItems WHERE collectionID IN (
+            SELECT collectionID FROM collections WHERE key = ? AND libraryID = ?)"""
+    RECURSIVE_COLLECTION_CONDITION = """WITH RECURSIVE subcollections(collectionID) AS (
+            SELECT collectionID FROM collections WHERE key = ? AND libraryID = ?
+            UNION SELECT c.collectionID FROM collections c JOIN subcollections s ON c.parentCollectionID = s.collectionID)
+        SELECT itemID FROM collectionItems WHERE collectionID IN subcollections"""
+    """Units of the isInTheLast operator (SQLite date modifiers)"""
+    DATE_UNITS = {
+        "seconds": (1, "seconds"),
+        "minutes": (1, "minutes"),
+        "hours": (1, "hours"),
+        "days": (1, "days"),
+        "weeks": (7, "days"),
+        "months": (1, "months"),
+        "years": (1, "years"),
+    }
+
+    def compile_search(self, libraryID, conditions):
+        """Compiles the conditions of a saved search into a SQL query
+
+        Supported conditions are tags, collections (recursive or not),
+        creators, item types, fields (e.g. title or DOI), date added and
+        modified; they are combined with AND or OR depending on the join mode.
+
+        Only publications are returned: notes and attachments never match,
+        but with the includeParentsAndChildren flag (and without noChildren)
+        they bring in their parent publication. With the deleted flag, only
+        the publications in the trash are returned (as in Zotero).
+
+        :param libraryID: The library of the search
+        :param conditions: A list of (condition, operator, value)
+        :returns: The query (returning library IDs and item keys) and its
+            parameters
+        :raises ValueError: if a condition is not supported
+        """
+        conditions = list(conditions)
+        flags = dict(Manager.SEARCH_FLAGS)
+        flags.update(
+            (condition, operator)
+            for condition, operator, value in conditions
+            if condition in Manager.SEARCH_FLAGS
+        )
+        recursive = flags["recursive"] == "true"
+        parents = (
+            flags["includeParentsAndChildren"] == "true"
+            and flags["noChildren"] != "true"
+        )
+
+        parameters = [libraryID]
+        clauses = []
+        for condition, operator, value in conditions:
+            if condition in Manager.SEARCH_FLAGS:
+                continue
+
+            if condition in ("dateAdded", "dateModified"):
+                column = "i.%s" % condition
+                if operator == "isBefore":
+                    clauses.append("%s < ?" % column)
+                elif operator == "isAfter":
+                    clauses.append("%s > ?" % column)
+                elif operator == "is":
+                    clauses.append("DATE(%s) = DATE(?)" % column)
+                elif operator == "isInTheLast":
+                    count, unit = value.split()
+                    factor, modifier = Manager.DATE_UNITS[unit]
+                    clauses.append("%s > DATETIME('now', ?)" % column)
+                    value = "-%d %s" % (int(count) * factor, modifier)
+                else:
+                    raise ValueError("Unsupported date operator %s" % operator)
+                parameters.append(value)
+                continue
+
+            if condition == "collection":
+                if operator not in ("is", "isNot"):
+                    raise ValueError("Unsupported collection operator %s" % operator)
+                subquery = (
+                    Manager.RECURSIVE_COLLECTION_CONDITION
+                    if recursive
+                    else Manager.COLLECTION_CONDITION
+                )
+                parameters.extend((value, libraryID))
+                clauses.append(
+                    "i.itemID %sIN (%s)"
+                    % ("NOT " if operator == "isNot" else "", subquery)
+                )
+                continue
+
+            if condition in Manager.SEARCH_CONDITIONS:
+                subquery = Manager.SEARCH_CONDITIONS[condition]
+            elif condition in self.fields:
+                subquery = Manager.SEARCH_CONDITIONS["field"]
+                parameters.append(self.fields[condition])
+            else:
+                raise ValueError("Unsupported search condition %s" % condition)
+
+            escaped = re.sub(r"([\\%_])", r"\\\1", value)
+            comparison = {
+                "is": (True, "= ?", value),
+                "isNot": (False, "= ?", value),
+                "contains": (True, "LIKE ? ESCAPE '\\'", "%%%s%%" % escaped),
+                "doesNotContain": (False, "LIKE ? ESCAPE '\\'", "%%%s%%" % escaped),
+                "beginsWith": (True, "LIKE ? ESCAPE '\\'", "%s%%" % escaped),
+            }.get(operator)
+            if comparison is None:
+                raise ValueError("Unsupported operator %s" % operator)
+            positive, comparison, value = comparison
+            parameters.append(value)
+            clauses.append(
+                "i.itemID %sIN (%s)"
+                % ("" if positive else "NOT ", subquery % comparison)
+            )
 
-    def get_collection_by_key(self, key):
-        collection = (
-            self.session.query(dbz.Collection).filter(dbz.Collection.key == key).one()
+        join = " OR " if flags["joinMode"] == "any" else " AND "
+        where = join.join("(%s)" % clause for clause in clauses) or "1"
+        query = Manager.SEARCH_QUERY % (
+            where,
+            "" if flags["deleted"] == "true" else "NOT ",
+            Manager.SEARCH_PARENTS if parents else Manager.SEARCH_MATCHES,
         )
-        return Collection(self, collection)
+        return query, parameters
+
+    def saved_searches(self):
+        """Returns the saved searches (saved search ID -> saved search)
+
+        Searches are compiled into SQL (see :py:meth:`compile_search`), and
+        their publications are read when iterated over; searches with
+        unsupported conditions are skipped.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            conditions = {
+                savedSearchID: [row[1:] for row in rows]
+                for savedSearchID, rows in itertools.groupby(
+                    conn.execute(Manager.SEARCH_CONDITIONS_QUERY), itemgetter(0)
+                )
+            }
+            searches = conn.execute(Manager.SAVED_SEARCHES_QUERY).fetchall()
+        finally:
+            conn.close()
+
+        savedsearches = {}
+        for savedSearchID, name, libraryID in searches:
+            try:
+                query, parameters = self.compile_search(
+                    libraryID, conditions.get(savedSearchID, [])
+                )
+            except (ValueError, KeyError) as e:
+                logging.warning("Skipping the saved search %s: %s", name, e)
+                continue
+            savedsearches[savedSearchID] = SavedSearch(
+                self, savedSearchID, name, query, parameters
+            )
+        return savedsearches
+
+    """Attachments (with a %s restriction), sorted by parent item ID"""
+    ATTACHMENTS_QUERY = """SELECT a.parentItemID, a.itemID, i.key, v.value, a.contentType, a.path
+        FROM itemAttachments a
+        JOIN items i ON i.itemID = a.itemID
+        LEFT JOIN itemData d ON d.itemID = a.itemID
+            AND d.fieldID = (SELECT fieldID FROM fieldsCombined WHERE fieldName = 'title')
+        LEFT JOIN itemDataValues v ON v.valueID = d.valueID
+        WHERE a.parentItemID IS NOT NULL AND a.path IS NOT NULL
+            AND a.itemID NOT IN (SELECT itemID FROM deletedItems) AND %s
+        ORDER BY a.parentItemID, a.itemID"""
+
+    def resolve(self, key, path):
+        """Returns the absolute path of an attachment
+
+        :param key: The key of the attachment item
+        :param path: The path stored by Zotero, which is either relative to
+            the attachment storage directory (storage:), relative to the base
+            attachment path (attachments:), or absolute (linked files)
+        """
+        prefix, sep, relpath = path.partition(":")
+        if prefix == "storage":
+            return op.join(self.basepaths["storage"], key, relpath)
+        if prefix == "attachments":
+            return op.join(self.basepaths["attachments"], relpath)
+        return path
+
+    def attachments(self, parentItemID=None):
+        """Returns the attachments (parent item ID -> list of files)
+
+        :param parentItemID: Restricts to the attachments of one item
+        """
+        conn = self.engine.raw_connection()
+        try:
+            if parentItemID is None:
+                rows = conn.execute(Manager.ATTACHMENTS_QUERY % "1")
+            else:
+                rows = conn.execute(
+                    Manager.ATTACHMENTS_QUERY % "a.parentItemID = ?", (parentItemID,)
+                )
+            return {
+                parentID: [self.attachment(row) for row in rows]
+                for parentID, rows in itertools.groupby(rows, itemgetter(0))
+            }
+        finally:
+            conn.close()
+
+    def attachment(self, row):
+        """Builds a file from an attachment row"""
+        _, itemID, key, title, mimetype, path = row
+        return File(self, itemID, key, title, mimetype, self.resolve(key, path))
+
+    """Reader annotations (Zotero 6+), sorted by attachment and position;
+    annotations imported from the PDF itself are skipped"""
+    ANNOTATIONS_QUERY = """SELECT a.parentItemID, i.key, a.type, a.authorName, a.comment, a.color, a.position, i.dateAdded
+        FROM itemAnnotations a JOIN items i ON i.itemID = a.itemID
+        WHERE a.isExternal = 0 AND a.itemID NOT IN (SELECT itemID FROM deletedItems)
+        ORDER BY a.parentItemID, a.sortIndex"""
+
+    @property
+    def annotation_index(self):
+        """Annotation rows of all the attachments, indexed by attachment ID
+
+        The index is built on first access with one query (it is empty for
+        databases without annotations, i.e. before Zotero 6).
+        """
+        if self._annotation_index is None:
+            with self.lock:
+                if self._annotation_index is None:
+                    self._annotation_index = self.read_annotation_index()
+        return self._annotation_index
+
+    def read_annotation_index(self):
+        index = {}
+        conn = self.engine.raw_connection()
+        try:
+            if has_table(conn, "itemAnnotations"):
+                for parentID, rows in itertools.groupby(
+                    conn.execute(Manager.ANNOTATIONS_QUERY), itemgetter(0)
+                ):
+                    index[parentID] = [row[1:] for row in rows]
+        finally:
+            conn.close()
+        return index
+
+    """Libraries (except feeds), with the name of groups"""
+    LIBRARIES_QUERY = """SELECT l.libraryID, l.type, g.name FROM libraries l
+        LEFT JOIN groups g ON g.libraryID = l.libraryID
+        WHERE l.libraryID NOT IN (SELECT libraryID FROM feeds)
+        ORDER BY l.libraryID"""
+
+    def libraries(self):
+        """Returns the libraries as a list of (library ID, type, group name)"""
+        conn = self.engine.raw_connection()
+        try:
+            return conn.execute(Manager.LIBRARIES_QUERY).fetchall()
+        finally:
+            conn.close()
+
+    """Item types that are not publications"""
+    NON_PUBLICATION_TYPES = ("attachment", "note", "annotation")
+
+    def publication_ids(self, session, library=None):
+        """Returns the IDs of all the publications (ordered by item ID)
+
+        Deleted items, feed items, notes, attachments and annotations are not
+        publications.
+
+        :param library: Restricts to the publications of a library
+        """
+        query = (
+            session.query(dbz.Item.itemID)
+            .filter(
+                ~dbz.Item.itemID.in_(session.query(dbz.DeletedItem.__table__.c.itemID))
+            )
+            .filter(
+                ~dbz.Item.libraryID.in_(session.query(dbz.Feed.__table__.c.libraryID))
+            )
+            .filter(
+                ~dbz.Item.itemTypeID.in_(
+                    session.query(dbz.ItemType.itemTypeID).filter(
+                        dbz.ItemType.typeName.in_(Manager.NON_PUBLICATION_TYPES)
+                    )
+                )
+            )
+            .order_by(dbz.Item.itemID)
+        )
+        if library is not None:
+            query = query.filter(dbz.Item.libraryID == library)
+        return [itemID for itemID, in query]
+
+    """Queries of the SQL path of publications(), sorted by item ID; the %s
+    placeholder restricts the items (see LIBRARY_CONDITION)"""
+    PUBLICATION_CONDITION = """i.itemID NOT IN (SELECT itemID FROM deletedItems)
+        AND i.libraryID NOT IN (SELECT libraryID FROM feeds)
+        AND i.itemTypeID NOT IN (SELECT itemTypeID FROM itemTypes WHERE typeName IN ('attachment', 'note', 'annotation'))"""
+    PUBLICATIONS_QUERY = (
+        """SELECT i.itemID, i.libraryID, i.key, i.itemTypeID, i.dateAdded FROM items i
+        WHERE %s AND %%s ORDER BY i.itemID""" % PUBLICATION_CONDITION
+    )
+    FIELDS_QUERY = """SELECT d.itemID, d.fieldID, v.value FROM itemData d, itemDataValues v
+        WHERE v.valueID = d.valueID AND %s ORDER BY d.itemID"""
+    CREATORS_QUERY = """SELECT ic.itemID, c.creatorID, c.firstName, c.lastName FROM itemCreators ic, creators c
+        WHERE c.creatorID = ic.creatorID AND %s ORDER BY ic.itemID, ic.orderIndex"""
+    TAGS_QUERY = """SELECT it.itemID, t.name FROM itemTags it, tags t
+        WHERE t.tagID = it.tagID AND %s ORDER BY it.itemID"""
+    NOTES_QUERY = """SELECT parentItemID, itemID, title, note FROM itemNotes
+        WHERE parentItemID IS NOT NULL AND %s ORDER BY parentItemID"""
+
+    """Items changed since a watermark (the condition is on the items c);
+    changes of notes, attachments and annotations change the publication they
+    belong to"""
+    CHANGED_ITEMS = """SELECT c.itemID FROM items c WHERE %(condition)s
+        UNION SELECT n.parentItemID FROM itemNotes n JOIN items c ON c.itemID = n.itemID WHERE %(condition)s
+        UNION SELECT a.parentItemID FROM itemAttachments a JOIN items c ON c.itemID = a.itemID WHERE %(condition)s"""
+    CHANGED_ANNOTATIONS = """UNION SELECT a.parentItemID FROM itemAttachments a
+            JOIN itemAnnotations n ON n.parentItemID = a.itemID
+            JOIN items c ON c.itemID = n.itemID WHERE %(condition)s"""
+
+    @staticmethod
+    def item_subset(conn, library=None, since=None):
+        """Returns a query selecting the IDs of the items of a library and/or
+        changed since a watermark, with its parameters (None if no restriction)
+
+        :param conn: The connection the query will be run with
+        :param library: A library ID
+        :param since: A watermark (see :py:meth:`watermark`); items of libraries
+            that are not in the watermark are all selected
+        """
+        conditions = []
+        parameters = {}
+        if library is not None:
+            conditions.append("c.libraryID = :library")
+            parameters["library"] = library
+        if since is not None:
+            changed = ["c.libraryID NOT IN (%s)" % ", ".join(map(str, since))]
+            for ix, (libraryID, (version, modified)) in enumerate(since.items()):
+                changed.append(
+                    "c.libraryID = %d AND (c.version > :version%d OR c.clientDateModified >= :modified%d)"
+                    % (libraryID, ix, ix)
+                )
+                parameters["version%d" % ix] = version
+                parameters["modified%d" % ix] = modified
+            conditions.append("(%s)" % " OR ".join("(%s)" % c for c in changed))
+
+        if not conditions:
+            return None, parameters
+        query = Manager.CHANGED_ITEMS
+        if since is not None and has_table(conn, "itemAnnotations"):
+            query += "\n        " + Manager.CHANGED_ANNOTATIONS
+        return query % {"condition": " AND ".join(conditions)}, parameters
+
+    """Watermark of each library: the largest version and modification (or
+    deletion) date"""
+    WATERMARK_QUERY = """SELECT libraryID, MAX(version), MAX(modified) FROM (
+            SELECT libraryID, version, clientDateModified AS modified FROM items
+            UNION ALL SELECT i.libraryID, 0, d.dateDeleted FROM deletedItems d JOIN items i ON i.itemID = d.itemID
+            %s
+        ) GROUP BY libraryID"""
+    """Items deleted since a watermark: moved to the trash (publications only),
+    or deleted for good (the sync log does not tell the item type)"""
+    DELETED_QUERY = """SELECT i.libraryID, i.key FROM deletedItems d JOIN items i ON i.itemID = d.itemID
+        WHERE i.libraryID = :library AND d.dateDeleted >= :modified
+        AND i.itemTypeID NOT IN (SELECT itemTypeID FROM itemTypes WHERE typeName IN ('attachment', 'note', 'annotation'))
+        %s"""
+    SYNC_DELETED = """UNION SELECT libraryID, key FROM syncDeleteLog
+        WHERE libraryID = :library AND dateDeleted >= :modified
+        AND syncObjectTypeID = (SELECT syncObjectTypeID FROM syncObjectTypes WHERE name = 'item')"""
+
+    def watermark(self):
+        """Returns the current watermark (library ID -> (version, modified))
+
+        Zotero increments the version of items when they are synchronized,
+        and updates their modification date on every local change.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            deletions = ""
+            if has_table(conn, "syncDeleteLog"):
+                deletions = (
+                    "UNION ALL SELECT libraryID, 0, dateDeleted FROM syncDeleteLog"
+                )
+            return {
+                library: (version, modified)
+                for library, version, modified in conn.execute(
+                    Manager.WATERMARK_QUERY % deletions
+                )
+            }
+        finally:
+            conn.close()
+
+    def deleted_keys(self, since, library=None):
+        """Returns the items deleted since a watermark (library ID, key)"""
+        conn = self.engine.raw_connection()
+        try:
+            query = Manager.DELETED_QUERY % (
+                Manager.SYNC_DELETED if has_table(conn, "syncDeleteLog") else ""
+            )
+            keys = []
+            for libraryID, (version, modified) in since.items():
+                if library is None or library == libraryID:
+                    keys.extend(
+                        conn.execute(
+                            query, {"library": libraryID, "modified": modified}
+                        )
+                    )
+            return keys
+        finally:
+            conn.close()
+
+    def source(self):
+        """The identifier of the database in the local database"""
+        return "zotero5:%s" % self.dbpath.resolve()
+
+    def incremental_publications(self, orm, chunksize, library, processes):
+        """Returns the publications changed since the last call
+
+        The watermark is stored in the local database (data.db) once all the
+        publications have been returned; the first call returns everything.
+        Items modified during the second of the watermark are returned again
+        by the next call.
+        """
+        since = config.watermark(self.source())
+        watermark = self.watermark()
+        if library is not None:
+            current = watermark
+            watermark = dict(since or {})
+            if library in current:
+                watermark[library] = current[library]
+
+        yield from self.read_publications(orm, chunksize, library, processes, since)
+        if since:
+            yield from self.deleted_publications(since, library)
+        config.set_watermark(self.source(), watermark)
+
+    def publications(
+        self, orm=False, chunksize=500, library=None, processes=None, since=None
+    ):
+        """Returns all the publications, fully populated
+
+        By default, the publications and their fields, creators, tags and
+        notes are read with one ordered scan each (bypassing the ORM), and
+        merge-joined on the item ID.
+
+        :param orm: Use the ORM instead: items are loaded by chunks and, for
+            each chunk, item data, creators, tags and notes are eagerly loaded
+            with one query per relationship
+        :param chunksize: The number of items loaded at once by the ORM path
+            (should be below the maximum number of SQL variables), or by each
+            task of the worker processes
+        :param library: Restricts to the publications of a library (see
+            :py:meth:`libraries`)
+        :param processes: If set (SQL path only), chunks of publications are
+            read concurrently by this number of worker processes, and returned
+            library by library (defaults to the manager one)
+        :param since: A watermark (see :py:meth:`watermark`): only the
+            publications changed since then are returned, followed by the
+            deleted ones (see :py:meth:`Paper.set_deleted`). When None and
+            the manager is incremental, the watermark of the previous call is
+            used (see :py:meth:`incremental_publications`)
+        """
+        if since is None and self.incremental:
+            yield from self.incremental_publications(
+                orm=orm, chunksize=chunksize, library=library, processes=processes
+            )
+            return
+
+        yield from self.read_publications(orm, chunksize, library, processes, since)
+        if since:
+            yield from self.deleted_publications(since, library)
+
+    def deleted_publications(self, since, library=None):
+        for libraryID, key in self.deleted_keys(since, library):
+            paper = self.paper(libraryID, key)
+            paper.set_deleted()
+            yield paper
+
+    def read_publications(self, orm, chunksize, library, processes, since):
+        if processes is None:
+            processes = self.processes
+        if processes:
+            if orm:
+                raise ValueError("Worker processes can only be used with SQL")
+            yield from self.parallel_publications(processes, library, since, chunksize)
+            return
+
+        if not orm:
+            yield from self.sql_publications(library, since)
+            return
+
+        configure_mappers()
+        files = self.attachments()
+        session = self.session()
+        try:
+            ids = self.publication_ids(session, library)
+            if since is not None:
+                conn = self.engine.raw_connection()
+                try:
+                    subset, parameters = Manager.item_subset(conn, since=since)
+                    changed = set(row[0] for row in conn.execute(subset, parameters))
+                finally:
+                    conn.close()
+                ids = [itemID for itemID in ids if itemID in changed]
+            logging.debug("Loading %d Zotero publications", len(ids))
+            for start in range(0, len(ids), chunksize):
+                query = (
+                    session.query(dbz.Item)
+                    .filter(dbz.Item.itemID.in_(ids[start : start + chunksize]))
+                    .options(
+                        subqueryload(dbz.Item.data).joinedload(dbz.ItemData.field),
+                        subqueryload(dbz.Item.data).joinedload(dbz.ItemData.value),
+                        subqueryload(dbz.Item.creators).joinedload(
+                            dbz.ItemCreator.creator
+                        ),
+                        subqueryload(dbz.Item.tags).joinedload(dbz.ItemTag.tag),
+                        subqueryload(dbz.Item.notes),
+                    )
+                    .order_by(dbz.Item.itemID)
+                )
+                for item in query:
+                    paper = self.paper(item.libraryID, item.key)
+                    paper.populate(item, files.get(item.itemID, []))
+                    yield paper
+
+                # Papers do not keep references to ORM objects
+                session.expunge_all()
+        finally:
+            session.close()
 
-    def get_item_by_key(self, key):
-        return Paper(self, key)
+    @staticmethod
+    def publication_rows(conn, library=None, since=None, items=None):
+        """Reads the publications with plain SQL
+
+        Yields, for each publication (ordered by item ID), its row and the
+        lists of its fields, creators, tags, notes and attachments rows.
+
+        :param conn: A sqlite3 connection
+        :param library: Restricts to the publications of a library
+        :param since: Restricts to the publications changed since a watermark
+        :param items: Restricts to a range of item IDs (first, last)
+        """
+        subset, parameters = Manager.item_subset(conn, library, since)
+        if items is not None:
+            parameters["first"], parameters["last"] = items
+        cursors = []
+        for query, column in (
+            (Manager.PUBLICATIONS_QUERY, "i.itemID"),
+            (Manager.FIELDS_QUERY, "d.itemID"),
+            (Manager.CREATORS_QUERY, "ic.itemID"),
+            (Manager.TAGS_QUERY, "it.itemID"),
+            (Manager.NOTES_QUERY, "parentItemID"),
+            (Manager.ATTACHMENTS_QUERY, "a.parentItemID"),
+        ):
+            conditions = []
+            if subset is not None:
+                conditions.append("%s IN (%s)" % (column, subset))
+            if items is not None:
+                conditions.append("%s BETWEEN :first AND :last" % column)
+            condition = " AND ".join(conditions) or "1"
+            cursors.append(conn.execute(query % condition, parameters))
+        return merge_join(*cursors)
+
+    @staticmethod
+    def chunk_rows(path, library, since, items):
+        """Reads the publications of a range of item IDs of a library (in a
+        worker process)"""
+        conn = connect_pooled(path)
+        try:
+            return list(Manager.publication_rows(conn, library, since, items))
+        finally:
+            conn.close()
+
+    """Query of the publication IDs of a library, which are split into chunks"""
+    LIBRARY_IDS_QUERY = (
+        """SELECT i.itemID FROM items i WHERE %s AND i.libraryID = ? ORDER BY i.itemID"""
+        % PUBLICATION_CONDITION
+    )
+
+    def chunks(self, library, chunksize):
+        """Returns the ranges of item IDs (first, last) of a library, each
+        containing (at most) chunksize publications"""
+        conn = self.engine.raw_connection()
+        try:
+            ids = [
+                itemID
+                for itemID, in conn.execute(Manager.LIBRARY_IDS_QUERY, (library,))
+            ]
+        finally:
+            conn.close()
+        return [
+            (ids[start], ids[min(start + chunksize, len(ids)) - 1])
+            for start in range(0, len(ids), chunksize)
+        ]
+
+    def sql_publications(self, library=None, since=None):
+        """Returns all the publications using plain SQL"""
+        conn = self.engine.raw_connection()
+        try:
+            for item, related in Manager.publication_rows(conn, library, since):
+                yield self.publication(item, related)
+        finally:
+            conn.close()
+
+    def parallel_publications(self, processes, library=None, since=None, chunksize=500):
+        """Returns all the publications (library by library), reading chunks
+        of publications in worker processes (with their own connection to the
+        snapshot)
+
+        Chunks are returned in order as soon as they are read; at most two
+        chunks per process are pending, which bounds the memory used.
+        """
+        if library is None:
+            libraries = [row[0] for row in self.libraries()]
+        else:
+            libraries = [library]
+        chunks = (
+            (library, items)
+            for library in libraries
+            for items in self.chunks(library, chunksize)
+        )
 
-    def get_paper_by_key(self, key):
-        return Paper(self, key)
+        path = str(self.ro_dbpath)
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            pending = deque()
+            for library, items in chunks:
+                pending.append(
+                    executor.submit(Manager.chunk_rows, path, library, since, items)
+                )
+                if len(pending) < 2 * processes:
+                    continue
+                for item, related in pending.popleft().result():
+                    yield self.publication(item, related)
+            while pending:
+                for item, related in pending.popleft().result():
+                    yield self.publication(item, related)
+
+    def publication(self, item, related):
+        """Populates a paper from the rows of :py:meth:`publication_rows`"""
+        fields, creators, tags, notes, files = related
+        itemID, libraryID, key, itemTypeID, dateAdded = item
+        fieldnames = self.fieldnames
+        paper = self.paper(libraryID, key)
+        paper.set_values(
+            self.itemtypes.get(itemTypeID),
+            {fieldnames[fieldID]: value for _, fieldID, value in fields},
+            parse_datetime(dateAdded),
+            [Author(*creator[1:]) for creator in creators],
+            [tag for _, tag in tags],
+            [Note(*note[1:]) for note in notes],
+            [self.attachment(row) for row in files],
+        )
+        return paper
+
+    def get_collection_by_key(self, key, library=None):
+        """Returns a collection by key
+
+        :param library: The library of the collection; by default, the first
+            library that contains the key
+        """
+        with self.session() as session:
+            query = session.query(dbz.Collection).filter(dbz.Collection.key == key)
+            if library is not None:
+                query = query.filter(dbz.Collection.libraryID == library)
+            collection = query.order_by(dbz.Collection.libraryID).limit(1).one()
+            return Collection(self, collection.collectionID, collection.collectionName)
+
+    """Query of the library of a key (keys are only unique within a library)"""
+    KEY_LIBRARY_QUERY = (
+        "SELECT libraryID FROM items WHERE key = ? ORDER BY libraryID LIMIT 1"
+    )
+
+    def get_item_by_key(self, key, library=None):
+        return self.get_paper_by_key(key, library)
+
+    def get_paper_by_key(self, key, library=None):
+        """Returns a paper by key
+
+        :param library: The library of the paper; by default, the first
+            library that contains the key
+        """
+        if library is None:
+            conn = self.engine.raw_connection()
+            try:
+                row = conn.execute(Manager.KEY_LIBRARY_QUERY, (key,)).fetchone()
+            finally:
+                conn.close()
+            library = 1 if row is None else row[0]
+        return self.paper(library, key)
 
     def get_publication_by_uri(self, uri):
-        re_papers_uri = re.compile(r"^zotero://select/items/\d+_(.*)$")
+        re_papers_uri = re.compile(r"^zotero://select/items/(\d+)_(.*)$")
         m = re_papers_uri.match(uri)
         if m is None:
             logging.warn("%s is not a Zotero URI", uri)
             return None
         else:
-            uriref = m.group(1)
+            libraryID, uriref = int(m.group(1)), m.group(2)
             logging.debug("Searching for Zotero publication with UUID %s", uriref)
-            item = (
-                self.session.query(dbz.Item)
+            with self.session() as session:
+                item = (
+                    session.query(dbz.Item)
+                    .outerjoin(dbz.DeletedItem)
+                    .filter(dbz.DeletedItem.itemID == None)
+                    .filter(dbz.Item.libraryID == libraryID)
+                    .filter(dbz.Item.key == uriref)
+                    .one()
+                )
+                return self.paper(item.libraryID, item.key)
+
+    def find_by(self, key, value):
+        with self.session() as session:
+            query = (
+                session.query(dbz.ItemData, dbz.Item)
+                .join(dbz.FieldsCombined)
+                .join(dbz.ItemDataValue)
+                .join(dbz.Item)
                 .outerjoin(dbz.DeletedItem)
                 .filter(dbz.DeletedItem.itemID == None)
-                .filter(dbz.Item.key == uriref)
-                .one()
+                .filter(dbz.ItemData.fieldID == self.fields[key])
+                .filter(dbz.ItemDataValue.value.like(value))
             )
 
-            return Paper(self, item.key)
-
-    def find_by(self, key, value):
-        query = (
-            self.session.query(dbz.ItemData, dbz.Item)
-            .join(dbz.FieldsCombined)
-            .join(dbz.ItemDataValue)
-            .join(dbz.Item)
-            .outerjoin(dbz.DeletedItem)
-            .filter(dbz.DeletedItem.itemID == None)
-            .filter(dbz.ItemData.fieldID == self.fields[key])
-            .filter(dbz.ItemDataValue.value.like(value))
-        )
+            logging.debug(
+                "Retrieving Zotero paper by %s == [%s]: %s", key, value, query
+            )
+            papers = []
+            for data, item in query:
+                papers.append(self.paper(item.libraryID, item.key))
 
-        logging.debug("Retrieving Zotero paper by %s == [%s]: %s", key, value, query)
-        papers = []
-        for data, item in query:
-            papers.append(Paper(self, item.key))
+        return papers
 
+    """Query of index(), which reads the values of one field"""
+    INDEX_QUERY = """SELECT i.libraryID, i.key, v.value FROM items i, itemData d, itemDataValues v
+        WHERE d.itemID = i.itemID AND v.valueID = d.valueID AND d.fieldID = ? AND %s"""
+
+    def index(self, field):
+        """Returns the index of a field (normalized value -> list of (library
+        ID, key))
+
+        The index covers all the publications; it is built with one query the
+        first time it is needed, and dropped when the snapshot changes.
+        """
+        index = self.indices.get(field)
+        if index is None:
+            with self.lock:
+                index = self.indices.get(field)
+                if index is None:
+                    index = self.indices[field] = self.read_index(field)
+        return index
+
+    def read_index(self, field):
+        start = time.time()
+        index = {}
+        conn = self.engine.raw_connection()
+        try:
+            for libraryID, key, value in conn.execute(
+                Manager.INDEX_QUERY % Manager.PUBLICATION_CONDITION,
+                (self.fields[field],),
+            ):
+                index.setdefault(normalize(field, value), []).append((libraryID, key))
+        finally:
+            conn.close()
+        logging.info(
+            "Indexed %d values of Zotero field %s in %.2fs",
+            len(index),
+            field,
+            time.time() - start,
+        )
+        return index
+
+    def find_by_many(self, field, values):
+        """Finds publications by field value
+
+        Values are normalized (see :py:func:`normalize`) and looked up in an
+        in-memory index of the field; values containing a % are SQL LIKE
+        patterns and are searched with :py:meth:`find_by`.
+
+        :param field: The Zotero field name (e.g. DOI or title)
+        :param values: An iterable over the searched values
+        :returns: A dictionary value -> list of papers
+        """
+        index = self.index(field)
+        papers = {}
+        for value in values:
+            if "%" in value:
+                papers[value] = self.find_by(field, value)
+            else:
+                papers[value] = [
+                    self.paper(libraryID, key)
+                    for libraryID, key in index.get(normalize(field, value), ())
+                ]
         return papers
 
     def find_by_doi(self, doi):
-        return self.find_by("DOI", doi)
+        return self.find_by_many("DOI", [doi])[doi]
 
     def find_by_title(self, title):
-        return self.find_by("title", title)
+        return self.find_by_many("title", [title])[title]
+
+    """Query of search_fulltext(): indexed attachments are mapped to their
+    parent, and publications are ranked by the number of matched words"""
+    FULLTEXT_QUERY = """SELECT i.libraryID, i.key, COUNT(DISTINCT fw.wordID) AS matches
+        FROM fulltextWords w
+        JOIN fulltextItemWords fw ON fw.wordID = w.wordID
+        LEFT JOIN itemAttachments a ON a.itemID = fw.itemID
+        JOIN items i ON i.itemID = COALESCE(a.parentItemID, fw.itemID)
+        WHERE w.word IN (%s) AND %s
+        GROUP BY i.itemID HAVING matches >= ?
+        ORDER BY matches DESC, i.itemID"""
+
+    def search_fulltext(self, words, match_all=True):
+        """Searches publications using the full-text index of Zotero
+
+        Only the index (words -> attachments) is read, not the files.
+
+        :param words: A string or a list of words
+        :param match_all: If True, publications must contain all the words;
+            otherwise, they must contain at least one
+        :returns: A list of papers (surrogates), ordered by decreasing number of
+            matched words
+        """
+        if isinstance(words, str):
+            words = re.findall(r"\w+", words)
+        # Zotero indexes lowercased words
+        words = sorted(set(word.lower() for word in words))
+        if not words:
+            return []
+
+        conn = self.engine.raw_connection()
+        try:
+            query = Manager.FULLTEXT_QUERY % (
+                ", ".join("?" * len(words)),
+                Manager.PUBLICATION_CONDITION,
+            )
+            rows = conn.execute(query, words + [len(words) if match_all else 1])
+            return [self.paper(libraryID, key) for libraryID, key, _ in rows]
+        finally:
+            conn.close()
 
     @staticmethod
     def create(prefix, args):
         """Creates a new manager"""
         parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument(
+            "--%sdbpath" % prefix,
+            dest="dbpath",
+            default=None,
+            help="The path to the Zotero sqlite database, "
+            "defaults to the one of the default Zotero profile",
+        )
+        parser.add_argument(
+            "--%sfilebase" % prefix,
+            dest="filebase",
+            default=None,
+            help="The base attachment path, "
+            "defaults to the one of the default Zotero profile",
+        )
+        parser.add_argument(
+            "--%sprocesses" % prefix,
+            dest="processes",
+            type=int,
+            default=None,
+            help="Read the libraries concurrently with this number of processes",
+        )
+        parser.add_argument(
+            "--%sincremental" % prefix,
+            dest="incremental",
+            action="store_true",
+            default=False,
+            help="Only read the publications changed since the previous "
+            "incremental read (the first one reads everything)",
+        )
         parser.add_argument(
             "--%shelp" % prefix,
             action="help",
             help="Provides helps about arguments for this manager",
         )
         args, remaining_args = parser.parse_known_args(args)
-        return Manager(args.dbpath), remaining_args
+        return (
+            Manager(
+                args.dbpath,
+                args.filebase,
+                processes=args.processes,
+                incremental=args.incremental,
+            ),
+            remaining_args,
+        )
@@ -1,6 +1,148 @@
+import itertools
+import json
+import logging
+import os
+import os.path as op
+import sqlite3
+import time
+from operator import itemgetter
+from pathlib import Path
+
+
 def dict_factory(cursor, row):
     """Used to extract results from a sqlite3 row by name"""
     d = {}
     for idx, col in enumerate(cursor.description):
         d[col[0]] = row[idx]
     return d
+
+
+def connect_readonly(path, **kwargs):
+    """Opens a read-only connection to a sqlite database"""
+    return sqlite3.connect(
+        Path(path).resolve().as_uri() + "?mode=ro", uri=True, **kwargs
+    )
+
+
+"""Size of the memory map of pooled connections (256 MB)"""
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+def connect_pooled(path, mmap_size=MMAP_SIZE):
+    """Opens a read-only connection that can be shared between threads
+
+    The connection is meant to be used by one thread at a time (e.g. through
+    a connection pool); it is query only, and reads the database through a
+    memory map.
+    """
+    conn = connect_readonly(path, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA mmap_size = %d" % mmap_size)
+    return conn
+
+
+def has_table(conn, name):
+    """Returns True if the database has a table with this name"""
+    return (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+        ).fetchone()
+        is not None
+    )
+
+
+def merge_join(rows, *others, key=itemgetter(0)):
+    """Merge-joins iterables of rows sorted by the same key
+
+    Yields, for each row of rows, the row and, for each of the other
+    iterables, the list of its rows with the same key.
+
+    :param key: A function returning the key of a row (defaults to the
+        first column)
+    """
+    groups = [itertools.groupby(other, key=key) for other in others]
+    current = [next(group, None) for group in groups]
+    for row in rows:
+        rowkey = key(row)
+        matched = []
+        for ix, group in enumerate(groups):
+            while current[ix] is not None and current[ix][0] < rowkey:
+                current[ix] = next(group, None)
+            if current[ix] is not None and current[ix][0] == rowkey:
+                matched.append(list(current[ix][1]))
+                current[ix] = next(group, None)
+            else:
+                matched.append([])
+        yield row, matched
+
+
+def signature(path):
+    """Returns the modification time and size of a database and of its WAL
+
+    Writes in WAL mode may only touch the -wal file, so both are needed to
+    detect a change.
+    """
+    signature = []
+    for filepath in (str(path), "%s-wal" % path):
+        try:
+            s = os.stat(filepath)
+            signature.append([s.st_mtime_ns, s.st_size])
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+
+def backup(source, target, pages=1024):
+    """Copies a (possibly live) database into a connection
+
+    The online backup API copies a consistent state of the database, and
+    only locks the source while copying each batch of pages (if the source is
+    modified in between, the copy is restarted by sqlite).
+
+    :param source: The path of the source database
+    :param target: The connection to copy into
+    :param pages: The number of pages copied per step
+    """
+    start = time.time()
+    conn = connect_readonly(source)
+    try:
+        conn.backup(target, pages=pages)
+    finally:
+        conn.close()
+    logging.info("Backup of %s in %.2fs", source, time.time() - start)
+
+
+def snapshot(source, target, pages=1024):
+    """Ensures that target is an up-to-date snapshot of the source database
+
+    The snapshot is reused as long as the modification time and size of the
+    source (and of its WAL) are unchanged; otherwise, it is rebuilt with
+    :py:func:`backup` and atomically replaced.
+
+    :param source: The path of the source database
+    :param target: The path of the snapshot
+    :returns: True if the snapshot was (re)built
+    """
+    source, target = str(source), str(target)
+    stamppath = target + ".json"
+    current = signature(source)
+
+    if op.isfile(target) and op.isfile(stamppath):
+        with open(stamppath, "rt") as fh:
+            if json.load(fh) == current:
+                logging.info("Snapshot %s is up to date", target)
+                return False
+
+    tmppath = target + ".tmp"
+    if op.exists(tmppath):
+        os.remove(tmppath)
+    conn = sqlite3.connect(tmppath)
+    try:
+        backup(source, conn, pages=pages)
+    finally:
+        conn.close()
+
+    os.replace(tmppath, target)
+    with open(stamppath, "wt") as fh:
+        json.dump(current, fh)
+    return True
@@ -0,0 +1,10 @@
+import pytest
+
+import biblioruler.config as config
+
+
+@pytest.fixture(autouse=True)
+def configpath(tmp_path, monkeypatch):
+    """Keeps the configuration directory (cached defaults, watermarks) of the
+    tests away from the user one"""
+    monkeypatch.setattr(config, "CONFIGPATH", str(tmp_path / ".biblioruler"))
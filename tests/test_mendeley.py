@@ -0,0 +1,101 @@
+import os
+import sqlite3
+
+import pytest
+
+from biblioruler.managers.base import HighlightAnnotation, NoteAnnotation
+from biblioruler.managers.mendeley import Manager
+
+SCHEMA = """
+CREATE TABLE Documents(id INTEGER PRIMARY KEY, uuid TEXT, type TEXT, userType TEXT, publication TEXT,
+    note TEXT, added INTEGER, title TEXT, issn TEXT, isbn TEXT, year INT, month INT, pages TEXT, pmid TEXT,
+    doi TEXT, read INT, favourite INT, abstract TEXT, institution TEXT);
+CREATE TABLE DocumentContributors(id INTEGER PRIMARY KEY, documentId INT, contribution TEXT,
+    firstNames TEXT, lastName TEXT);
+CREATE TABLE DocumentTags(documentId INT, tag TEXT);
+CREATE TABLE DocumentFiles(documentId INT, hash TEXT);
+CREATE TABLE Files(hash TEXT, localUrl TEXT);
+CREATE TABLE Groups(id INTEGER PRIMARY KEY, groupType TEXT);
+CREATE TABLE RemoteDocuments(documentId INT, groupId INT);
+CREATE TABLE DocumentZotero(documentId INT);
+CREATE TABLE Folders(id INTEGER PRIMARY KEY, name TEXT, parentId INT);
+CREATE TABLE RemoteFolders(folderId INT, groupId INT);
+CREATE TABLE DocumentFolders(documentId INT, folderId INT);
+CREATE TABLE FileHighlights(id INTEGER PRIMARY KEY, fileHash TEXT, createdTime TEXT, color TEXT);
+CREATE TABLE FileHighlightRects(id INTEGER PRIMARY KEY, highlightId INT, page INT,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL);
+CREATE TABLE FileNotes(id INTEGER PRIMARY KEY, fileHash TEXT, page INT, x REAL, y REAL, author TEXT,
+    note TEXT, modifiedTime TEXT, color TEXT);
+INSERT INTO Groups VALUES (1, 'PersonalGroupType');
+"""
+
+
+def document(conn, documentId):
+    conn.execute(
+        "INSERT INTO Documents(id, uuid, type, added, title) VALUES (?, ?, 'JournalArticle', 1500000000000, ?)",
+        (documentId, "uuid-%d" % documentId, "Title %d" % documentId),
+    )
+    conn.execute("INSERT INTO RemoteDocuments VALUES (?, 1)", (documentId,))
+    conn.commit()
+
+
+@pytest.fixture
+def dbpath(tmp_path):
+    """A Mendeley database with one document, whose file has a highlight (on
+    two rectangles) and a note"""
+    path = str(tmp_path / "mendeley.sqlite")
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    document(conn, 1)
+    conn.executescript("""
+        INSERT INTO DocumentFiles VALUES (1, 'hash1');
+        INSERT INTO Files VALUES ('hash1', 'file:///tmp/1.pdf');
+        INSERT INTO FileHighlights VALUES (1, 'hash1', '2020-01-01T00:00:00', '#ff0');
+        INSERT INTO FileHighlightRects(highlightId, page, x1, y1, x2, y2)
+            VALUES (1, 1, 0, 0, 10, 10), (1, 1, 0, 10, 10, 20);
+        INSERT INTO FileNotes(fileHash, page, x, y, author, note, modifiedTime, color)
+            VALUES ('hash1', 2, 5, 5, 'me', 'A note', '2020-01-01T00:00:00', '#ff0');
+        """)
+    conn.close()
+    return path
+
+
+def count(manager):
+    return manager.dbconn.execute("SELECT COUNT(*) AS n FROM Documents").fetchone()["n"]
+
+
+def test_refresh_snapshot(dbpath, tmp_path):
+    manager = Manager(dbpath, snapshot=str(tmp_path / "snapshot.sqlite"))
+    assert count(manager) == 1
+    assert manager.refresh() is False
+
+    conn = sqlite3.connect(dbpath)
+    document(conn, 2)
+    conn.close()
+    assert manager.refresh() is True
+    assert count(manager) == 2
+
+
+@pytest.mark.parametrize("snapshot", [None, ":memory:"])
+def test_refresh_without_snapshot_file(dbpath, tmp_path, monkeypatch, snapshot):
+    monkeypatch.chdir(tmp_path)
+    manager = Manager(dbpath, snapshot=snapshot)
+    assert manager.refresh() is False
+    assert sorted(os.listdir(tmp_path)) == ["mendeley.sqlite"]
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_annotations(dbpath, tmp_path, bulk):
+    manager = Manager(dbpath, snapshot=str(tmp_path / "snapshot.sqlite"))
+    (paper,) = manager.publications(bulk=bulk)
+    (file,) = paper.files
+    highlight, note = file.annotations
+
+    assert isinstance(highlight, HighlightAnnotation)
+    assert highlight.page == 0
+    assert highlight.bboxes == [[0, 0, 10, 10], [0, 10, 10, 20]]
+
+    assert isinstance(note, NoteAnnotation)
+    assert note.page == 1
+    assert note.text == "A note"
+    assert note.bbox == [5, 5, 35, 35]
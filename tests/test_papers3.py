@@ -0,0 +1,229 @@
+import os.path as op
+import plistlib
+import sqlite3
+import struct
+
+import pytest
+from sqlalchemy import create_engine
+
+from biblioruler.managers.db.papers3 import metadata
+import biblioruler.managers.papers3 as papers3_module
+from biblioruler.managers.base import HighlightAnnotation, NoteAnnotation
+from biblioruler.managers.papers3 import Papers3
+
+
+def log(conn, table, uuid, modType=1):
+    conn.execute(
+        "INSERT INTO changeLog(modifiedDate, modTable, modUUID, modType, dbRevision) VALUES (1, ?, ?, ?, 'r')",
+        (table, uuid, modType),
+    )
+    conn.commit()
+
+
+@pytest.fixture
+def papers3(tmp_path):
+    """A Papers3 library with three publications, their authors and a
+    collection"""
+    path = tmp_path / "Database.papersdb"
+    metadata.create_all(create_engine("sqlite:///%s" % path))
+
+    conn = sqlite3.connect(str(path))
+    conn.execute("INSERT INTO Metadata(uuid, key, value) VALUES ('m', 'version', '1')")
+    conn.execute(
+        "INSERT INTO Author(uuid, prename, surname) VALUES ('A', 'Ada', 'Lovelace')"
+    )
+    conn.execute(
+        "INSERT INTO Collection(uuid, name, editable, priority, type) VALUES ('C', 'Collection', 1, 0, 0)"
+    )
+    for i in range(3):
+        conn.execute(
+            "INSERT INTO Publication(uuid, type, attributed_title, created_at, updated_at) VALUES (?, -100, ?, 0, 0)",
+            ("P%d" % i, "Title %d" % i),
+        )
+        conn.execute(
+            "INSERT INTO OrderedAuthor(uuid, author_id, object_id, priority) VALUES (?, 'A', ?, 0)",
+            ("OA%d" % i, "P%d" % i),
+        )
+        conn.execute(
+            "INSERT INTO CollectionItem(uuid, collection, object_id, priority) VALUES (?, 'C', ?, 0)",
+            ("CI%d" % i, "P%d" % i),
+        )
+    log(conn, "Publication", "P0")
+    return Papers3(str(path), str(tmp_path), incremental=True), conn
+
+
+@pytest.fixture
+def library(tmp_path):
+    """A Papers3 library with 150 publications (with authors and keywords),
+    a file with an annotation, a collection and a smart collection"""
+    path = tmp_path / "Database.papersdb"
+    metadata.create_all(create_engine("sqlite:///%s" % path))
+
+    conn = sqlite3.connect(str(path))
+    conn.execute("INSERT INTO Metadata(uuid, key, value) VALUES ('m', 'version', '1')")
+    conn.executemany(
+        "INSERT INTO Author(uuid, prename, surname) VALUES (?, ?, ?)",
+        [("A%d" % i, "First%d" % i, "Last%d" % i) for i in range(5)],
+    )
+    conn.executemany(
+        "INSERT INTO Keyword(uuid, name, canonical_name) VALUES (?, ?, ?)",
+        [("K%d" % i, "kw%d" % i, "kw%d" % i) for i in range(3)],
+    )
+    for i in range(150):
+        uuid = "P%03d" % i
+        conn.execute(
+            "INSERT INTO Publication(uuid, type, attributed_title, citekey, created_at, updated_at) VALUES (?, -100, ?, ?, 0, 0)",
+            (uuid, "Title %d" % i, "key%d" % i),
+        )
+        conn.execute(
+            "INSERT INTO OrderedAuthor(uuid, author_id, object_id, priority) VALUES (?, ?, ?, 0)",
+            ("OA%d" % i, "A%d" % (i % 5), uuid),
+        )
+        conn.execute(
+            "INSERT INTO KeywordItem(uuid, keyword_id, object_id, priority) VALUES (?, ?, ?, 0)",
+            ("KI%d" % i, "K%d" % (i % 3), uuid),
+        )
+        if i % 3 == 0:
+            conn.execute(
+                "INSERT INTO CollectionItem(uuid, collection, object_id, priority) VALUES (?, 'C', ?, 0)",
+                ("CI%d" % i, uuid),
+            )
+    conn.execute(
+        "INSERT INTO Collection(uuid, name, editable, priority, type) VALUES ('C', 'Collection', 1, 0, 0)"
+    )
+    conn.execute(
+        "INSERT INTO Collection(uuid, name, editable, priority, type, configuration) VALUES ('S', 'Smart', 0, 1, 1, ?)",
+        (
+            plistlib.dumps(
+                {
+                    "smart": {
+                        "predicateFormat": 'attributed_title CONTAINS[c] "TITLE 12"'
+                    }
+                },
+                fmt=plistlib.FMT_BINARY,
+            ),
+        ),
+    )
+    conn.execute(
+        "INSERT INTO PDF(uuid, object_id, is_primary, mime_type, path, md5) VALUES ('F', 'P000', 1, 'application/pdf', 'Files/0.pdf', 'x')"
+    )
+    conn.execute(
+        "INSERT INTO Annotation(uuid, object_id, type, contents, text, created_at, page_nr, rectangles, color) VALUES ('N', 'F', 0, 'A comment', 'text', 1000.0, 2, ?, 0)",
+        (struct.pack("<8d", 1, 2, 3, 4, 10, 20, 30, 40),),
+    )
+    conn.commit()
+    conn.close()
+    return Papers3(str(path), str(tmp_path))
+
+
+def test_get_many(library):
+    keys = ["key%d" % i for i in range(120)] + ["unknown"]
+    papers = library.get_many("citekey", keys)
+    assert sorted(paper.local_uuid for paper in papers) == [
+        "P%03d" % i for i in range(120)
+    ]
+
+    papers = library.get_many("rowid", ["1", "2", "150", "151"])
+    assert sorted(paper.local_uuid for paper in papers) == ["P000", "P001", "P149"]
+
+
+def test_incremental_deleted_rows(papers3):
+    manager, conn = papers3
+    assert len(list(manager.publications())) == 3
+    assert list(manager.publications()) == []
+
+    conn.execute("DELETE FROM CollectionItem WHERE uuid = 'CI1'")
+    log(conn, "CollectionItem", "CI1", 2)
+    conn.execute("DELETE FROM OrderedAuthor WHERE uuid = 'OA2'")
+    log(conn, "OrderedAuthor", "OA2", 2)
+
+    papers = list(manager.publications())
+    assert sorted(paper.local_uuid for paper in papers) == ["P1", "P2"]
+    assert not any(paper.deleted for paper in papers)
+    assert [paper.local_uuid for paper in papers if not paper.authors] == ["P2"]
+    assert list(manager.publications()) == []
+
+
+def test_without_preferences(papers3, monkeypatch):
+    """The Papers3 preferences are not read when the database is given"""
+
+    def defaults():
+        raise AssertionError("No Papers3 preferences")
+
+    manager, _ = papers3
+    monkeypatch.setattr(papers3_module, "defaults", defaults)
+    assert Papers3(manager.dbpath).filebase == op.dirname(manager.dbpath)
+
+
+def test_authors_and_keywords(library):
+    papers = {paper.local_uuid: paper for paper in library.publications()}
+    assert len(papers) == 150
+    for i in (0, 7, 149):
+        paper = papers["P%03d" % i]
+        assert [author.surname for author in paper.authors] == ["Last%d" % (i % 5)]
+        assert [author.firstname for author in paper.authors] == ["First%d" % (i % 5)]
+        assert paper.keywords == {"kw%d" % (i % 3)}
+
+
+def test_surrogate_authors_and_keywords(library):
+    paper = library.paper("P042")
+    assert paper.surrogate
+    assert [author.surname for author in paper.authors] == ["Last2"]
+    assert paper.keywords == {"kw0"}
+    assert paper.title == "Title 42"
+
+
+@pytest.fixture(params=["numpy", "array"])
+def decoder(request, monkeypatch):
+    """Decodes rectangles with NumPy (if installed) and without"""
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(papers3_module, "numpy", None)
+    return papers3_module.decode_rectangles
+
+
+def test_decode_rectangles(decoder):
+    blob = struct.pack("<8d", 1, 2, 3, 4, 10, 20, 30, 40)
+    assert decoder([None, b"", blob + b"\0" * 8, blob[:32]]) == [
+        [],
+        [],
+        [[1, 2, 4, 6], [10, 20, 40, 60]],
+        [[1, 2, 4, 6]],
+    ]
+    assert decoder([]) == []
+
+
+def test_file_annotations(decoder, library):
+    (pdf,) = library.paper("P000").files
+    highlight, note = pdf.annotations
+    assert isinstance(highlight, HighlightAnnotation)
+    assert highlight.page == 1
+    assert highlight.bboxes == [[1, 2, 4, 6], [10, 20, 40, 60]]
+    assert isinstance(note, NoteAnnotation)
+    assert note.text == "A comment"
+    assert note.bbox == [1, 2, 31, 32]
+
+
+def test_collections(library):
+    papers = {paper.local_uuid: paper for paper in library.publications()}
+    collections = {
+        collection.local_uuid: collection
+        for collection in library.collections(virtual=True).values()
+    }
+
+    members = collections["C"].publications
+    assert [paper.local_uuid for paper in members] == [
+        "P%03d" % i for i in range(0, 150, 3)
+    ]
+    assert all(paper is papers[paper.local_uuid] for paper in members)
+
+    smart = collections["S"].publications
+    assert [paper.title for paper in smart] == ["Title 12"] + [
+        "Title %d" % i for i in range(120, 130)
+    ]
+    assert all(paper is papers[paper.local_uuid] for paper in smart)
+
+    assert [collection.local_uuid for collection in library.collections().values()] == [
+        "C"
+    ]
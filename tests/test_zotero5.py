@@ -0,0 +1,179 @@
+import importlib.util
+from pathlib import Path
+import sqlite3
+
+import pytest
+
+from biblioruler.managers import zotero5
+
+ROOT = Path(__file__).parent.parent
+
+
+def library(path, n):
+    spec = importlib.util.spec_from_file_location(
+        "zotero5_library", ROOT / "benchmarks" / "zotero5_library.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.create(str(path), n)
+
+
+SEARCHES = {
+    "Recursive": [("collection", "is", "PARENT"), ("recursive", "true", "")],
+    "Flat": [("collection", "is", "PARENT"), ("recursive", "false", "")],
+    "Trash": [("collection", "is", "PARENT"), ("deleted", "true", "")],
+    "Parents": [
+        ("collection", "is", "NOTES"),
+        ("includeParentsAndChildren", "true", ""),
+    ],
+    "NoChildren": [
+        ("collection", "is", "NOTES"),
+        ("includeParentsAndChildren", "true", ""),
+        ("noChildren", "true", ""),
+    ],
+}
+
+
+@pytest.fixture
+def zotero(tmp_path):
+    """A small Zotero library with a parent collection (containing a trashed
+    publication), its child collection, and a collection with a note"""
+    path = tmp_path / "zotero.sqlite"
+    library(path, 50)
+
+    conn = sqlite3.connect(str(path))
+    ids = [
+        itemID
+        for (itemID,) in conn.execute(
+            "SELECT itemID FROM items i WHERE %s ORDER BY itemID"
+            % zotero5.Manager.PUBLICATION_CONDITION
+        )
+    ][:3]
+    conn.executescript("""
+        DELETE FROM collectionItems;
+        INSERT INTO collections(collectionID, collectionName, parentCollectionID, libraryID, key)
+            VALUES (100, 'Parent', NULL, 1, 'PARENT'), (101, 'Child', 100, 1, 'CHILD'),
+                (102, 'Notes', NULL, 1, 'NOTES');
+        INSERT INTO items(itemID, itemTypeID, libraryID, key)
+            SELECT 10000, itemTypeID, 1, 'NOTE' FROM itemTypes WHERE typeName = 'note';
+        """)
+    conn.executemany(
+        "INSERT INTO collectionItems(collectionID, itemID) VALUES (?, ?)",
+        [(100, ids[0]), (101, ids[1]), (100, ids[2]), (102, 10000)],
+    )
+    conn.execute(
+        "INSERT INTO itemNotes(itemID, parentItemID) VALUES (10000, ?)", (ids[1],)
+    )
+    conn.execute("INSERT INTO deletedItems(itemID) VALUES (?)", (ids[2],))
+    for savedSearchID, (name, conditions) in enumerate(SEARCHES.items()):
+        conn.execute(
+            "INSERT INTO savedSearches(savedSearchID, savedSearchName, libraryID, key) VALUES (?, ?, 1, ?)",
+            (savedSearchID, name, "SEARCH%d" % savedSearchID),
+        )
+        conn.executemany(
+            "INSERT INTO savedSearchConditions(savedSearchID, searchConditionID, condition, operator, value, required) VALUES (?, ?, ?, ?, ?, 0)",
+            [
+                (savedSearchID, ix) + condition
+                for ix, condition in enumerate(conditions)
+            ],
+        )
+    keys = [
+        conn.execute("SELECT key FROM items WHERE itemID = ?", (itemID,)).fetchone()[0]
+        for itemID in ids
+    ]
+    conn.commit()
+    conn.close()
+
+    return zotero5.Manager(path, str(tmp_path), copy=False), keys
+
+
+def saved_searches(manager):
+    return {search.name: search for search in manager.saved_searches().values()}
+
+
+def keys(search):
+    return [paper.local_uuid for paper in search.publications]
+
+
+def test_recursive_saved_search(zotero):
+    manager, expected = zotero
+    searches = saved_searches(manager)
+    assert keys(searches["Recursive"]) == expected[:2]
+    assert keys(searches["Flat"]) == expected[:1]
+
+
+def test_saved_search_flags(zotero):
+    manager, expected = zotero
+    searches = saved_searches(manager)
+    assert keys(searches["Trash"]) == expected[2:]
+    assert keys(searches["Parents"]) == expected[1:2]
+    assert keys(searches["NoChildren"]) == []
+
+
+def test_collections(zotero):
+    manager, expected = zotero
+    papers = {paper.local_uuid: paper for paper in manager.publications()}
+    collections = {
+        collection.name: collection for collection in manager.collections().values()
+    }
+
+    parent, child, notes = (
+        collections["Parent"],
+        collections["Child"],
+        collections["Notes"],
+    )
+    assert parent.parent is None and notes.parent is None
+    assert child.parent is parent
+    assert parent.children == [child]
+    assert child.children == [] and notes.children == []
+
+    # The trashed publication is not a member
+    assert keys(parent) == expected[:1]
+    assert keys(child) == expected[1:2]
+    assert keys(notes) == []
+    assert all(
+        paper is papers[paper.local_uuid]
+        for paper in parent.publications + child.publications
+    )
+
+
+def test_without_profile(tmp_path, monkeypatch):
+    """The Zotero profile is not read when the database is given"""
+
+    def defaults():
+        raise AssertionError("Could not find the default profile")
+
+    monkeypatch.setattr(zotero5, "defaults", defaults)
+    path = tmp_path / "zotero.sqlite"
+    library(path, 10)
+    manager = zotero5.Manager(path, copy=False)
+    assert manager.basepaths["attachments"] == str(tmp_path / "storage")
+
+
+def test_keys_per_library(tmp_path):
+    """Collections and replaced items are found by (library, key)"""
+    path = tmp_path / "zotero.sqlite"
+    library(path, 20)
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+        INSERT INTO libraries(libraryID, type, editable, filesEditable, version, storageVersion, lastSync, archived)
+            VALUES (2, 'group', 1, 1, 0, 0, 0, 0);
+        INSERT INTO groups(groupID, libraryID, name, description, version) VALUES (77, 2, 'Group', '', 0);
+        INSERT INTO collections(collectionID, collectionName, libraryID, key)
+            VALUES (100, 'Mine', 1, 'SAME'), (101, 'Group', 2, 'SAME');
+        INSERT OR IGNORE INTO relationPredicates(predicate) VALUES ('dc:replaces');
+        INSERT INTO itemRelations(itemID, predicateID, object)
+            SELECT 2, predicateID, 'http://zotero.org/groups/77/items/GONE'
+            FROM relationPredicates WHERE predicate = 'dc:replaces';
+        INSERT INTO itemRelations(itemID, predicateID, object)
+            SELECT 3, predicateID, 'http://zotero.org/users/1/items/GONE'
+            FROM relationPredicates WHERE predicate = 'dc:replaces';
+        """)
+    conn.commit()
+    conn.close()
+
+    manager = zotero5.Manager(path, copy=False)
+    assert manager.get_collection_by_key("SAME").name == "Mine"
+    assert manager.get_collection_by_key("SAME", library=2).name == "Group"
+    replaced = manager.relations().replaced
+    assert replaced[2, "GONE"] == 2 and replaced[1, "GONE"] == 3
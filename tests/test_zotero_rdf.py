@@ -0,0 +1,52 @@
+import sqlite3
+import struct
+
+import pytest
+from sqlalchemy import create_engine
+
+from biblioruler.exporters.zotero_rdf import Exporter
+from biblioruler.managers.db.papers3 import metadata
+from biblioruler.managers.papers3 import Papers3
+
+
+@pytest.fixture
+def library(tmp_path):
+    """A Papers3 library with one publication, whose annotated PDF is not a
+    PDF"""
+    path = tmp_path / "Database.papersdb"
+    metadata.create_all(create_engine("sqlite:///%s" % path))
+    (tmp_path / "Files").mkdir()
+    (tmp_path / "Files" / "0.pdf").write_bytes(b"not a PDF")
+
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "INSERT INTO Publication(uuid, type, attributed_title, created_at, updated_at) VALUES ('P', -100, 'Title', 0, 0)"
+    )
+    conn.execute(
+        "INSERT INTO PDF(uuid, object_id, is_primary, mime_type, path, md5) VALUES ('F', 'P', 1, 'application/pdf', 'Files/0.pdf', 'x')"
+    )
+    conn.execute(
+        "INSERT INTO Annotation(uuid, object_id, type, contents, created_at, page_nr, rectangles, color) VALUES ('N', 'F', 0, 'A comment', 1000.0, 1, ?, 0)",
+        (struct.pack("<4d", 1, 2, 3, 4),),
+    )
+    conn.commit()
+    conn.close()
+    return Papers3(str(path), str(tmp_path))
+
+
+@pytest.mark.parametrize("jobs", [None, 2])
+def test_annotation_errors(library, tmp_path, jobs):
+    """PDFs that cannot be annotated are reported, and their attachments
+    point to the original file (with or without worker processes)"""
+    exporter = Exporter()
+    exporter.annotate = True
+    exporter.jobs = jobs
+    path = str(tmp_path / "export")
+    exporter.export(path, list(library.publications()), [])
+
+    source = str(tmp_path / "Files" / "0.pdf")
+    assert list(exporter.errors) == [source]
+    with open(path + ".rdf") as fp:
+        assert '<rdf:resource rdf:resource="%s"/>' % source in fp.read()
+    assert (tmp_path / "export").is_dir()
+    assert list((tmp_path / "export").iterdir()) == []